@@ -0,0 +1,251 @@
+import asyncio
+import functools
+import logging
+from typing import AsyncIterator, Dict, Iterable, List, Mapping, Optional, Set, Tuple, Union
+
+from .client import (APNsClient, MAX_CONNECTION_RETRIES, AnyNotification, NotificationPriority, NotificationType,
+                     _HeaderTemplateCache, _PayloadCache, _build_headers, _clamp_max_concurrent_streams,
+                     _encode_payload, _get_serializer, _parse_error_response, _raise_for_result, _request_token)
+from .async_connection import AsyncHTTP20Connection
+from .credentials import CertificateCredentials, Credentials
+from .errors import ConnectionFailed, PayloadTooLarge
+from .payload import Payload
+from .retry import RetryPolicy
+from .serializer import JSONSerializer
+from .validation import DuplicatePolicy, _PreSendCheck, _collect_results, normalize_token
+
+logger = logging.getLogger(__name__)
+
+_TaskResult = Tuple[str, Union[str, Tuple[str, str]]]
+
+
+class AsyncAPNsClient(object):
+    """
+    asyncio counterpart of APNsClient. It exposes the same send/batch API as coroutines and runs
+    on h2 connections driven by asyncio streams instead of hyper's blocking HTTP20Connection.
+    Batches are spread over the `pool_size` connections, single notifications use the first one.
+    """
+    SANDBOX_SERVER = APNsClient.SANDBOX_SERVER
+    LIVE_SERVER = APNsClient.LIVE_SERVER
+
+    DEFAULT_PORT = APNsClient.DEFAULT_PORT
+    ALTERNATIVE_PORT = APNsClient.ALTERNATIVE_PORT
+
+    def __init__(self,
+                 credentials: Union[Credentials, str],
+                 use_sandbox: bool = False, use_alternative_port: bool = False,
+                 json_encoder: Optional[type] = None, password: Optional[str] = None,
+                 truncate_alert_body: bool = False, retry_policy: Optional[RetryPolicy] = None,
+                 serializer: Optional[JSONSerializer] = None, validate_tokens: bool = False,
+                 duplicate_policy: DuplicatePolicy = DuplicatePolicy.Keep, pool_size: int = 1) -> None:
+        if isinstance(credentials, str):
+            self.__credentials = CertificateCredentials(credentials, password)  # type: Credentials
+        else:
+            self.__credentials = credentials
+
+        if pool_size < 1:
+            raise ValueError('pool_size must be at least 1')
+        server = self.SANDBOX_SERVER if use_sandbox else self.LIVE_SERVER
+        port = self.ALTERNATIVE_PORT if use_alternative_port else self.DEFAULT_PORT
+        self._connections = [self.__credentials.create_async_connection(server, port) for _ in range(pool_size)]
+        self._connection = self._connections[0]
+
+        self.__serializer = _get_serializer(serializer, json_encoder)
+        self.__truncate_alert_body = truncate_alert_body
+        self.__retry_policy = retry_policy
+        self.__validate_tokens = validate_tokens
+        self.__duplicate_policy = duplicate_policy
+        self.__max_concurrent_streams = [0] * pool_size
+        self.__previous_server_max_concurrent_streams = [None] * pool_size  # type: List[Optional[int]]
+
+    async def send_notification(self, token_hex: str, notification: Payload, topic: Optional[str] = None,
+                                priority: NotificationPriority = NotificationPriority.Immediate,
+                                expiration: Optional[int] = None, collapse_id: Optional[str] = None) -> None:
+        await self.connect()
+        stream_id = await self.send_notification_async(token_hex, notification, topic, priority, expiration,
+                                                       collapse_id)
+        _raise_for_result(await self.get_notification_result(stream_id))
+
+    async def send_notification_async(self, token_hex: str, notification: Payload, topic: Optional[str] = None,
+                                      priority: NotificationPriority = NotificationPriority.Immediate,
+                                      expiration: Optional[int] = None, collapse_id: Optional[str] = None,
+                                      push_type: Optional[NotificationType] = None) -> int:
+        token_hex = _request_token(token_hex, self.__validate_tokens)
+        json_payload = _encode_payload(notification, self.__serializer, self.__truncate_alert_body)
+        headers = _build_headers(self.__credentials, notification, topic, priority, expiration, collapse_id,
+                                 push_type)
+
+        return await self._send_request(self._connection, token_hex, json_payload, headers)
+
+    @staticmethod
+    async def _send_request(connection: AsyncHTTP20Connection, token_hex: str, json_payload: bytes,
+                            headers: Mapping[str, str]) -> int:
+        url = '/3/device/{}'.format(token_hex)
+        return await connection.request('POST', url, json_payload, headers)
+
+    async def get_notification_result(self, stream_id: int) -> Union[str, Tuple[str, str]]:
+        """
+        Get result for specified stream
+        The function returns: 'Success' or 'failure reason' or ('Unregistered', timestamp)
+        """
+        return await self._get_result(self._connection, stream_id)
+
+    async def _get_result(self, connection: AsyncHTTP20Connection, stream_id: int) -> Union[str, Tuple[str, str]]:
+        status, raw_data = await connection.get_response(stream_id)
+        if status == 200:
+            return 'Success'
+        else:
+            return _parse_error_response(status, raw_data, self.__serializer)
+
+    async def send_notification_batch(self, notifications: Iterable[AnyNotification], topic: Optional[str] = None,
+                                      priority: NotificationPriority = NotificationPriority.Immediate,
+                                      expiration: Optional[int] = None, collapse_id: Optional[str] = None,
+                                      push_type: Optional[NotificationType] = None
+                                      ) -> Dict[str, Union[str, Tuple[str, str]]]:
+        """
+        Send a notification to a list of tokens in batch, see APNsClient.send_notification_batch.
+
+        Every request runs in its own task, so as many streams as the server allows are kept in
+        flight on every connection of the pool and a new request is sent as soon as any response
+        arrives.
+        """
+        return _collect_results([result async for result in self.iter_notification_results(
+            notifications, topic, priority, expiration, collapse_id, push_type)])
+
+    async def iter_notification_results(self, notifications: Iterable[AnyNotification], topic: Optional[str] = None,
+                                        priority: NotificationPriority = NotificationPriority.Immediate,
+                                        expiration: Optional[int] = None, collapse_id: Optional[str] = None,
+                                        push_type: Optional[NotificationType] = None
+                                        ) -> AsyncIterator[Tuple[str, Union[str, Tuple[str, str]]]]:
+        """
+        Streaming variant of send_notification_batch, yielding a (token, result) pair as soon as
+        each response arrives. See APNsClient.iter_notification_results.
+        """
+        await self.connect()
+
+        payload_cache = _PayloadCache(self.__serializer, self.__truncate_alert_body)
+        header_templates = _HeaderTemplateCache(self.__credentials, topic, priority, expiration, collapse_id,
+                                                push_type)
+        pre_send_check = None  # type: Optional[_PreSendCheck]
+        if self.__validate_tokens or self.__duplicate_policy is not DuplicatePolicy.Keep:
+            pre_send_check = _PreSendCheck(self.__validate_tokens, self.__duplicate_policy, self.__serializer)
+        # Tasks sending a request and waiting for its response, and the finished ones not yielded yet
+        pending = set()  # type: Set[asyncio.Future[_TaskResult]]
+        finished = asyncio.Queue()  # type: asyncio.Queue[asyncio.Future[_TaskResult]]
+        in_flight = [0] * len(self._connections)
+
+        def task_done(index: int, task: 'asyncio.Future[_TaskResult]') -> None:
+            pending.discard(task)
+            in_flight[index] -= 1
+            finished.put_nowait(task)
+
+        try:
+            for notification in notifications:
+                rejection = pre_send_check.check(notification) if pre_send_check is not None else None
+                if rejection is not None:
+                    yield notification.token, rejection
+                    continue
+
+                # A SETTINGS frame can be sent by the server at any time.
+                self.update_max_concurrent_streams()
+                while True:
+                    # Report every response that arrived meanwhile, not only when all streams are busy
+                    while not finished.empty():
+                        yield finished.get_nowait().result()
+                    free_streams, index = max((self.__max_concurrent_streams[index] - count, index)
+                                              for index, count in enumerate(in_flight))
+                    if free_streams > 0:
+                        break
+                    yield (await finished.get()).result()
+
+                try:
+                    json_payload = payload_cache.encode(notification.payload)
+                except PayloadTooLarge:
+                    # APNs would reject it anyway, don't waste a stream on it
+                    yield notification.token, 'PayloadTooLarge'
+                    continue
+
+                headers = header_templates.headers(notification)
+                token = normalize_token(notification.token) if self.__validate_tokens else notification.token
+                task = asyncio.ensure_future(self._send_and_get_result(index, notification.token, json_payload,
+                                                                       headers, token))
+                pending.add(task)
+                in_flight[index] += 1
+                task.add_done_callback(functools.partial(task_done, index))
+                # Let the request go out and the reader tasks process responses
+                await asyncio.sleep(0)
+
+            while pending or not finished.empty():
+                yield (await finished.get()).result()
+        finally:
+            for unfinished in list(pending):
+                unfinished.cancel()
+
+    async def _send_and_get_result(self, index: int, token_hex: str, json_payload: bytes,
+                                   headers: Mapping[str, str], request_token: Optional[str] = None) -> _TaskResult:
+        # The result is reported for token_hex, and the request sent to request_token if given, its
+        # normalized form
+        connection = self._connections[index]
+        attempt = 0
+        lost_connections = 0
+        while True:
+            try:
+                stream_id = await self._send_request(connection, request_token or token_hex, json_payload, headers)
+                result = await self._get_result(connection, stream_id)
+            except OSError:
+                # The connection was lost or terminated by the server before the response arrived:
+                # reconnect and send the request again.
+                lost_connections += 1
+                if lost_connections > MAX_CONNECTION_RETRIES:
+                    raise ConnectionFailed()
+                logger.warning('Connection to APNs lost, sending to token %s again', token_hex)
+                await self._connect(connection)
+                continue
+
+            reason = result[0] if isinstance(result, tuple) else result
+            if self.__retry_policy is None or not self.__retry_policy.should_retry(reason, attempt):
+                return token_hex, result
+
+            await asyncio.sleep(self.__retry_policy.delay(attempt))
+            attempt += 1
+
+    def update_max_concurrent_streams(self) -> None:
+        for index in range(len(self._connections)):
+            self._update_max_concurrent_streams(index)
+
+    def _update_max_concurrent_streams(self, index: int) -> None:
+        max_concurrent_streams = self._connections[index].max_concurrent_streams
+        if max_concurrent_streams == self.__previous_server_max_concurrent_streams[index]:
+            # The server hasn't issued an updated SETTINGS frame.
+            return
+
+        self.__previous_server_max_concurrent_streams[index] = max_concurrent_streams
+        self.__max_concurrent_streams[index] = _clamp_max_concurrent_streams(max_concurrent_streams)
+
+    async def connect(self) -> None:
+        """
+        Establish every connection of the pool to APNs. Connections that are already established
+        are left untouched. If a connection fails, the function retries up to
+        MAX_CONNECTION_RETRIES times.
+        """
+        for connection in self._connections:
+            await self._connect(connection)
+
+    async def _connect(self, connection: AsyncHTTP20Connection) -> None:
+        retries = 0
+        while retries < MAX_CONNECTION_RETRIES:
+            # noinspection PyBroadException
+            try:
+                await connection.connect()
+                logger.info('Connected to APNs')
+                return
+            except Exception:  # pylint: disable=broad-except
+                await connection.close()
+                retries += 1
+                logger.exception('Failed connecting to APNs (attempt %s of %s)', retries, MAX_CONNECTION_RETRIES)
+
+        raise ConnectionFailed()
+
+    async def close(self) -> None:
+        for connection in self._connections:
+            await connection.close()
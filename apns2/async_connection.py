@@ -0,0 +1,263 @@
+import asyncio
+import logging
+from typing import Dict, List, Mapping, Optional, Tuple, TYPE_CHECKING
+
+import h2.config  # type: ignore
+import h2.connection  # type: ignore
+import h2.events  # type: ignore
+from hyper.tls import init_context  # type: ignore
+
+if TYPE_CHECKING:
+    from hyper.ssl_compat import SSLContext  # type: ignore
+
+READ_CHUNK_SIZE = 65535
+
+logger = logging.getLogger(__name__)
+
+
+class _ResponseStream(object):
+    def __init__(self, future: 'asyncio.Future[Tuple[int, bytes]]') -> None:
+        self.future = future
+        self.status = 0
+        self.data = []  # type: List[bytes]
+
+
+class AsyncHTTP20Connection(object):
+    """
+    A minimal HTTP/2 client connection built on h2 and asyncio streams.
+
+    It covers only what APNs needs: POST requests with small bodies, responses collected per
+    stream, and the server's SETTINGS frame for max_concurrent_streams. Any number of coroutines
+    may have requests in flight at the same time, responses are dispatched by a single reader task.
+    """
+
+    def __init__(self, host: str, port: int, ssl_context: 'Optional[SSLContext]' = None,
+                 secure: bool = True) -> None:
+        self.host = host
+        self.port = port
+        self.secure = secure
+        self.ssl_context = ssl_context
+
+        self._conn = None  # type: Optional[h2.connection.H2Connection]
+        self._reader = None  # type: Optional[asyncio.StreamReader]
+        self._writer = None  # type: Optional[asyncio.StreamWriter]
+        self._read_task = None  # type: Optional[asyncio.Future[None]]
+        self._streams = {}  # type: Dict[int, _ResponseStream]
+        self._results = {}  # type: Dict[int, asyncio.Future[Tuple[int, bytes]]]
+        self._error = None  # type: Optional[Exception]
+        self._settings_received = None  # type: Optional[asyncio.Event]
+        self._window_updated = None  # type: Optional[asyncio.Event]
+        self._stream_closed = None  # type: Optional[asyncio.Event]
+        self._drain_lock = None  # type: Optional[asyncio.Lock]
+        self._connect_lock = None  # type: Optional[asyncio.Lock]
+
+    @property
+    def connected(self) -> bool:
+        return self._writer is not None
+
+    @property
+    def max_concurrent_streams(self) -> int:
+        if self._conn is None:
+            return 0
+        return int(self._conn.remote_settings.max_concurrent_streams)
+
+    async def connect(self) -> None:
+        """
+        Open the connection and wait for the server's SETTINGS frame. This is a no-op if we're
+        already connected.
+        """
+        if self._connect_lock is None:
+            self._connect_lock = asyncio.Lock()
+        async with self._connect_lock:
+            await self._connect()
+
+    async def _connect(self) -> None:
+        if self._writer is not None:
+            return
+
+        ssl_context = None
+        if self.secure:
+            ssl_context = self.ssl_context or init_context()
+        reader, writer = await asyncio.open_connection(self.host, self.port, ssl=ssl_context)
+
+        config = h2.config.H2Configuration(client_side=True, header_encoding='utf-8')
+        self._conn = h2.connection.H2Connection(config=config)
+        self._conn.initiate_connection()
+        writer.write(self._conn.data_to_send())
+
+        self._reader, self._writer = reader, writer
+        self._error = None
+        self._settings_received = asyncio.Event()
+        self._window_updated = asyncio.Event()
+        self._stream_closed = asyncio.Event()
+        self._drain_lock = asyncio.Lock()
+        self._read_task = asyncio.ensure_future(self._read_loop())
+
+        await self._settings_received.wait()
+        if self._error is not None:
+            raise self._error
+
+    async def close(self) -> None:
+        if self._writer is None:
+            return
+
+        if self._conn is not None:
+            self._conn.close_connection()
+            self._writer.write(self._conn.data_to_send())
+        self._abort(ConnectionError('Connection closed'))
+
+        if self._read_task is not None:
+            self._read_task.cancel()
+            self._read_task = None
+
+    async def request(self, method: str, url: str, body: bytes, headers: Mapping[str, str]) -> int:
+        """
+        Send a request and return its stream ID. The response is collected with get_response().
+        """
+        if self._conn is None or self._writer is None:
+            raise ConnectionError('Tried to send a request on a closed connection')
+
+        conn = self._conn
+        assert self._stream_closed is not None
+        while conn.open_outbound_streams >= conn.remote_settings.max_concurrent_streams:
+            # The server lowered its limit below the number of requests in flight, wait for one to finish.
+            self._stream_closed.clear()
+            await self._stream_closed.wait()
+            if self._conn is not conn:
+                raise self._error or ConnectionError('Connection lost while waiting for a free stream')
+
+        stream_id = conn.get_next_available_stream_id()  # type: int
+        request_headers = [
+            (':method', method),
+            (':scheme', 'https' if self.secure else 'http'),
+            (':authority', self.host),
+            (':path', url),
+        ]
+        request_headers.extend(headers.items())
+        conn.send_headers(stream_id, request_headers)
+
+        future = asyncio.get_event_loop().create_future()  # type: asyncio.Future[Tuple[int, bytes]]
+        self._streams[stream_id] = _ResponseStream(future)
+        self._results[stream_id] = future
+
+        try:
+            await self._send_body(stream_id, body)
+        except BaseException:
+            # Nobody is going to wait for the response of a request that failed to send
+            self._streams.pop(stream_id, None)
+            del self._results[stream_id]
+            if not future.done():
+                future.cancel()
+            elif not future.cancelled():
+                future.exception()
+            raise
+        return stream_id
+
+    async def get_response(self, stream_id: int) -> Tuple[int, bytes]:
+        """
+        Wait for the response on the specified stream and return its status and body.
+        """
+        return await self._results.pop(stream_id)
+
+    async def _send_body(self, stream_id: int, body: bytes) -> None:
+        assert self._conn is not None and self._window_updated is not None
+        # Not Optional, the identity check below must not widen it again
+        conn = self._conn  # type: h2.connection.H2Connection
+        window_updated = self._window_updated  # type: asyncio.Event
+        while True:
+            window = min(conn.local_flow_control_window(stream_id), conn.max_outbound_frame_size)
+            if window >= len(body):
+                conn.send_data(stream_id, body, end_stream=True)
+                await self._flush()
+                return
+
+            if window > 0:
+                conn.send_data(stream_id, body[:window])
+                body = body[window:]
+            await self._flush()
+
+            # Not enough flow control window left, wait until the server sends a WINDOW_UPDATE.
+            window_updated.clear()
+            await window_updated.wait()
+            if self._conn is not conn:
+                raise self._error or ConnectionError('Connection lost while sending request')
+
+    async def _flush(self) -> None:
+        writer = self._writer
+        if writer is None or self._conn is None:
+            raise self._error or ConnectionError('Tried to write to a closed connection')
+
+        writer.write(self._conn.data_to_send())
+        assert self._drain_lock is not None
+        # Concurrent drain() calls are not supported on older Python versions
+        async with self._drain_lock:
+            await writer.drain()
+
+    async def _read_loop(self) -> None:
+        assert self._reader is not None
+        try:
+            while True:
+                data = await self._reader.read(READ_CHUNK_SIZE)
+                if not data:
+                    raise ConnectionError('Connection closed by server')
+
+                assert self._conn is not None and self._writer is not None
+                for event in self._conn.receive_data(data):
+                    self._handle_event(event)
+                self._writer.write(self._conn.data_to_send())
+        except Exception as exc:  # pylint: disable=broad-except
+            self._abort(exc)
+
+    def _handle_event(self, event: 'h2.events.Event') -> None:
+        assert self._conn is not None
+        if isinstance(event, h2.events.ResponseReceived):
+            stream = self._streams.get(event.stream_id)
+            if stream is not None:
+                stream.status = int(dict(event.headers)[':status'])
+        elif isinstance(event, h2.events.DataReceived):
+            self._conn.acknowledge_received_data(event.flow_controlled_length, event.stream_id)
+            stream = self._streams.get(event.stream_id)
+            if stream is not None:
+                stream.data.append(event.data)
+        elif isinstance(event, h2.events.StreamEnded):
+            assert self._stream_closed is not None
+            self._stream_closed.set()
+            stream = self._streams.pop(event.stream_id, None)
+            if stream is not None and not stream.future.done():
+                stream.future.set_result((stream.status, b''.join(stream.data)))
+        elif isinstance(event, h2.events.StreamReset):
+            assert self._stream_closed is not None
+            self._stream_closed.set()
+            stream = self._streams.pop(event.stream_id, None)
+            if stream is not None and not stream.future.done():
+                stream.future.set_exception(
+                    ConnectionError('Stream %d reset by server (error code %s)' % (event.stream_id,
+                                                                                   event.error_code)))
+        elif isinstance(event, h2.events.RemoteSettingsChanged):
+            assert self._settings_received is not None
+            self._settings_received.set()
+        elif isinstance(event, h2.events.WindowUpdated):
+            assert self._window_updated is not None
+            self._window_updated.set()
+        elif isinstance(event, h2.events.ConnectionTerminated):
+            raise ConnectionError('Connection terminated by server (error code %s)' % event.error_code)
+
+    def _abort(self, error: Exception) -> None:
+        """
+        Fail every outstanding stream with the given error and reset the connection state, so
+        that the next connect() call opens a fresh connection.
+        """
+        self._error = error
+        for stream in self._streams.values():
+            if not stream.future.done():
+                stream.future.set_exception(error)
+        self._streams = {}
+
+        if self._writer is not None:
+            self._writer.close()
+        self._reader = self._writer = None
+        self._conn = None
+
+        for event in (self._settings_received, self._window_updated, self._stream_closed):
+            if event is not None:
+                event.set()
@@ -1,18 +1,34 @@
 import collections
-import json
+import heapq
+import itertools
 import logging
+import select
+import socket
+import ssl
 import time
 import typing
 import weakref
 from enum import Enum
 from threading import Thread
-from typing import Dict, Iterable, Optional, Tuple, Union
+from types import MappingProxyType
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Mapping, Optional, Set, Tuple, Union
 
+from h2.exceptions import H2Error  # type: ignore
+from hyper import HTTP20Connection  # type: ignore
+from hyper.http20.exceptions import HTTP20Error, StreamResetError  # type: ignore
+
+from .concurrency import AdaptiveConcurrency
 from .credentials import CertificateCredentials, Credentials
-from .errors import ConnectionFailed, exception_class_for_reason
+from .errors import BadDeviceToken, ConnectionFailed, PayloadTooLarge, exception_class_for_reason
+from .observer import Observer
 # We don't generally need to know about the Credentials subclasses except to
 # keep the old API, where APNsClient took a cert_file
-from .payload import Payload
+from .payload import MAX_PAYLOAD_SIZE, Payload
+from .rate_limit import TokenRateLimiter, _RateLimitQueue
+from .retry import RetryPolicy
+from .serializer import JSONSerializer, get_default_serializer
+from .token_sink import InvalidTokenSink, _report_result
+from .validation import DuplicatePolicy, _PreSendCheck, _collect_results, is_valid_token, normalize_token
 
 
 class NotificationPriority(Enum):
@@ -31,14 +47,429 @@ class NotificationType(Enum):
 
 RequestStream = collections.namedtuple('RequestStream', ['stream_id', 'token'])
 Notification = collections.namedtuple('Notification', ['token', 'payload'])
+# A notification whose optional fields override the batch-wide arguments of send_notification_batch,
+# so that a single batch can target several apps
+RoutedNotification = collections.namedtuple('RoutedNotification', ['token', 'payload', 'topic', 'priority',
+                                                                   'expiration', 'collapse_id', 'push_type'],
+                                            defaults=(None, None, None, None, None))
+AnyNotification = Union[Notification, RoutedNotification]
+# Overrides of a plain Notification
+_NO_ROUTING = (None, None, None, None, None)
 
 DEFAULT_APNS_PRIORITY = NotificationPriority.Immediate
 CONCURRENT_STREAMS_SAFETY_MAXIMUM = 1000
 MAX_CONNECTION_RETRIES = 3
+# Result of a notification of a batch whose stream was reset or lost on every attempt
+STREAM_LOST = 'StreamLost'
+# Number of distinct payloads kept encoded during a batch
+PAYLOAD_CACHE_SIZE = 16
+# Number of distinct topic, priority, expiration, collapse ID and push type combinations whose
+# headers are kept during a batch
+HEADER_CACHE_SIZE = 256
+# A batch logs a progress summary every this many results or seconds, whichever comes first
+PROGRESS_LOG_INTERVAL = 10000
+PROGRESS_LOG_PERIOD = 10.0
+TRUNCATION_ELLIPSIS = '\u2026'
+_JSON_SHORT_ESCAPES = frozenset('"\\\b\f\n\r\t')
 
 logger = logging.getLogger(__name__)
 
 
+def _get_serializer(serializer: Optional[JSONSerializer], json_encoder: Optional[type]) -> JSONSerializer:
+    """The serializer a client was given, or else the default one, unless a JSONEncoder is given"""
+    if serializer is not None:
+        return serializer
+    elif json_encoder is not None:
+        return JSONSerializer(json_encoder)
+    return get_default_serializer()
+
+
+def _encode_payload(notification: Payload, serializer: JSONSerializer, truncate_alert_body: bool = False) -> bytes:
+    """
+    Serialize a payload, raising PayloadTooLarge instead of letting APNs reject it. With
+    truncate_alert_body, an oversized payload gets its alert body shortened to fit, which costs a
+    single extra serialization.
+    """
+    json_payload = notification.encode(serializer)
+    if len(json_payload) <= MAX_PAYLOAD_SIZE:
+        return json_payload
+
+    if truncate_alert_body:
+        excess = len(json_payload) - MAX_PAYLOAD_SIZE
+        # The payload's dictionaries are shared, truncate copies of them
+        payload_dict = dict(notification.dict())
+        payload_dict['aps'] = dict(payload_dict['aps'])
+        alert = payload_dict['aps'].get('alert')
+        if isinstance(alert, dict) and alert.get('body'):
+            payload_dict['aps']['alert'] = dict(alert, body=_truncate_text(alert['body'], excess))
+            json_payload = serializer.dumps(payload_dict)
+        elif isinstance(alert, str) and alert:
+            payload_dict['aps']['alert'] = _truncate_text(alert, excess)
+            json_payload = serializer.dumps(payload_dict)
+
+        if len(json_payload) <= MAX_PAYLOAD_SIZE:
+            return json_payload
+
+    raise PayloadTooLarge()
+
+
+def _json_char_length(char: str) -> int:
+    """Number of bytes a character takes in a UTF-8 encoded JSON string"""
+    if char in _JSON_SHORT_ESCAPES:
+        return 2
+    elif char < ' ':
+        return 6  # \uXXXX
+    else:
+        return len(char.encode('utf-8'))
+
+
+def _truncate_text(text: str, excess: int) -> str:
+    """
+    Shorten text so that its JSON encoding is at least `excess` bytes smaller, ending it with an
+    ellipsis. Cuts only happen between characters, so multi-byte UTF-8 sequences are kept whole.
+    """
+    to_remove = excess + _json_char_length(TRUNCATION_ELLIPSIS)
+    end = len(text)
+    while end > 0 and to_remove > 0:
+        end -= 1
+        to_remove -= _json_char_length(text[end])
+
+    if end == 0:
+        return ''
+    return text[:end] + TRUNCATION_ELLIPSIS
+
+
+class _PayloadCache(object):
+    """
+    Encoded payloads of a batch, keyed by Payload identity. Broadcasts share one Payload object
+    between all notifications, so it's serialized only once and the same bytes are sent on every
+    stream. Payloads must not be modified while the batch is being sent.
+    """
+
+    def __init__(self, serializer: JSONSerializer, truncate_alert_body: bool = False,
+                 size: int = PAYLOAD_CACHE_SIZE) -> None:
+        self.__serializer = serializer
+        self.__truncate_alert_body = truncate_alert_body
+        self.__size = size
+        # Payloads that are too large are cached as None
+        self.__entries = collections.OrderedDict()  # type: typing.OrderedDict[int, Tuple[Payload, Optional[bytes]]]
+
+    def encode(self, payload: Payload) -> bytes:
+        key = id(payload)
+        entry = self.__entries.get(key)
+        # Keeping a reference to the payload guarantees its id can't be reused by another object
+        if entry is not None and entry[0] is payload:
+            self.__entries.move_to_end(key)
+            json_payload = entry[1]
+        else:
+            try:
+                json_payload = _encode_payload(payload, self.__serializer, self.__truncate_alert_body)
+            except PayloadTooLarge:
+                json_payload = None
+            self.__entries[key] = (payload, json_payload)
+            if len(self.__entries) > self.__size:
+                self.__entries.popitem(last=False)
+
+        if json_payload is None:
+            raise PayloadTooLarge()
+        return json_payload
+
+
+class _HeaderTemplate(object):
+    """
+    Request headers for a fixed topic, priority, expiration, collapse ID and push type. Everything
+    but the authorization header and the inferred push type is computed once, and the resulting
+    header mappings are shared between requests, so they must not be modified.
+    """
+
+    def __init__(self, credentials: Credentials, topic: Optional[str], priority: NotificationPriority,
+                 expiration: Optional[int], collapse_id: Optional[str],
+                 push_type: Optional[NotificationType]) -> None:
+        self.__credentials = credentials
+        self.__topic = topic
+        self.__priority = priority
+        self.__expiration = expiration
+        self.__collapse_id = collapse_id
+
+        # The push type depends on the payload only when it can't be determined from the topic
+        self.__push_type = None  # type: Optional[str]
+        self.__infer_push_type = False
+        if push_type:
+            self.__push_type = push_type.value
+        elif topic is not None:
+            self.__push_type = _topic_push_type(topic)
+            self.__infer_push_type = self.__push_type is None
+
+        self.__auth_header = None  # type: Optional[str]
+        self.__headers = {}  # type: Dict[Optional[str], Mapping[str, str]]
+        self.__build(None)
+
+    def __build(self, auth_header: Optional[str]) -> None:
+        self.__auth_header = auth_header
+        if self.__infer_push_type:
+            push_types = [NotificationType.Alert.value,
+                          NotificationType.Background.value]  # type: List[Optional[str]]
+        else:
+            push_types = [self.__push_type]
+        self.__headers = {push_type: MappingProxyType(self.__build_headers(push_type, auth_header))
+                          for push_type in push_types}
+
+    def __build_headers(self, push_type: Optional[str], auth_header: Optional[str]) -> Dict[str, str]:
+        headers = {}
+
+        if self.__topic is not None:
+            headers['apns-topic'] = self.__topic
+
+        if push_type:
+            headers['apns-push-type'] = push_type
+
+        if self.__priority != DEFAULT_APNS_PRIORITY:
+            headers['apns-priority'] = self.__priority.value
+
+        if self.__expiration is not None:
+            headers['apns-expiration'] = '%d' % self.__expiration
+
+        if auth_header is not None:
+            headers['authorization'] = auth_header
+
+        if self.__collapse_id is not None:
+            headers['apns-collapse-id'] = self.__collapse_id
+
+        return headers
+
+    def headers(self, notification: Payload) -> Mapping[str, str]:
+        auth_header = self.__credentials.get_authorization_header(self.__topic)
+        if auth_header != self.__auth_header:
+            # The provider token was refreshed
+            self.__build(auth_header)
+
+        if not self.__infer_push_type:
+            return self.__headers[self.__push_type]
+        return self.__headers[_payload_push_type(notification)]
+
+
+class _HeaderTemplateCache(object):
+    """
+    Header templates of a batch, one per distinct combination of the per-notification overrides.
+    Fields a notification leaves to None fall back to the batch-wide arguments.
+    """
+
+    def __init__(self, credentials: Credentials, topic: Optional[str], priority: NotificationPriority,
+                 expiration: Optional[int], collapse_id: Optional[str], push_type: Optional[NotificationType],
+                 size: int = HEADER_CACHE_SIZE) -> None:
+        self.__credentials = credentials
+        self.__topic = topic
+        self.__priority = priority
+        self.__expiration = expiration
+        self.__collapse_id = collapse_id
+        self.__push_type = push_type
+        self.__size = size
+        self.__templates = {}  # type: Dict[Tuple[Any, ...], _HeaderTemplate]
+
+    def headers(self, notification: AnyNotification) -> Mapping[str, str]:
+        # topic, priority, expiration, collapse_id and push_type
+        key = notification[2:] if isinstance(notification, RoutedNotification) else _NO_ROUTING
+        template = self.__templates.get(key)
+        if template is None:
+            if len(self.__templates) >= self.__size:
+                # Most likely a unique collapse ID per notification, don't let the cache grow
+                self.__templates.clear()
+            topic, priority, expiration, collapse_id, push_type = key
+            template = _HeaderTemplate(
+                self.__credentials,
+                self.__topic if topic is None else topic,
+                self.__priority if priority is None else priority,
+                self.__expiration if expiration is None else expiration,
+                self.__collapse_id if collapse_id is None else collapse_id,
+                self.__push_type if push_type is None else push_type,
+            )
+            self.__templates[key] = template
+        return template.headers(notification.payload)
+
+
+def _topic_push_type(topic: str) -> Optional[str]:
+    """The push type implied by the topic, if any"""
+    if topic.endswith('.voip'):
+        return NotificationType.VoIP.value
+    elif topic.endswith('.complication'):
+        return NotificationType.Complication.value
+    elif topic.endswith('.pushkit.fileprovider'):
+        return NotificationType.FileProvider.value
+    return None
+
+
+def _payload_push_type(notification: Payload) -> str:
+    """The push type of a payload sent to a topic that doesn't imply one"""
+    if any([
+        notification.alert is not None,
+        notification.badge is not None,
+        notification.sound is not None,
+    ]):
+        return NotificationType.Alert.value
+    else:
+        return NotificationType.Background.value
+
+
+def _build_headers(credentials: Credentials, notification: Payload, topic: Optional[str],
+                   priority: NotificationPriority, expiration: Optional[int], collapse_id: Optional[str],
+                   push_type: Optional[NotificationType]) -> Dict[str, str]:
+    """Request headers of a single notification, batches reuse _HeaderTemplate instances instead"""
+    headers = {}
+
+    inferred_push_type = None  # type: Optional[str]
+    if topic is not None:
+        headers['apns-topic'] = topic
+        inferred_push_type = _topic_push_type(topic) or _payload_push_type(notification)
+
+    if push_type:
+        inferred_push_type = push_type.value
+
+    if inferred_push_type:
+        headers['apns-push-type'] = inferred_push_type
+
+    if priority != DEFAULT_APNS_PRIORITY:
+        headers['apns-priority'] = priority.value
+
+    if expiration is not None:
+        headers['apns-expiration'] = '%d' % expiration
+
+    auth_header = credentials.get_authorization_header(topic)
+    if auth_header is not None:
+        headers['authorization'] = auth_header
+
+    if collapse_id is not None:
+        headers['apns-collapse-id'] = collapse_id
+
+    return headers
+
+
+def _request_token(token_hex: str, validate_tokens: bool) -> str:
+    """The token to send a single notification to, normalized and checked if tokens are validated"""
+    if not validate_tokens:
+        return token_hex
+    request_token = normalize_token(token_hex)
+    if not is_valid_token(request_token):
+        raise BadDeviceToken()
+    return request_token
+
+
+def _raise_for_result(result: Union[str, Tuple[str, str]]) -> None:
+    """Raise the exception of a single notification's failure reason"""
+    if result != 'Success':
+        if isinstance(result, tuple):
+            reason, info = result
+            raise exception_class_for_reason(reason)(info)
+        else:
+            raise exception_class_for_reason(result)
+
+
+def _clamp_max_concurrent_streams(max_concurrent_streams: int) -> int:
+    """The number of streams to use for the max_concurrent_streams setting of the server"""
+    # Handle and log unexpected values sent by APNs, just in case.
+    if max_concurrent_streams > CONCURRENT_STREAMS_SAFETY_MAXIMUM:
+        logger.warning('APNs max_concurrent_streams too high (%s), resorting to default maximum (%s)',
+                       max_concurrent_streams, CONCURRENT_STREAMS_SAFETY_MAXIMUM)
+        return CONCURRENT_STREAMS_SAFETY_MAXIMUM
+    elif max_concurrent_streams < 1:
+        logger.warning('APNs reported max_concurrent_streams less than 1 (%s), using value of 1',
+                       max_concurrent_streams)
+        return 1
+    else:
+        logger.info('APNs set max_concurrent_streams to %s', max_concurrent_streams)
+        return max_concurrent_streams
+
+
+def _parse_error_response(status: int, raw_data: bytes, serializer: JSONSerializer) -> Union[str, Tuple[str, str]]:
+    data = serializer.loads(raw_data)  # type: Dict[str, str]
+    if status == 410:
+        return data['reason'], data['timestamp']
+    else:
+        return data['reason']
+
+
+class _BatchProgress(object):
+    """
+    Counts the results of a batch per reason and logs a summary of them, with the current
+    throughput, every PROGRESS_LOG_INTERVAL results or PROGRESS_LOG_PERIOD seconds.
+    """
+
+    def __init__(self) -> None:
+        self.__interval = PROGRESS_LOG_INTERVAL
+        self.__period = PROGRESS_LOG_PERIOD
+        self.__counts = collections.Counter()  # type: typing.Counter[str]
+        self.__total = 0
+        self.__started = self.__logged_at = time.monotonic()
+        self.__logged_total = 0
+
+    def add(self, reason: str) -> None:
+        self.__counts[reason] += 1
+        self.__total += 1
+        # Results can trickle in, as in a dispatcher, so the clock is checked for every one of them
+        if (self.__total - self.__logged_total >= self.__interval
+                or time.monotonic() - self.__logged_at >= self.__period):
+            self.log('Batch progress')
+
+    def log(self, message: str) -> None:
+        now = time.monotonic()
+        rate = (self.__total - self.__logged_total) / max(now - self.__logged_at, 1e-6)
+        logger.info('%s: %d results (%.0f/s), %s', message, self.__total, rate, self.__summary())
+        self.__logged_at = now
+        self.__logged_total = self.__total
+
+    def finish(self) -> None:
+        elapsed = max(time.monotonic() - self.__started, 1e-6)
+        logger.info('Batch finished: %d results in %.1fs (%.0f/s), %s', self.__total, elapsed,
+                    self.__total / elapsed, self.__summary())
+
+    def __summary(self) -> str:
+        return ', '.join('%s: %d' % item for item in self.__counts.most_common()) or 'no results'
+
+
+# Errors raised by hyper when a connection is lost or terminated by the server
+_CONNECTION_ERRORS = (OSError, HTTP20Error, H2Error)
+
+# Notification, attempt number and send time of a request waiting for its response
+_OpenStream = Tuple[AnyNotification, int, float]
+# Connection index, notification, attempt number and result of a batch request
+_Response = Tuple[int, AnyNotification, int, Union[str, Tuple[str, str]]]
+
+
+class _ConnectionLost(Exception):
+    def __init__(self, index: int) -> None:
+        super().__init__(index)
+        self.index = index
+
+
+def _is_stream_closed(connection: HTTP20Connection, stream_id: int) -> bool:
+    stream = connection.streams.get(stream_id)
+    # A stream missing from the connection was reset, get_response() will raise for it
+    return stream is None or bool(stream.remote_closed)
+
+
+def _next_notification(iterator: Iterator[Optional[AnyNotification]]) -> Tuple[Optional[AnyNotification], bool]:
+    """Next notification of a batch, and whether the batch is exhausted"""
+    try:
+        return next(iterator), False
+    except StopIteration:
+        return None, True
+
+
+def _drain_wakeup(wakeup: Optional[socket.socket]) -> None:
+    assert wakeup is not None
+    try:
+        while wakeup.recv(4096):
+            pass
+    except BlockingIOError:
+        pass
+
+
+def _has_pending_data(connection: HTTP20Connection) -> bool:
+    # TLS sockets may hold decrypted data that select() doesn't report
+    # pylint: disable=protected-access
+    sock = connection._sock._sck
+    return isinstance(sock, ssl.SSLSocket) and sock.pending() > 0
+
+
 class APNsClient(object):
     SANDBOX_SERVER = 'api.development.push.apple.com'
     LIVE_SERVER = 'api.push.apple.com'
@@ -51,36 +482,66 @@ class APNsClient(object):
                  use_sandbox: bool = False, use_alternative_port: bool = False, proto: Optional[str] = None,
                  json_encoder: Optional[type] = None, password: Optional[str] = None,
                  proxy_host: Optional[str] = None, proxy_port: Optional[int] = None,
-                 heartbeat_period: Optional[float] = None) -> None:
+                 heartbeat_period: Optional[float] = None, pool_size: int = 1,
+                 truncate_alert_body: bool = False, retry_policy: Optional[RetryPolicy] = None,
+                 observer: Optional[Observer] = None, log_tokens: bool = False,
+                 serializer: Optional[JSONSerializer] = None, validate_tokens: bool = False,
+                 duplicate_policy: DuplicatePolicy = DuplicatePolicy.Keep,
+                 invalid_token_sink: Optional[InvalidTokenSink] = None,
+                 rate_limiter: Optional[TokenRateLimiter] = None,
+                 concurrency: Optional[AdaptiveConcurrency] = None) -> None:
         if isinstance(credentials, str):
             self.__credentials = CertificateCredentials(credentials, password)  # type: Credentials
         else:
             self.__credentials = credentials
+        self.__observer = observer
+        self.__log_tokens = log_tokens
+        self.__validate_tokens = validate_tokens
+        self.__duplicate_policy = duplicate_policy
+        self.__invalid_token_sink = invalid_token_sink
+        self.__rate_limiter = rate_limiter
+        self.__concurrency = concurrency
+        if observer is not None:
+            self.__credentials.add_observer(observer)
+        # Token and send time of the requests sent with send_notification_async, reported to the
+        # observer and the invalid token sink when their result is read
+        self.__sent = {}  # type: Dict[int, Tuple[str, float]]
+        if pool_size < 1:
+            raise ValueError('pool_size must be at least 1')
+        self.__pool_size = pool_size
         self._init_connection(use_sandbox, use_alternative_port, proto, proxy_host, proxy_port)
 
         if heartbeat_period:
             self._start_heartbeat(heartbeat_period)
 
-        self.__json_encoder = json_encoder
-        self.__max_concurrent_streams = 0
-        self.__previous_server_max_concurrent_streams = None
+        self.__serializer = _get_serializer(serializer, json_encoder)
+        self.__truncate_alert_body = truncate_alert_body
+        self.__retry_policy = retry_policy
+        self.__max_concurrent_streams = [0] * pool_size
+        self.__previous_server_max_concurrent_streams = [None] * pool_size  # type: List[Optional[int]]
 
     def _init_connection(self, use_sandbox: bool, use_alternative_port: bool, proto: Optional[str],
                          proxy_host: Optional[str], proxy_port: Optional[int]) -> None:
         server = self.SANDBOX_SERVER if use_sandbox else self.LIVE_SERVER
         port = self.ALTERNATIVE_PORT if use_alternative_port else self.DEFAULT_PORT
-        self._connection = self.__credentials.create_connection(server, port, proto, proxy_host, proxy_port)
+        # All connections of the pool share the same credentials. The first one is also used for
+        # single notifications sent with send_notification/send_notification_async.
+        self._connections = [self.__credentials.create_connection(server, port, proto, proxy_host, proxy_port)
+                             for _ in range(self.__pool_size)]
+        self._connection = self._connections[0]
 
     def _start_heartbeat(self, heartbeat_period: float) -> None:
-        conn_ref = weakref.ref(self._connection)
+        conn_refs = [weakref.ref(connection) for connection in self._connections]
 
         def watchdog() -> None:
             while True:
-                conn = conn_ref()
-                if conn is None:
-                    break
+                for conn_ref in conn_refs:
+                    conn = conn_ref()
+                    if conn is None:
+                        return
 
-                conn.ping('-' * 8)
+                    conn.ping('-' * 8)
+                    del conn
                 time.sleep(heartbeat_period)
 
         thread = Thread(target=watchdog)
@@ -91,62 +552,33 @@ class APNsClient(object):
                           priority: NotificationPriority = NotificationPriority.Immediate,
                           expiration: Optional[int] = None, collapse_id: Optional[str] = None) -> None:
         stream_id = self.send_notification_async(token_hex, notification, topic, priority, expiration, collapse_id)
-        result = self.get_notification_result(stream_id)
-        if result != 'Success':
-            if isinstance(result, tuple):
-                reason, info = result
-                raise exception_class_for_reason(reason)(info)
-            else:
-                raise exception_class_for_reason(result)
+        _raise_for_result(self.get_notification_result(stream_id))
 
     def send_notification_async(self, token_hex: str, notification: Payload, topic: Optional[str] = None,
                                 priority: NotificationPriority = NotificationPriority.Immediate,
                                 expiration: Optional[int] = None, collapse_id: Optional[str] = None,
                                 push_type: Optional[NotificationType] = None) -> int:
-        json_str = json.dumps(notification.dict(), cls=self.__json_encoder, ensure_ascii=False, separators=(',', ':'))
-        json_payload = json_str.encode('utf-8')
-
-        headers = {}
-
-        inferred_push_type = None  # type: Optional[str]
-        if topic is not None:
-            headers['apns-topic'] = topic
-            if topic.endswith('.voip'):
-                inferred_push_type = NotificationType.VoIP.value
-            elif topic.endswith('.complication'):
-                inferred_push_type = NotificationType.Complication.value
-            elif topic.endswith('.pushkit.fileprovider'):
-                inferred_push_type = NotificationType.FileProvider.value
-            elif any([
-                notification.alert is not None,
-                notification.badge is not None,
-                notification.sound is not None,
-            ]):
-                inferred_push_type = NotificationType.Alert.value
-            else:
-                inferred_push_type = NotificationType.Background.value
-
-        if push_type:
-            inferred_push_type = push_type.value
-
-        if inferred_push_type:
-            headers['apns-push-type'] = inferred_push_type
-
-        if priority != DEFAULT_APNS_PRIORITY:
-            headers['apns-priority'] = priority.value
-
-        if expiration is not None:
-            headers['apns-expiration'] = '%d' % expiration
-
-        auth_header = self.__credentials.get_authorization_header(topic)
-        if auth_header is not None:
-            headers['authorization'] = auth_header
-
-        if collapse_id is not None:
-            headers['apns-collapse-id'] = collapse_id
+        try:
+            request_token = _request_token(token_hex, self.__validate_tokens)
+        except BadDeviceToken:
+            if self.__invalid_token_sink is not None:
+                _report_result(self.__invalid_token_sink, token_hex, 'BadDeviceToken')
+            raise
+        json_payload = _encode_payload(notification, self.__serializer, self.__truncate_alert_body)
+        headers = _build_headers(self.__credentials, notification, topic, priority, expiration, collapse_id,
+                                 push_type)
+        stream_id = self._send_request(self._connection, request_token, json_payload, headers)
+        if self.__observer is not None or self.__invalid_token_sink is not None:
+            self.__sent[stream_id] = (token_hex, time.monotonic())
+        if self.__observer is not None:
+            self.__observer.stream_opened(token_hex, stream_id)
+        return stream_id
 
+    @staticmethod
+    def _send_request(connection: HTTP20Connection, token_hex: str, json_payload: bytes,
+                      headers: Mapping[str, str]) -> int:
         url = '/3/device/{}'.format(token_hex)
-        stream_id = self._connection.request('POST', url, json_payload, headers)  # type: int
+        stream_id = connection.request('POST', url, json_payload, headers)  # type: int
         return stream_id
 
     def get_notification_result(self, stream_id: int) -> Union[str, Tuple[str, str]]:
@@ -154,111 +586,435 @@ class APNsClient(object):
         Get result for specified stream
         The function returns: 'Success' or 'failure reason' or ('Unregistered', timestamp)
         """
-        with self._connection.get_response(stream_id) as response:
+        status, result = self._read_response(self._connection, stream_id)
+        sent = self.__sent.pop(stream_id, None)
+        if sent is not None:
+            token_hex, sent_at = sent
+            if self.__observer is not None:
+                self._observe_response(token_hex, status, result, sent_at)
+            if self.__invalid_token_sink is not None:
+                _report_result(self.__invalid_token_sink, token_hex, result)
+        return result
+
+    def _get_result(self, connection: HTTP20Connection, stream_id: int) -> Union[str, Tuple[str, str]]:
+        return self._read_response(connection, stream_id)[1]
+
+    def _encode(self, payload: Payload) -> bytes:
+        """Serialize a payload the way this client sends it, see _encode_payload"""
+        return _encode_payload(payload, self.__serializer, self.__truncate_alert_body)
+
+    def _read_response(self, connection: HTTP20Connection,
+                       stream_id: int) -> Tuple[int, Union[str, Tuple[str, str]]]:
+        with connection.get_response(stream_id) as response:
             if response.status == 200:
-                return 'Success'
+                return 200, 'Success'
             else:
-                raw_data = response.read().decode('utf-8')
-                data = json.loads(raw_data)  # type: Dict[str, str]
-                if response.status == 410:
-                    return data['reason'], data['timestamp']
-                else:
-                    return data['reason']
-
-    def send_notification_batch(self, notifications: Iterable[Notification], topic: Optional[str] = None,
+                return response.status, _parse_error_response(response.status, response.read(), self.__serializer)
+
+    def _observe_response(self, token_hex: str, status: int, result: Union[str, Tuple[str, str]],
+                          sent_at: float) -> None:
+        assert self.__observer is not None
+        reason = result[0] if isinstance(result, tuple) else result
+        self.__observer.response_received(token_hex, status, reason, time.monotonic() - sent_at)
+
+    def send_notification_batch(self, notifications: Iterable[AnyNotification], topic: Optional[str] = None,
                                 priority: NotificationPriority = NotificationPriority.Immediate,
                                 expiration: Optional[int] = None, collapse_id: Optional[str] = None,
                                 push_type: Optional[NotificationType] = None) -> Dict[str, Union[str, Tuple[str, str]]]:
         """
         Send a notification to a list of tokens in batch. Instead of sending a synchronous request
-        for each token, send multiple requests concurrently. This is done on the same connection,
-        using HTTP/2 streams (one request per stream).
+        for each token, send multiple requests concurrently. This is done using HTTP/2 streams (one
+        request per stream) on every connection of the pool, each new request going to the
+        connection with the most free streams.
 
         APNs allows many streams simultaneously, but the number of streams can vary depending on
         server load. This method reads the SETTINGS frame sent by the server to figure out the
         maximum number of concurrent streams. Typically, APNs reports a maximum of 500.
 
+        The topic, priority, expiration, collapse ID and push type apply to every notification that
+        doesn't set its own in a RoutedNotification, so notifications for several apps can share a
+        batch and its streams.
+
         The function returns a dictionary mapping each token to its result. The result is "Success"
         if the token was sent successfully, or the string returned by APNs in the 'reason' field of
-        the response, if the token generated an error.
+        the response, if the token generated an error. Requests whose stream is reset, or whose
+        connection is lost, are sent again, up to MAX_CONNECTION_RETRIES times or max_retries of the
+        retry policy if that's more, after which the notification gets the StreamLost result.
+
+        If the client validates tokens, malformed ones get the BadDeviceToken result without being
+        sent, and the others are sent in lowercase. Notifications dropped by the duplicate policy
+        get the Duplicate result in iter_notification_results, which doesn't replace the result of
+        the notification they duplicate here.
+
+        With an invalid token sink, the BadDeviceToken, DeviceTokenNotForTopic and Unregistered
+        results are also reported to it as they arrive, and it's flushed at the end of the batch.
+
+        With a rate limiter, notifications exceeding the rate of their token are delayed before they
+        use a stream, or get the RateLimited or Coalesced result depending on its policy. While its
+        max_waiting notifications are delayed, no more are taken from the batch. The limit doesn't
+        apply to single notifications.
+
+        With adaptive concurrency, the number of requests in flight is also limited by its window,
+        which shrinks when APNs slows down or fails and grows back otherwise.
+        """
+        return _collect_results(self.iter_notification_results(notifications, topic, priority, expiration,
+                                                               collapse_id, push_type))
+
+    def iter_notification_results(self, notifications: Iterable[AnyNotification], topic: Optional[str] = None,
+                                  priority: NotificationPriority = NotificationPriority.Immediate,
+                                  expiration: Optional[int] = None, collapse_id: Optional[str] = None,
+                                  push_type: Optional[NotificationType] = None
+                                  ) -> Iterator[Tuple[str, Union[str, Tuple[str, str]]]]:
+        """
+        Streaming variant of send_notification_batch. Yields a (token, result) pair as soon as each
+        response arrives, so memory stays bounded by the number of streams in flight and results
+        can be processed while the batch is still being sent.
+
+        The notifications iterable is consumed lazily, and nothing is sent until the generator is
+        iterated.
+        """
+        for notification, result in self._iter_results(notifications, topic, priority, expiration, collapse_id,
+                                                       push_type):
+            yield notification.token, result
+
+    def _iter_results(self, notifications: Iterable[Optional[AnyNotification]], topic: Optional[str],
+                      priority: NotificationPriority, expiration: Optional[int], collapse_id: Optional[str],
+                      push_type: Optional[NotificationType], wakeup: Optional[socket.socket] = None,
+                      deduplicate: bool = True, on_error: Optional[Callable[[AnyNotification, Exception], None]] = None
+                      ) -> Iterator[Tuple[AnyNotification, Union[str, Tuple[str, str]]]]:
+        """
+        iter_notification_results, yielding each result with its notification.
+
+        With a wakeup socket, the notifications iterable may yield None when it has nothing to send
+        right now. Responses keep being processed meanwhile, and the iterable is polled again on
+        every iteration and whenever the wakeup socket becomes readable. Without deduplicate, the
+        duplicate policy of the client doesn't apply. With on_error, a notification whose request
+        can't be built is given to it with the exception, instead of ending the batch.
         """
         notification_iterator = iter(notifications)
-        next_notification = next(notification_iterator, None)
+        next_notification, exhausted = _next_notification(notification_iterator)
         # Make sure we're connected to APNs, so that we receive and process the server's SETTINGS
         # frame before starting to send notifications.
         self.connect()
 
-        results = {}
-        open_streams = collections.deque()  # type: typing.Deque[RequestStream]
+        payload_cache = _PayloadCache(self.__serializer, self.__truncate_alert_body)
+        header_templates = _HeaderTemplateCache(self.__credentials, topic, priority, expiration, collapse_id,
+                                                push_type)
+        # Logging every token costs two log records per notification and writes device tokens to the
+        # logs, so it's opt-in. Otherwise only aggregated progress is logged.
+        log_tokens = self.__log_tokens and logger.isEnabledFor(logging.DEBUG)
+        progress = _BatchProgress() if logger.isEnabledFor(logging.INFO) else None
+        pre_send_check = None  # type: Optional[_PreSendCheck]
+        duplicate_policy = self.__duplicate_policy if deduplicate else DuplicatePolicy.Keep
+        if self.__validate_tokens or duplicate_policy is not DuplicatePolicy.Keep:
+            pre_send_check = _PreSendCheck(self.__validate_tokens, duplicate_policy, self.__serializer)
+        invalid_token_sink = self.__invalid_token_sink
+        # Notifications held back by the rate limiter until their token may get one again
+        rate_limit_queue = _RateLimitQueue(self.__rate_limiter) if self.__rate_limiter is not None else None
+        concurrency = self.__concurrency
+        reported_window = None  # type: Optional[int]
+        # Stream ID to notification, attempt number and send time of the requests waiting for a
+        # response, for each connection of the pool
+        open_streams = [{} for _ in self._connections]  # type: List[Dict[int, _OpenStream]]
+        # Responses read from the connections but not processed yet
+        responses = collections.deque()  # type: typing.Deque[_Response]
+        # Requests that never got a response because their connection was lost, they are sent again
+        # before anything else
+        replay_queue = collections.deque()  # type: typing.Deque[Tuple[AnyNotification, int]]
+        # Replays of a notification allowed before it gets the StreamLost result
+        replay_limit = max(MAX_CONNECTION_RETRIES,
+                           self.__retry_policy.max_retries if self.__retry_policy is not None else 0)
+        lost_connections = 0
+        # Failed notifications to send again: (time when due, sequence number, attempt, notification)
+        retry_queue = []  # type: List[Tuple[float, int, int, AnyNotification]]
+        retry_sequence = itertools.count()
+        # Connections that reported Shutdown, they get no new requests and are reopened once idle
+        draining = set()  # type: Set[int]
         # Loop on the tokens, sending as many requests as possible concurrently to APNs.
         # When reaching the maximum concurrent streams limit, wait for a response before sending
         # another request.
-        while len(open_streams) > 0 or next_notification is not None:
+        while any(open_streams) or not exhausted or retry_queue or replay_queue or responses or rate_limit_queue:
+            if next_notification is None and not exhausted:
+                next_notification, exhausted = _next_notification(notification_iterator)
+                if exhausted:
+                    # Check again whether anything is left to wait for
+                    continue
+
+            for index in list(draining):
+                if not open_streams[index]:
+                    logger.info('Reopening connection to APNs after Shutdown')
+                    self._reconnect(index)
+                    draining.discard(index)
+
             # Update the max_concurrent_streams on every iteration since a SETTINGS frame can be
             # sent by the server at any time.
             self.update_max_concurrent_streams()
-            if next_notification is not None and len(open_streams) < self.__max_concurrent_streams:
-                logger.info('Sending to token %s', next_notification.token)
-                stream_id = self.send_notification_async(next_notification.token, next_notification.payload, topic,
-                                                         priority, expiration, collapse_id, push_type)
-                open_streams.append(RequestStream(stream_id, next_notification.token))
-
-                next_notification = next(notification_iterator, None)
-                if next_notification is None:
-                    # No tokens remaining. Proceed to get results for pending requests.
-                    logger.info('Finished sending all tokens, waiting for pending requests.')
-            else:
-                # We have at least one request waiting for response (otherwise we would have either
-                # sent new requests or exited the while loop.) Wait for the first outstanding stream
-                # to return a response.
-                pending_stream = open_streams.popleft()
-                result = self.get_notification_result(pending_stream.stream_id)
-                logger.info('Got response for %s: %s', pending_stream.token, result)
-                results[pending_stream.token] = result
-
-        return results
+            free_streams, index = max([(self.__max_concurrent_streams[index] - len(streams), index)
+                                       for index, streams in enumerate(open_streams) if index not in draining],
+                                      default=(0, 0))
+            if concurrency is not None:
+                concurrency.set_maximum(sum(self.__max_concurrent_streams[index] for index in range(self.__pool_size)
+                                            if index not in draining))
+                window = concurrency.limit
+                if window != reported_window and self.__observer is not None:
+                    self.__observer.concurrency_window_changed(window)
+                reported_window = window
+                free_streams = min(free_streams, window - sum(map(len, open_streams)))
+
+            notification, attempt = None, 0
+            if free_streams > 0:
+                if replay_queue:
+                    notification, attempt = replay_queue.popleft()
+                    if attempt > replay_limit:
+                        # Its stream was lost on every attempt, don't send it again
+                        if progress is not None:
+                            progress.add(STREAM_LOST)
+                        yield notification, STREAM_LOST
+                        continue
+                elif retry_queue and retry_queue[0][0] <= time.monotonic():
+                    _, _, attempt, notification = heapq.heappop(retry_queue)
+                elif rate_limit_queue is not None and rate_limit_queue.is_due():
+                    notification = rate_limit_queue.pop()
+                elif next_notification is not None and (rate_limit_queue is None or not rate_limit_queue.is_full()):
+                    notification = next_notification
+                    next_notification, exhausted = _next_notification(notification_iterator)
+                    if exhausted:
+                        # No tokens remaining. Proceed to get results for pending requests.
+                        logger.info('Finished sending all tokens, waiting for pending requests.')
+
+                    rejection = pre_send_check.check(notification) if pre_send_check is not None else None
+                    if rejection is not None:
+                        if progress is not None:
+                            progress.add(rejection)
+                        if invalid_token_sink is not None:
+                            _report_result(invalid_token_sink, notification.token, rejection)
+                        yield notification, rejection
+                        continue
+
+                    if rate_limit_queue is not None:
+                        admitted, held_back = rate_limit_queue.admit(notification)
+                        if held_back is not None:
+                            if progress is not None:
+                                progress.add(held_back[1])
+                            yield held_back
+                        if not admitted:
+                            continue
+
+            if notification is not None:
+                try:
+                    json_payload = payload_cache.encode(notification.payload)
+                    headers = header_templates.headers(notification)
+                    token = normalize_token(notification.token) if self.__validate_tokens else notification.token
+                except PayloadTooLarge:
+                    # APNs would reject it anyway, don't waste a stream on it
+                    if progress is not None:
+                        progress.add('PayloadTooLarge')
+                    yield notification, 'PayloadTooLarge'
+                    continue
+                except Exception as exc:  # pylint: disable=broad-except
+                    if on_error is None:
+                        raise
+                    on_error(notification, exc)
+                    continue
+
+                if log_tokens:
+                    logger.debug('Sending to token %s', notification.token)
+                try:
+                    stream_id = self._send_request(self._connections[index], token, json_payload, headers)
+                except _CONNECTION_ERRORS:
+                    lost_connections += 1
+                    self._recover_connection(index, open_streams, replay_queue, lost_connections,
+                                             (notification, attempt))
+                    continue
+                open_streams[index][stream_id] = (notification, attempt, time.monotonic())
+                if self.__observer is not None:
+                    self.__observer.stream_opened(notification.token, stream_id)
+                continue
+
+            if not responses:
+                # Nothing can be sent right now. Wait for any response, but no longer than until
+                # the next retry or rate limited notification is due.
+                timeout = None  # type: Optional[float]
+                # When the source has nothing to send right now, wait for it as well
+                idle_wakeup = wakeup if next_notification is None and not exhausted else None
+                due_times = [retry_queue[0][0]] if retry_queue else []  # type: List[float]
+                if rate_limit_queue:
+                    due_times.append(rate_limit_queue.next_due())
+                if due_times:
+                    timeout = max(0.0, min(due_times) - time.monotonic())
+                    if not any(open_streams) and idle_wakeup is None:
+                        time.sleep(timeout)
+                        continue
+                try:
+                    responses.extend(self._wait_for_responses(open_streams, replay_queue, timeout, idle_wakeup))
+                except _ConnectionLost as exc:
+                    lost_connections += 1
+                    self._recover_connection(exc.index, open_streams, replay_queue, lost_connections)
+                    continue
+                if not responses:
+                    continue
+
+            lost_connections = 0
+            index, notification, attempt, result = responses.popleft()
+            if log_tokens:
+                logger.debug('Got response for %s: %s', notification.token, result)
+
+            reason = result[0] if isinstance(result, tuple) else result
+            if reason == 'Shutdown':
+                draining.add(index)
+            if self.__retry_policy is not None and self.__retry_policy.should_retry(reason, attempt):
+                due = time.monotonic() + self.__retry_policy.delay(attempt)
+                heapq.heappush(retry_queue, (due, next(retry_sequence), attempt + 1, notification))
+                continue
+
+            if progress is not None:
+                progress.add(reason)
+            if invalid_token_sink is not None:
+                _report_result(invalid_token_sink, notification.token, result)
+            yield notification, result
+
+        if invalid_token_sink is not None:
+            invalid_token_sink.flush()
+        if progress is not None:
+            progress.finish()
+
+    def _wait_for_responses(self, open_streams: List[Dict[int, _OpenStream]],
+                            replay_queue: 'typing.Deque[Tuple[AnyNotification, int]]',
+                            timeout: Optional[float] = None, wakeup: Optional[socket.socket] = None) -> List[_Response]:
+        """
+        Block until at least one of the open streams has received its full response, and return
+        the responses of every such stream, in whichever order they arrived. Streams reset by the
+        server are moved to the replay queue. If a timeout is given, an empty list is returned when
+        no response arrived in time, and likewise when the wakeup socket becomes readable.
+        """
+        # pylint: disable=protected-access
+        replayed = len(replay_queue)
+        while True:
+            responses = []  # type: List[_Response]
+            for index, streams in enumerate(open_streams):
+                connection = self._connections[index]
+                # hyper records the ID of every stream that got a frame in recent_recv_streams.
+                # Streams that are not complete yet will show up there again with their final frame.
+                received_streams = connection.recent_recv_streams
+                connection.recent_recv_streams = set()
+                for stream_id in received_streams:
+                    if stream_id not in streams or not _is_stream_closed(connection, stream_id):
+                        continue
+
+                    notification, attempt, sent_at = streams.pop(stream_id)
+                    try:
+                        status, result = self._read_response(connection, stream_id)
+                    except StreamResetError:
+                        if self.__observer is not None:
+                            self.__observer.stream_lost(notification.token)
+                        if self.__concurrency is not None:
+                            self.__concurrency.stream_lost(sent_at)
+                        replay_queue.append((notification, attempt + 1))
+                        continue
+                    if self.__observer is not None:
+                        self._observe_response(notification.token, status, result, sent_at)
+                    if self.__concurrency is not None:
+                        self.__concurrency.response_received(result[0] if isinstance(result, tuple) else result,
+                                                             sent_at)
+                    responses.append((index, notification, attempt, result))
+            if responses or len(replay_queue) > replayed:
+                return responses
+
+            waiting = [index for index, streams in enumerate(open_streams) if streams]
+            if len(waiting) > 1 or timeout is not None or wakeup is not None:
+                readable = [index for index in waiting if _has_pending_data(self._connections[index])]
+                if not readable:
+                    sockets = {self._connections[index]._sock.fileno(): index for index in waiting}
+                    if wakeup is not None:
+                        sockets[wakeup.fileno()] = -1
+                    readable = [sockets[fd] for fd in select.select(list(sockets), [], [], timeout)[0]]
+                    if -1 in readable:
+                        _drain_wakeup(wakeup)
+                        return []
+                    if not readable:
+                        return []
+                waiting = readable
+
+            for index in waiting:
+                try:
+                    self._connections[index]._recv_cb()
+                except _CONNECTION_ERRORS as exc:
+                    raise _ConnectionLost(index) from exc
+
+    def _recover_connection(self, index: int, open_streams: List[Dict[int, _OpenStream]],
+                            replay_queue: 'typing.Deque[Tuple[AnyNotification, int]]', lost_connections: int,
+                            unsent: Optional[Tuple[AnyNotification, int]] = None) -> None:
+        """
+        Reopen a connection that was lost or sent GOAWAY in the middle of a batch, and queue every
+        request still waiting for a response on it to be sent again, followed by the unsent
+        notification whose request failed, if any. Each of them counts as a new attempt.
+        """
+        lost_streams = open_streams[index]
+        open_streams[index] = {}
+        logger.warning('Connection to APNs lost with %s requests in flight, reconnecting', len(lost_streams))
+        if lost_connections > MAX_CONNECTION_RETRIES:
+            raise ConnectionFailed()
+
+        # Keep the original sending order, lost requests are all sent before anything else
+        for notification, attempt, _ in lost_streams.values():
+            if self.__observer is not None:
+                self.__observer.stream_lost(notification.token)
+            replay_queue.append((notification, attempt + 1))
+        if unsent is not None:
+            replay_queue.append((unsent[0], unsent[1] + 1))
+        self._reconnect(index)
+
+    def _reconnect(self, index: int) -> None:
+        self._connections[index].close()
+        self.__previous_server_max_concurrent_streams[index] = None
+        self._connect(self._connections[index], reconnect=True)
 
     def update_max_concurrent_streams(self) -> None:
+        for index in range(self.__pool_size):
+            self._update_max_concurrent_streams(index)
+
+    def _update_max_concurrent_streams(self, index: int) -> None:
         # Get the max_concurrent_streams setting returned by the server.
         # The max_concurrent_streams value is saved in the H2Connection instance that must be
         # accessed using a with statement in order to acquire a lock.
         # pylint: disable=protected-access
-        with self._connection._conn as connection:
+        with self._connections[index]._conn as connection:
             max_concurrent_streams = connection.remote_settings.max_concurrent_streams
 
-        if max_concurrent_streams == self.__previous_server_max_concurrent_streams:
+        if max_concurrent_streams == self.__previous_server_max_concurrent_streams[index]:
             # The server hasn't issued an updated SETTINGS frame.
             return
 
-        self.__previous_server_max_concurrent_streams = max_concurrent_streams
-        # Handle and log unexpected values sent by APNs, just in case.
-        if max_concurrent_streams > CONCURRENT_STREAMS_SAFETY_MAXIMUM:
-            logger.warning('APNs max_concurrent_streams too high (%s), resorting to default maximum (%s)',
-                           max_concurrent_streams, CONCURRENT_STREAMS_SAFETY_MAXIMUM)
-            self.__max_concurrent_streams = CONCURRENT_STREAMS_SAFETY_MAXIMUM
-        elif max_concurrent_streams < 1:
-            logger.warning('APNs reported max_concurrent_streams less than 1 (%s), using value of 1',
-                           max_concurrent_streams)
-            self.__max_concurrent_streams = 1
-        else:
-            logger.info('APNs set max_concurrent_streams to %s', max_concurrent_streams)
-            self.__max_concurrent_streams = max_concurrent_streams
+        self.__previous_server_max_concurrent_streams[index] = max_concurrent_streams
+        self.__max_concurrent_streams[index] = _clamp_max_concurrent_streams(max_concurrent_streams)
+        if self.__observer is not None:
+            self.__observer.max_concurrent_streams_changed(self.__max_concurrent_streams[index])
 
     def connect(self) -> None:
         """
-        Establish a connection to APNs. If already connected, the function does nothing. If the
-        connection fails, the function retries up to MAX_CONNECTION_RETRIES times.
+        Establish every connection of the pool to APNs. Connections that are already established
+        are left untouched. If a connection fails, the function retries up to
+        MAX_CONNECTION_RETRIES times.
         """
+        for connection in self._connections:
+            self._connect(connection)
+
+    def _connect(self, connection: HTTP20Connection, reconnect: bool = False) -> None:
+        # connect() does nothing if the connection is already established, don't report that
+        # pylint: disable=protected-access
+        was_connected = connection._sock is not None
         retries = 0
         while retries < MAX_CONNECTION_RETRIES:
             # noinspection PyBroadException
             try:
-                self._connection.connect()
+                connection.connect()
                 logger.info('Connected to APNs')
+                if self.__observer is not None and not was_connected:
+                    self.__observer.connected(reconnect)
                 return
             except Exception:  # pylint: disable=broad-except
                 # close the connnection, otherwise next connect() call would do nothing
-                self._connection.close()
+                connection.close()
                 retries += 1
                 logger.exception('Failed connecting to APNs (attempt %s of %s)', retries, MAX_CONNECTION_RETRIES)
 
@@ -0,0 +1,91 @@
+import time
+from typing import FrozenSet, Iterable, Optional
+
+# Failure reasons meaning that APNs is overloaded. TooManyRequests is about a single device token,
+# and Shutdown about a single connection, so they don't count.
+CONGESTION_REASONS = frozenset([
+    'InternalServerError',
+    'ServiceUnavailable',
+])
+
+DEFAULT_INITIAL_WINDOW = 50
+DEFAULT_MAXIMUM_WINDOW = 1000
+
+
+class AdaptiveConcurrency(object):
+    """
+    Adapts the number of requests a batch keeps in flight to how APNs copes with them, so that
+    brownouts aren't made worse by filling every stream the server allows.
+
+    The window grows by one stream for every window's worth of responses (additive increase), and
+    is multiplied by `backoff` (multiplicative decrease) when a response fails with one of
+    `reasons`, a stream is reset, or the smoothed response time exceeds both `latency_tolerance`
+    times the fastest response seen and `latency_threshold` seconds. Responses to requests sent
+    before the last decrease don't count, so one bad spell only shrinks the window once.
+
+    The window never goes below `minimum`, nor above the max_concurrent_streams of the server. Its
+    current value is `limit`, and observers are told about its changes. Use one per client.
+    """
+
+    def __init__(self, initial: int = DEFAULT_INITIAL_WINDOW, minimum: int = 1,
+                 maximum: int = DEFAULT_MAXIMUM_WINDOW, backoff: float = 0.5, latency_tolerance: float = 2.0,
+                 latency_threshold: float = 0.1, smoothing: float = 0.1,
+                 reasons: Optional[Iterable[str]] = None) -> None:
+        if not 1 <= minimum <= initial <= maximum:
+            raise ValueError('The windows must satisfy 1 <= minimum <= initial <= maximum')
+        if not 0 < backoff < 1:
+            raise ValueError('backoff must be between 0 and 1')
+        if not 0 < smoothing <= 1:
+            raise ValueError('smoothing must be between 0 and 1')
+
+        self.window = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        # The maximum asked for, the server's max_concurrent_streams only ever lowers it
+        self.__user_maximum = maximum
+        self.backoff = backoff
+        self.latency_tolerance = latency_tolerance
+        self.latency_threshold = latency_threshold
+        self.smoothing = smoothing
+        self.reasons = CONGESTION_REASONS if reasons is None else frozenset(reasons)  # type: FrozenSet[str]
+        # Exponential moving average and minimum of the response times, in seconds
+        self.latency = None  # type: Optional[float]
+        self.min_latency = None  # type: Optional[float]
+        self.__decreased_at = float('-inf')
+
+    @property
+    def limit(self) -> int:
+        """Number of requests that may be in flight now"""
+        return max(self.minimum, min(int(self.window), self.maximum))
+
+    def set_maximum(self, maximum: int) -> None:
+        """Cap the window, with the max_concurrent_streams allowed by the server"""
+        self.maximum = max(self.minimum, min(self.__user_maximum, maximum))
+
+    def response_received(self, reason: str, sent_at: float, now: Optional[float] = None) -> None:
+        """Adapt the window to the response of a request sent at `sent_at`, a time.monotonic() value"""
+        if now is None:
+            now = time.monotonic()
+        elapsed = now - sent_at
+        if self.latency is None or self.min_latency is None:
+            self.latency = self.min_latency = elapsed
+        else:
+            self.latency += self.smoothing * (elapsed - self.latency)
+            self.min_latency = min(self.min_latency, elapsed)
+
+        if sent_at <= self.__decreased_at:
+            return
+        if reason in self.reasons or self.latency > max(self.latency_tolerance * self.min_latency,
+                                                        self.latency_threshold):
+            self.__decrease(now)
+        elif self.window < self.maximum:
+            self.window = min(self.maximum, self.window + 1 / self.window)
+
+    def stream_lost(self, sent_at: float, now: Optional[float] = None) -> None:
+        """Adapt the window to a request sent at `sent_at` whose stream was reset"""
+        if sent_at > self.__decreased_at:
+            self.__decrease(time.monotonic() if now is None else now)
+
+    def __decrease(self, now: float) -> None:
+        self.window = max(float(self.minimum), min(self.window, self.maximum) * self.backoff)
+        self.__decreased_at = now
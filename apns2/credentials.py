@@ -1,16 +1,31 @@
+import logging
 import time
-from typing import Optional, Tuple, TYPE_CHECKING
+import weakref
+from threading import Thread
+from typing import Any, Dict, List, Optional, Tuple, TYPE_CHECKING
 
 import jwt
 
 from hyper import HTTP20Connection  # type: ignore
 from hyper.tls import init_context  # type: ignore
 
+from .async_connection import AsyncHTTP20Connection
+from .observer import Observer
+from .token_store import TokenStore, get_default_token_store
+
 if TYPE_CHECKING:
     from hyper.ssl_compat import SSLContext  # type: ignore
 
 DEFAULT_TOKEN_LIFETIME = 2700
 DEFAULT_TOKEN_ENCRYPTION_ALGORITHM = 'ES256'
+# With background refresh, tokens are replaced this many seconds before they expire
+DEFAULT_REFRESH_MARGIN = 300
+MIN_REFRESH_INTERVAL = 1.0
+# Shared tokens may be replaced early by another process, look at the store at least this often
+MAX_REFRESH_INTERVAL = 60.0
+CLOCK_SKEW_TOLERANCE = 60
+
+logger = logging.getLogger(__name__)
 
 
 # Abstract Base class. This should not be instantiated directly.
@@ -18,6 +33,18 @@ class Credentials(object):
     def __init__(self, ssl_context: 'Optional[SSLContext]' = None) -> None:
         super().__init__()
         self.__ssl_context = ssl_context
+        self._observers = []  # type: List[Observer]
+
+    # Registers an observer notified of provider token refreshes. Clients register their own observer.
+    def add_observer(self, observer: Observer) -> None:
+        if observer not in self._observers:
+            self._observers.append(observer)
+
+    # Observers belong to the process that registered them, they are not pickled along.
+    def __getstate__(self) -> Dict[str, Any]:
+        state = self.__dict__.copy()
+        state['_observers'] = []
+        return state
 
     # Creates a connection with the credentials, if available or necessary.
     def create_connection(self, server: str, port: int, proto: Optional[str], proxy_host: Optional[str] = None,
@@ -26,6 +53,10 @@ class Credentials(object):
         return HTTP20Connection(server, port, ssl_context=self.__ssl_context, force_proto=proto or 'h2',
                                 secure=True, proxy_host=proxy_host, proxy_port=proxy_port)
 
+    # Creates an asyncio connection with the credentials, used by AsyncAPNsClient.
+    def create_async_connection(self, server: str, port: int) -> AsyncHTTP20Connection:
+        return AsyncHTTP20Connection(server, port, ssl_context=self.__ssl_context, secure=True)
+
     def get_authorization_header(self, topic: Optional[str]) -> Optional[str]:
         return None
 
@@ -34,34 +65,58 @@ class Credentials(object):
 class CertificateCredentials(Credentials):
     def __init__(self, cert_file: Optional[str] = None, password: Optional[str] = None,
                  cert_chain: Optional[str] = None) -> None:
+        self.__args = (cert_file, password, cert_chain)
         ssl_context = init_context(cert=cert_file, cert_password=password)
         if cert_chain:
             ssl_context.load_cert_chain(cert_chain)
         super(CertificateCredentials, self).__init__(ssl_context)
 
+    # SSL contexts can't be pickled, so other processes load the certificate again.
+    def __reduce__(self) -> Tuple[Any, ...]:
+        return CertificateCredentials, self.__args
+
 
 # Credentials subclass for JWT token based authentication
 class TokenCredentials(Credentials):
     def __init__(self, auth_key_path: str, auth_key_id: str, team_id: str,
                  encryption_algorithm: str = DEFAULT_TOKEN_ENCRYPTION_ALGORITHM,
-                 token_lifetime: int = DEFAULT_TOKEN_LIFETIME) -> None:
+                 token_lifetime: int = DEFAULT_TOKEN_LIFETIME, token_store: Optional[TokenStore] = None,
+                 background_refresh: bool = False) -> None:
+        self.__args = (auth_key_path, auth_key_id, team_id, encryption_algorithm, token_lifetime, token_store,
+                       background_refresh)
         self.__auth_key = self._get_signing_key(auth_key_path)
         self.__auth_key_id = auth_key_id
         self.__team_id = team_id
         self.__encryption_algorithm = encryption_algorithm
         self.__token_lifetime = token_lifetime
 
-        self.__jwt_token = None  # type: Optional[Tuple[float, str]]
+        # Tokens are shared with every other credentials for the same key
+        self.__token_store = token_store or get_default_token_store()
+        self.__token_store_key = '%s.%s' % (team_id, auth_key_id)
+        self.__issued_at = 0.0
+        self.__authorization_header = None  # type: Optional[str]
+        self.__background_refresh = background_refresh
 
         # Use the default constructor because we don't have an SSL context
         super(TokenCredentials, self).__init__()
 
+        if background_refresh:
+            self._start_refresh_thread()
+
+    # Other processes read the key again and create their own provider tokens.
+    def __reduce__(self) -> Tuple[Any, ...]:
+        return TokenCredentials, self.__args
+
     def get_authorization_header(self, topic: Optional[str]) -> str:
-        token = self._get_or_create_topic_token()
-        return 'bearer %s' % token
+        header = self.__authorization_header
+        if header is not None and (self.__background_refresh or not self._is_expired_token(self.__issued_at)):
+            return header
+        return 'bearer %s' % self._get_or_create_topic_token()
 
-    def _is_expired_token(self, issue_date: float) -> bool:
-        return time.time() > issue_date + self.__token_lifetime
+    def _is_expired_token(self, issue_date: float, margin: float = 0) -> bool:
+        now = time.time()
+        # A token from the future comes from a clock that went backwards, don't trust it
+        return now > issue_date + self.__token_lifetime - margin or issue_date > now + CLOCK_SKEW_TOLERANCE
 
     @staticmethod
     def _get_signing_key(key_path: str) -> str:
@@ -71,27 +126,72 @@ class TokenCredentials(Credentials):
                 secret = f.read()
         return secret
 
-    def _get_or_create_topic_token(self) -> str:
-        # dict of topic to issue date and JWT token
-        token_pair = self.__jwt_token
-        if token_pair is None or self._is_expired_token(token_pair[0]):
-            # Create a new token
-            issued_at = time.time()
-            token_dict = {
-                'iss': self.__team_id,
-                'iat': issued_at,
-            }
-            headers = {
-                'alg': self.__encryption_algorithm,
-                'kid': self.__auth_key_id,
-            }
-            jwt_token = jwt.encode(token_dict, self.__auth_key,
-                                   algorithm=self.__encryption_algorithm,
-                                   headers=headers)
-
-            # Cache JWT token for later use. One JWT token per connection.
-            # https://developer.apple.com/documentation/usernotifications/setting_up_a_remote_notification_server/establishing_a_token-based_connection_to_apns
-            self.__jwt_token = (issued_at, jwt_token)
-            return jwt_token
-        else:
-            return token_pair[1]
+    def _get_or_create_topic_token(self, margin: float = 0) -> str:
+        """
+        Return the shared token, signing a new one if it expires in less than `margin` seconds. Only
+        one of the clients sharing the token store signs it, the others pick it up.
+        """
+        token_pair = self.__token_store.get(self.__token_store_key)
+        if token_pair is None or self._is_expired_token(token_pair[0], margin):
+            with self.__token_store.lock(self.__token_store_key):
+                # Another client may have refreshed it while we waited for the lock
+                token_pair = self.__token_store.get(self.__token_store_key)
+                if token_pair is None or self._is_expired_token(token_pair[0], margin):
+                    token_pair = self._create_token()
+                    self.__token_store.set(self.__token_store_key, *token_pair)
+                    for observer in self._observers:
+                        observer.token_refreshed()
+
+        # Cache JWT token for later use. One JWT token per connection.
+        # https://developer.apple.com/documentation/usernotifications/setting_up_a_remote_notification_server/establishing_a_token-based_connection_to_apns
+        self.__issued_at = token_pair[0]
+        self.__authorization_header = 'bearer %s' % token_pair[1]
+        return token_pair[1]
+
+    def _create_token(self) -> Tuple[float, str]:
+        issued_at = time.time()
+        token_dict = {
+            'iss': self.__team_id,
+            'iat': issued_at,
+        }
+        headers = {
+            'alg': self.__encryption_algorithm,
+            'kid': self.__auth_key_id,
+        }
+        jwt_token = jwt.encode(token_dict, self.__auth_key,
+                               algorithm=self.__encryption_algorithm,
+                               headers=headers)
+        return issued_at, jwt_token
+
+    def _refresh_margin(self) -> float:
+        return min(DEFAULT_REFRESH_MARGIN, self.__token_lifetime / 2)
+
+    def _start_refresh_thread(self) -> None:
+        """
+        Keep the token fresh from a background thread, so that get_authorization_header() is a plain
+        read. The token is replaced _refresh_margin() seconds before it expires.
+        """
+        self._get_or_create_topic_token()
+        credentials_ref = weakref.ref(self)
+
+        def refresh() -> None:
+            while True:
+                credentials = credentials_ref()
+                if credentials is None:
+                    return
+                margin = credentials._refresh_margin()
+                delay = credentials.__issued_at + credentials.__token_lifetime - margin - time.time()
+                del credentials
+
+                time.sleep(min(max(delay, MIN_REFRESH_INTERVAL), MAX_REFRESH_INTERVAL))
+                credentials = credentials_ref()
+                if credentials is None:
+                    return
+                try:
+                    credentials._get_or_create_topic_token(margin)
+                except Exception:  # pylint: disable=broad-except
+                    logger.exception('Failed refreshing the APNs provider token')
+                del credentials
+
+        thread = Thread(target=refresh, name='TokenCredentials refresh', daemon=True)
+        thread.start()
@@ -0,0 +1,178 @@
+import logging
+import queue
+import socket
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Dict, Iterator, Optional, Tuple, Union
+
+from .client import (APNsClient, AnyNotification, Notification, NotificationPriority, NotificationType,
+                     RoutedNotification)
+from .errors import PayloadTooLarge
+
+DEFAULT_MAX_QUEUE_SIZE = 10000
+# Seconds to wait before sending again after the connection to APNs failed
+FAILURE_DELAY = 1.0
+
+logger = logging.getLogger(__name__)
+
+_Result = Union[str, Tuple[str, str]]
+
+
+class APNsDispatcher(object):
+    """
+    Long-lived sender around an APNsClient, for applications pushing notifications one at a time
+    from many threads, such as web servers.
+
+    submit() queues a notification and returns a Future of its result: 'Success', the failure
+    reason, or ('Unregistered', timestamp). A background thread sends queued notifications as a
+    never-ending batch, keeping as many streams in flight as APNs allows, so no caller holds a
+    stream or waits for anyone else's response. The queue is bounded: when it's full, submit()
+    blocks or raises queue.Full, which pushes back on producers faster than APNs.
+
+    The topic, priority, expiration, collapse ID and push type apply to every notification that
+    doesn't set its own in a RoutedNotification. The client must not be used for anything else
+    while the dispatcher runs.
+    Every submission stands alone: the duplicate policy of the client doesn't apply.
+    """
+
+    def __init__(self, client: APNsClient, topic: Optional[str] = None,
+                 priority: NotificationPriority = NotificationPriority.Immediate,
+                 expiration: Optional[int] = None, collapse_id: Optional[str] = None,
+                 push_type: Optional[NotificationType] = None, max_queue_size: int = DEFAULT_MAX_QUEUE_SIZE) -> None:
+        self.__client = client
+        self.__batch_args = (topic, priority, expiration, collapse_id, push_type)
+        self.__queue = queue.Queue(max_queue_size)  # type: queue.Queue[Tuple[AnyNotification, Future[_Result]]]
+        # Submitted notifications handed to the client, by identity, until their result arrives
+        self.__outstanding = {}  # type: Dict[int, Future[_Result]]
+        self.__closed = False
+        # Number of submit() calls queueing a notification. The sender thread doesn't stop until it's
+        # back to 0, and close() sets __closed under the same lock, so nothing is queued after it stops.
+        self.__submitting = 0
+        self.__lock = threading.Lock()
+        # Set by the sender thread when it's waiting for new notifications, so that submit() knows
+        # it must wake it up
+        self.__idle = False
+        self.__wakeup_reader, self.__wakeup_writer = socket.socketpair()
+        self.__wakeup_reader.setblocking(False)
+        self.__wakeup_writer.setblocking(False)
+
+        self.__thread = threading.Thread(target=self._run, name='APNsDispatcher', daemon=True)
+        self.__thread.start()
+
+    def __enter__(self) -> 'APNsDispatcher':
+        return self
+
+    def __exit__(self, *_args: Any) -> None:
+        self.close()
+
+    def submit(self, notification: AnyNotification, block: bool = True,
+               timeout: Optional[float] = None) -> 'Future[_Result]':
+        """
+        Queue a notification and return a Future of its result. If the queue is full, wait for
+        room, at most `timeout` seconds, or raise queue.Full right away if block is False.
+
+        The notification is copied and its payload encoded right away: a malformed notification
+        or unserializable payload isn't queued, and its future holds the exception.
+        """
+        future = Future()  # type: Future[_Result]
+        future.set_running_or_notify_cancel()
+        try:
+            # A copy of the notification identifies this submission, even if the caller submits
+            # the same object twice
+            if isinstance(notification, RoutedNotification):
+                notification = RoutedNotification(*notification)
+            else:
+                notification = Notification(*notification)
+            if not isinstance(notification.token, str):
+                raise TypeError('The device token must be a str, not %s' % type(notification.token).__name__)
+            # The payload keeps the encoded bytes, the client doesn't serialize it again
+            self.__client._encode(notification.payload)  # pylint: disable=protected-access
+        except PayloadTooLarge:
+            future.set_result('PayloadTooLarge')
+            return future
+        except Exception as exc:  # pylint: disable=broad-except
+            future.set_exception(exc)
+            return future
+
+        with self.__lock:
+            if self.__closed:
+                raise RuntimeError('Cannot submit to a closed dispatcher')
+            self.__submitting += 1
+
+        try:
+            self.__queue.put((notification, future), block, timeout)
+        finally:
+            with self.__lock:
+                self.__submitting -= 1
+        # Once closed, the sender thread may be waiting for this call to finish before stopping
+        if self.__idle or self.__closed:
+            self.__wake()
+        return future
+
+    def close(self, wait: bool = True) -> None:
+        """
+        Stop accepting notifications. Those already queued are still sent, and if wait is True,
+        the call returns once all their results are in.
+        """
+        with self.__lock:
+            self.__closed = True
+        self.__wake()
+        if wait:
+            self.__thread.join()
+
+    def __wake(self) -> None:
+        try:
+            self.__wakeup_writer.send(b'\0')
+        except BlockingIOError:
+            # The socket buffer is full of wakeups already
+            pass
+
+    def _notifications(self) -> Iterator[Optional[AnyNotification]]:
+        """
+        The queued notifications, as an endless batch for the client. It yields None whenever the
+        queue is empty, and ends once the dispatcher is closed and the queue drained.
+        """
+        while True:
+            try:
+                notification, future = self.__queue.get_nowait()
+            except queue.Empty:
+                self.__idle = True
+                # A notification may have been queued before submit() saw the idle flag
+                try:
+                    notification, future = self.__queue.get_nowait()
+                except queue.Empty:
+                    with self.__lock:
+                        if self.__closed and not self.__submitting and self.__queue.empty():
+                            return
+                    yield None
+                    continue
+                finally:
+                    self.__idle = False
+
+            self.__outstanding[id(notification)] = future
+            yield notification
+
+    def __fail(self, notification: AnyNotification, exc: Exception) -> None:
+        # Only this notification couldn't be sent, the others go on
+        self.__outstanding.pop(id(notification)).set_exception(exc)
+
+    def _run(self) -> None:
+        while not (self.__closed and self.__queue.empty()):
+            try:
+                for notification, result in self.__client._iter_results(  # pylint: disable=protected-access
+                        self._notifications(), *self.__batch_args, wakeup=self.__wakeup_reader, deduplicate=False,
+                        on_error=self.__fail):
+                    future = self.__outstanding.pop(id(notification))
+                    future.set_result(result)
+            except Exception as exc:  # pylint: disable=broad-except
+                logger.exception('Failed sending notifications to APNs')
+                # The connection failed and every notification handed to the client is lost, fail
+                # them and carry on with the next ones
+                outstanding, self.__outstanding = self.__outstanding, {}
+                for future in outstanding.values():
+                    future.set_exception(exc)
+                time.sleep(FAILURE_DELAY)
+
+        self.__wakeup_reader.close()
+        self.__wakeup_writer.close()
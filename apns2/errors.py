@@ -1,4 +1,4 @@
-from typing import Type, Optional
+from typing import Dict, Type, Optional
 
 
 class APNsException(Exception):
@@ -167,34 +167,41 @@ class Shutdown(APNsException):
     pass
 
 
+# Exception class of every failure reason APNs reports, built once instead of on every lookup
+_EXCEPTION_CLASSES = {
+    'BadCollapseId': BadCollapseId,
+    'BadDeviceToken': BadDeviceToken,
+    'BadExpirationDate': BadExpirationDate,
+    'BadMessageId': BadMessageId,
+    'BadPriority': BadPriority,
+    'BadTopic': BadTopic,
+    'DeviceTokenNotForTopic': DeviceTokenNotForTopic,
+    'DuplicateHeaders': DuplicateHeaders,
+    'IdleTimeout': IdleTimeout,
+    'MissingDeviceToken': MissingDeviceToken,
+    'MissingTopic': MissingTopic,
+    'PayloadEmpty': PayloadEmpty,
+    'TopicDisallowed': TopicDisallowed,
+    'BadCertificate': BadCertificate,
+    'BadCertificateEnvironment': BadCertificateEnvironment,
+    'ExpiredProviderToken': ExpiredProviderToken,
+    'Forbidden': Forbidden,
+    'InvalidProviderToken': InvalidProviderToken,
+    'MissingProviderToken': MissingProviderToken,
+    'BadPath': BadPath,
+    'MethodNotAllowed': MethodNotAllowed,
+    'Unregistered': Unregistered,
+    'PayloadTooLarge': PayloadTooLarge,
+    'TooManyProviderTokenUpdates': TooManyProviderTokenUpdates,
+    'TooManyRequests': TooManyRequests,
+    'InternalServerError': InternalServerError,
+    'ServiceUnavailable': ServiceUnavailable,
+    'Shutdown': Shutdown,
+}  # type: Dict[str, Type[APNsException]]
+
+# Every failure reason known to this library
+FAILURE_REASONS = tuple(_EXCEPTION_CLASSES)
+
+
 def exception_class_for_reason(reason: str) -> Type[APNsException]:
-    return {
-        'BadCollapseId': BadCollapseId,
-        'BadDeviceToken': BadDeviceToken,
-        'BadExpirationDate': BadExpirationDate,
-        'BadMessageId': BadMessageId,
-        'BadPriority': BadPriority,
-        'BadTopic': BadTopic,
-        'DeviceTokenNotForTopic': DeviceTokenNotForTopic,
-        'DuplicateHeaders': DuplicateHeaders,
-        'IdleTimeout': IdleTimeout,
-        'MissingDeviceToken': MissingDeviceToken,
-        'MissingTopic': MissingTopic,
-        'PayloadEmpty': PayloadEmpty,
-        'TopicDisallowed': TopicDisallowed,
-        'BadCertificate': BadCertificate,
-        'BadCertificateEnvironment': BadCertificateEnvironment,
-        'ExpiredProviderToken': ExpiredProviderToken,
-        'Forbidden': Forbidden,
-        'InvalidProviderToken': InvalidProviderToken,
-        'MissingProviderToken': MissingProviderToken,
-        'BadPath': BadPath,
-        'MethodNotAllowed': MethodNotAllowed,
-        'Unregistered': Unregistered,
-        'PayloadTooLarge': PayloadTooLarge,
-        'TooManyProviderTokenUpdates': TooManyProviderTokenUpdates,
-        'TooManyRequests': TooManyRequests,
-        'InternalServerError': InternalServerError,
-        'ServiceUnavailable': ServiceUnavailable,
-        'Shutdown': Shutdown,
-    }[reason]
+    return _EXCEPTION_CLASSES[reason]
@@ -0,0 +1,152 @@
+import bisect
+import threading
+from typing import Dict, List, Sequence, Tuple
+
+# Upper bounds in seconds of the response time histogram buckets
+DEFAULT_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Observer(object):
+    """
+    Receives the lifecycle events of an APNsClient, for metrics or tracing. Subclass it and
+    override the methods you need, the default implementations do nothing.
+
+    The methods are called synchronously from the sending code, so they should be quick.
+    """
+
+    def stream_opened(self, token: str, stream_id: int) -> None:
+        """A request for the token was sent on a new stream"""
+
+    def response_received(self, token: str, status: int, reason: str, elapsed: float) -> None:
+        """
+        APNs answered the request for the token. The reason is 'Success' for status 200, and
+        elapsed is the number of seconds since the request was sent.
+        """
+
+    def stream_lost(self, token: str) -> None:
+        """
+        The request for the token got no response, because its stream was reset or its connection
+        was lost. Batches send it again.
+        """
+
+    def connected(self, reconnect: bool) -> None:
+        """A connection to APNs was established. reconnect is True if it replaces a lost or closed one."""
+
+    def max_concurrent_streams_changed(self, max_concurrent_streams: int) -> None:
+        """The server sent a new SETTINGS_MAX_CONCURRENT_STREAMS value, after clamping to sane limits"""
+
+    def concurrency_window_changed(self, window: int) -> None:
+        """The adaptive concurrency control of a batch changed the number of requests it keeps in flight"""
+
+    def token_refreshed(self) -> None:
+        """The credentials created a new JWT provider token"""
+
+
+class _Histogram(object):
+    def __init__(self, buckets: Sequence[float]) -> None:
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class MetricsObserver(Observer):
+    """
+    Observer keeping Prometheus-style counters, gauges and a response time histogram. render()
+    returns them in the Prometheus text exposition format, to be served from a /metrics endpoint.
+    One instance can be shared by several clients, even on different threads.
+    """
+
+    def __init__(self, prefix: str = 'apns', latency_buckets: Sequence[float] = DEFAULT_LATENCY_BUCKETS) -> None:
+        self.prefix = prefix
+        self.streams_opened = 0
+        self.streams_lost = 0
+        self.in_flight = 0
+        # (status, reason) to number of responses
+        self.responses = {}  # type: Dict[Tuple[int, str], int]
+        self.latency = _Histogram(latency_buckets)
+        self.connects = 0
+        self.reconnects = 0
+        self.max_concurrent_streams = 0
+        self.concurrency_window = 0
+        self.token_refreshes = 0
+        self.__lock = threading.Lock()
+
+    def stream_opened(self, token: str, stream_id: int) -> None:
+        with self.__lock:
+            self.streams_opened += 1
+            self.in_flight += 1
+
+    def response_received(self, token: str, status: int, reason: str, elapsed: float) -> None:
+        with self.__lock:
+            self.in_flight -= 1
+            key = (status, reason)
+            self.responses[key] = self.responses.get(key, 0) + 1
+            self.latency.observe(elapsed)
+
+    def stream_lost(self, token: str) -> None:
+        with self.__lock:
+            self.in_flight -= 1
+            self.streams_lost += 1
+
+    def connected(self, reconnect: bool) -> None:
+        with self.__lock:
+            if reconnect:
+                self.reconnects += 1
+            else:
+                self.connects += 1
+
+    def max_concurrent_streams_changed(self, max_concurrent_streams: int) -> None:
+        self.max_concurrent_streams = max_concurrent_streams
+
+    def concurrency_window_changed(self, window: int) -> None:
+        self.concurrency_window = window
+
+    def token_refreshed(self) -> None:
+        with self.__lock:
+            self.token_refreshes += 1
+
+    def render(self) -> str:
+        """Current values in the Prometheus text exposition format"""
+        with self.__lock:
+            lines = []  # type: List[str]
+            self._metric(lines, 'streams_opened_total', 'counter', 'Requests sent to APNs', self.streams_opened)
+            self._metric(lines, 'streams_lost_total', 'counter', 'Requests that got no response', self.streams_lost)
+            self._metric(lines, 'streams_in_flight', 'gauge', 'Requests waiting for a response', self.in_flight)
+            self._metric(lines, 'connects_total', 'counter', 'Connections established', self.connects)
+            self._metric(lines, 'reconnects_total', 'counter', 'Connections re-established', self.reconnects)
+            self._metric(lines, 'max_concurrent_streams', 'gauge', 'Last max_concurrent_streams set by APNs',
+                         self.max_concurrent_streams)
+            self._metric(lines, 'concurrency_window', 'gauge', 'Requests kept in flight by adaptive concurrency',
+                         self.concurrency_window)
+            self._metric(lines, 'token_refreshes_total', 'counter', 'JWT provider tokens created',
+                         self.token_refreshes)
+
+            name = '%s_responses_total' % self.prefix
+            lines.append('# HELP %s Responses from APNs by status and reason' % name)
+            lines.append('# TYPE %s counter' % name)
+            for (status, reason), count in sorted(self.responses.items()):
+                lines.append('%s{status="%d",reason="%s"} %d' % (name, status, reason, count))
+
+            name = '%s_response_seconds' % self.prefix
+            lines.append('# HELP %s Time from sending a request to its response' % name)
+            lines.append('# TYPE %s histogram' % name)
+            cumulative = 0
+            for bound, count in zip(self.latency.buckets + (float('inf'),), self.latency.counts):
+                cumulative += count
+                lines.append('%s_bucket{le="%s"} %d' % (name, '+Inf' if bound == float('inf') else repr(bound),
+                                                        cumulative))
+            lines.append('%s_sum %r' % (name, self.latency.sum))
+            lines.append('%s_count %d' % (name, self.latency.count))
+        return '\n'.join(lines) + '\n'
+
+    def _metric(self, lines: List[str], name: str, metric_type: str, description: str, value: int) -> None:
+        name = '%s_%s' % (self.prefix, name)
+        lines.append('# HELP %s %s' % (name, description))
+        lines.append('# TYPE %s %s' % (name, metric_type))
+        lines.append('%s %d' % (name, value))
@@ -1,9 +1,33 @@
-from typing import Any, Dict, List, Optional, Union, Iterable
+import operator
+from typing import Any, Dict, List, Optional, Tuple, Union, Iterable
+
+from .serializer import JSONSerializer, get_default_serializer
 
 MAX_PAYLOAD_SIZE = 4096
 
+_ALERT_FIELDS = ('title', 'title_localized_key', 'title_localized_args', 'subtitle', 'subtitle_localized_key',
+                 'subtitle_localized_args', 'body', 'body_localized_key', 'body_localized_args',
+                 'action_localized_key', 'action', 'launch_image')
+_PAYLOAD_FIELDS = ('alert', 'badge', 'sound', 'content_available', 'category', 'url_args', 'custom',
+                   'mutable_content', 'thread_id')
+# Snapshots of the attribute values, to tell whether a memoized dict() is still valid
+_alert_values = operator.attrgetter(*_ALERT_FIELDS)
+_payload_values = operator.attrgetter(*_PAYLOAD_FIELDS)
+
+
+def _same_values(values: Tuple[Any, ...], cached_values: Tuple[Any, ...]) -> bool:
+    # By identity: equal values of another type, such as True for 1, aren't serialized the same
+    return all(value is cached for value, cached in zip(values, cached_values))
+
 
 class PayloadAlert(object):
+    """
+    The alert of a Payload. dict() is computed once and memoized until an attribute is assigned
+    another object. Lists given as arguments are used as they are, modifying them in place
+    isn't noticed.
+    """
+    __slots__ = _ALERT_FIELDS + ('__dict_cache',)
+
     def __init__(
             self,
             title: Optional[str] = None,
@@ -31,8 +55,16 @@ class PayloadAlert(object):
         self.action_localized_key = action_localized_key
         self.action = action
         self.launch_image = launch_image
+        # Attribute values and the dict() built from them
+        self.__dict_cache = None  # type: Optional[Tuple[Tuple[Any, ...], Dict[str, Any]]]
 
     def dict(self) -> Dict[str, Any]:
+        """The alert dictionary. It's shared between calls, so it must not be modified."""
+        values = _alert_values(self)
+        cached = self.__dict_cache
+        if cached is not None and _same_values(values, cached[0]):
+            return cached[1]
+
         result = {}  # type: Dict[str, Any]
 
         if self.title:
@@ -64,10 +96,19 @@ class PayloadAlert(object):
         if self.launch_image:
             result['launch-image'] = self.launch_image
 
+        self.__dict_cache = (values, result)
         return result
 
 
 class Payload(object):
+    """
+    A notification payload. dict() and encode() are computed once and memoized until an attribute
+    is assigned another object, so a payload sent many times is serialized once. The custom
+    dictionary and the lists given as arguments are used as they are, modifying them in place
+    isn't noticed.
+    """
+    __slots__ = _PAYLOAD_FIELDS + ('__dict_cache', '__json_cache')
+
     def __init__(
             self,
             alert: Union[PayloadAlert, str, None] = None,
@@ -89,17 +130,29 @@ class Payload(object):
         self.custom = custom
         self.mutable_content = mutable_content
         self.thread_id = thread_id
+        # Attribute values and the dict() built from them
+        self.__dict_cache = None  # type: Optional[Tuple[Tuple[Any, ...], Dict[str, Any]]]
+        # dict() result and serializer the JSON was encoded with, and the JSON
+        self.__json_cache = None  # type: Optional[Tuple[Dict[str, Any], JSONSerializer, bytes]]
 
     def dict(self) -> Dict[str, Any]:
+        """The payload dictionary. It's shared between calls, so it must not be modified."""
+        alert_dict = self.alert.dict() if isinstance(self.alert, PayloadAlert) else None
+        values = _payload_values(self)
+        cached = self.__dict_cache
+        # A new alert dictionary means the alert was modified since
+        if (cached is not None and _same_values(values, cached[0])
+                and (alert_dict is None or cached[1]['aps']['alert'] is alert_dict)):
+            return cached[1]
+
         result = {
             'aps': {}
         }  # type: Dict[str, Any]
 
-        if self.alert is not None:
-            if isinstance(self.alert, PayloadAlert):
-                result['aps']['alert'] = self.alert.dict()
-            else:
-                result['aps']['alert'] = self.alert
+        if alert_dict is not None:
+            result['aps']['alert'] = alert_dict
+        elif self.alert is not None:
+            result['aps']['alert'] = self.alert
         if self.badge is not None:
             result['aps']['badge'] = self.badge
         if self.sound is not None:
@@ -117,4 +170,18 @@ class Payload(object):
         if self.custom is not None:
             result.update(self.custom)
 
+        self.__dict_cache = (values, result)
         return result
+
+    def encode(self, serializer: Optional[JSONSerializer] = None) -> bytes:
+        """The payload as compact UTF-8 JSON, the way it's sent to APNs"""
+        if serializer is None:
+            serializer = get_default_serializer()
+        payload_dict = self.dict()
+        cached = self.__json_cache
+        if cached is not None and cached[0] is payload_dict and cached[1] is serializer:
+            return cached[2]
+
+        json_payload = serializer.dumps(payload_dict)
+        self.__json_cache = (payload_dict, serializer, json_payload)
+        return json_payload
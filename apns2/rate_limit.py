@@ -0,0 +1,150 @@
+import collections
+import heapq
+import itertools
+import threading
+import time
+import typing
+from enum import Enum
+from typing import Any, List, Optional, Tuple
+
+# Results of the notifications held back by a TokenRateLimiter, they're not sent
+RATE_LIMITED = 'RateLimited'
+COALESCED = 'Coalesced'
+
+DEFAULT_MAX_TOKENS = 100000
+DEFAULT_MAX_WAITING = 10000
+
+
+class RateLimitPolicy(Enum):
+    # Send excess notifications once the token has a free slot again
+    Delay = 'delay'
+    # Like Delay, but only the latest waiting notification of a token is sent, older ones get the
+    # Coalesced result
+    Coalesce = 'coalesce'
+    # Don't send excess notifications, they get the RateLimited result
+    Drop = 'drop'
+
+
+class TokenRateLimiter(object):
+    """
+    Limits how often notifications are sent to each device token, so that chatty producers don't
+    waste streams on TooManyRequests failures. Each token gets a bucket of `burst` notifications,
+    refilled at `rate` notifications per second, and `policy` decides what happens to the
+    notifications exceeding it.
+
+    Only the buckets of the last `max_tokens` tokens used are kept, a token evicted before its bucket
+    refilled gets a full one again. At most `max_waiting` notifications of a batch wait for their
+    token at a time, the client stops taking notifications from the batch while that many do.
+    """
+
+    def __init__(self, rate: float, burst: int = 1, policy: RateLimitPolicy = RateLimitPolicy.Delay,
+                 max_tokens: int = DEFAULT_MAX_TOKENS, max_waiting: int = DEFAULT_MAX_WAITING) -> None:
+        if rate <= 0:
+            raise ValueError('rate must be positive')
+        if burst < 1:
+            raise ValueError('burst must be at least 1')
+        if max_tokens < 1:
+            raise ValueError('max_tokens must be at least 1')
+        if max_waiting < 1:
+            raise ValueError('max_waiting must be at least 1')
+
+        self.rate = rate
+        self.burst = burst
+        self.policy = policy
+        self.max_tokens = max_tokens
+        self.max_waiting = max_waiting
+        self.__interval = 1.0 / rate
+        self.__tolerance = (burst - 1) * self.__interval
+        # Time at which the bucket of each token will be full again, least recently used first
+        self.__full_at = collections.OrderedDict()  # type: typing.OrderedDict[str, float]
+        self.__lock = threading.Lock()
+
+    # Locks can't be pickled, another process gets empty buckets
+    def __reduce__(self) -> Tuple[Any, ...]:
+        return TokenRateLimiter, (self.rate, self.burst, self.policy, self.max_tokens, self.max_waiting)
+
+    def check(self, token: str, now: Optional[float] = None) -> float:
+        """
+        Take a notification from the bucket of the token and return 0 if it has one, otherwise
+        return the number of seconds until it does.
+        """
+        return self.__take(token, now, False)
+
+    def reserve(self, token: str, now: Optional[float] = None) -> float:
+        """Take the next notification from the bucket of the token, returning the number of seconds to wait for it"""
+        return self.__take(token, now, True)
+
+    def __take(self, token: str, now: Optional[float], reserve: bool) -> float:
+        if now is None:
+            now = time.monotonic()
+        with self.__lock:
+            full_at = max(self.__full_at.pop(token, now), now)
+            wait = max(0.0, full_at - self.__tolerance - now)
+            if wait == 0 or reserve:
+                full_at += self.__interval
+            self.__full_at[token] = full_at
+            if len(self.__full_at) > self.max_tokens:
+                self.__full_at.popitem(last=False)
+        return wait
+
+
+class _RateLimitQueue(object):
+    """The notifications of a batch waiting for their token's rate limit, in the order they're due"""
+
+    def __init__(self, limiter: TokenRateLimiter) -> None:
+        self.__limiter = limiter
+        self.__coalesce = limiter.policy is RateLimitPolicy.Coalesce
+        # [due time, sequence number, notification]
+        self.__heap = []  # type: List[List[Any]]
+        self.__sequence = itertools.count()
+        # Entry of the notification waiting for each token, when coalescing
+        self.__waiting = {}  # type: typing.Dict[str, List[Any]]
+
+    def __len__(self) -> int:
+        return len(self.__heap)
+
+    def is_full(self) -> bool:
+        """Whether no more notifications should be admitted until a waiting one is due"""
+        return len(self.__heap) >= self.__limiter.max_waiting
+
+    def admit(self, notification: Any) -> Tuple[bool, Optional[Tuple[Any, str]]]:
+        """
+        Whether the notification can be sent right now, and a notification that won't be sent with
+        its result, if any. Notifications that can't be sent now are either kept until they're due
+        or returned with the RateLimited result.
+        """
+        token = notification.token  # type: str
+        if self.__limiter.policy is RateLimitPolicy.Drop:
+            if self.__limiter.check(token):
+                return False, (notification, RATE_LIMITED)
+            return True, None
+
+        if self.__coalesce:
+            entry = self.__waiting.get(token)
+            if entry is not None:
+                superseded, entry[2] = entry[2], notification
+                return False, (superseded, COALESCED)
+
+        wait = self.__limiter.reserve(token)
+        if not wait:
+            return True, None
+        entry = [time.monotonic() + wait, next(self.__sequence), notification]
+        heapq.heappush(self.__heap, entry)
+        if self.__coalesce:
+            self.__waiting[token] = entry
+        return False, None
+
+    def next_due(self) -> float:
+        """Time at which the first waiting notification is due"""
+        due = self.__heap[0][0]  # type: float
+        return due
+
+    def is_due(self) -> bool:
+        return bool(self.__heap) and self.__heap[0][0] <= time.monotonic()
+
+    def pop(self) -> Any:
+        """The first waiting notification"""
+        notification = heapq.heappop(self.__heap)[2]
+        if self.__coalesce:
+            del self.__waiting[notification.token]
+        return notification
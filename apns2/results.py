@@ -0,0 +1,142 @@
+import array
+import re
+from typing import Dict, Iterable, Iterator, List, Set, Tuple, Union
+
+from .errors import FAILURE_REASONS
+from .validation import _collect_results
+
+# 'Success', a failure reason, or a failure reason and timestamp
+Result = Union[str, Tuple[str, Union[str, int]]]
+
+# Reasons by code in BatchResults, 'Success' being 0
+REASONS = ('Success',) + FAILURE_REASONS
+_REASON_CODES = {reason: code for code, reason in enumerate(REASONS)}
+# Timestamp column value of results without a timestamp
+_NO_TIMESTAMP = -1
+_FAILURE = re.compile(b'[^\x00]')
+
+
+class BatchResults(object):
+    """
+    Compact storage for the results of a large batch, as an alternative to the dictionary returned
+    by send_notification_batch. Tokens are kept as raw bytes, reasons as one-byte codes and the
+    timestamps of Unregistered results in a column of their own, some 45 bytes per token instead of
+    several hundreds. Failures of a given reason are found without going through the successes.
+
+    Fill it from any iterable of (token, result) pairs, such as iter_notification_results():
+
+        results = BatchResults(client.iter_notification_results(notifications, topic))
+        for token, timestamp in results.unregistered():
+            ...
+    """
+
+    def __init__(self, results: Iterable[Tuple[str, Result]] = ()) -> None:
+        self.__tokens = bytearray()
+        # End offset of every token in __tokens
+        self.__token_ends = array.array('L')
+        self.__codes = bytearray()
+        self.__timestamps = array.array('q')
+        # Indexes of the tokens that aren't lowercase hex, stored as text
+        self.__text_tokens = set()  # type: Set[int]
+        # Reasons unknown to this library get their codes after the known ones
+        self.__reasons = list(REASONS)  # type: List[str]
+        self.__reason_codes = dict(_REASON_CODES)
+        self.extend(results)
+
+    def __len__(self) -> int:
+        return len(self.__codes)
+
+    def __iter__(self) -> Iterator[Tuple[str, Result]]:
+        for index in range(len(self.__codes)):
+            yield self.__token(index), self.__result(index)
+
+    def add(self, token: str, result: Result) -> None:
+        if isinstance(result, tuple):
+            reason, timestamp = result[0], int(result[1])
+        else:
+            reason, timestamp = result, _NO_TIMESTAMP
+
+        code = self.__reason_codes.get(reason)
+        if code is None:
+            code = len(self.__reasons)
+            if code > 255:
+                raise ValueError('Too many distinct reasons')
+            self.__reasons.append(reason)
+            self.__reason_codes[reason] = code
+
+        try:
+            raw_token = bytes.fromhex(token)
+        except ValueError:
+            raw_token = b''
+        if raw_token.hex() != token:
+            raw_token = token.encode('utf-8')
+            self.__text_tokens.add(len(self.__codes))
+
+        self.__tokens += raw_token
+        self.__token_ends.append(len(self.__tokens))
+        self.__codes.append(code)
+        self.__timestamps.append(timestamp)
+
+    def extend(self, results: Iterable[Tuple[str, Result]]) -> None:
+        for token, result in results:
+            self.add(token, result)
+
+    def count(self, reason: str) -> int:
+        """Number of results with the reason, 'Success' included"""
+        code = self.__reason_codes.get(reason)
+        return 0 if code is None else self.__codes.count(code)
+
+    def counts(self) -> Dict[str, int]:
+        """Number of results of every reason that occurred"""
+        counts = {}
+        for code, reason in enumerate(self.__reasons):
+            count = self.__codes.count(code)
+            if count:
+                counts[reason] = count
+        return counts
+
+    def tokens_with_reason(self, reason: str) -> Iterator[str]:
+        """Tokens whose result has the reason"""
+        for index in self.__indexes(reason):
+            yield self.__token(index)
+
+    def unregistered(self) -> Iterator[Tuple[str, int]]:
+        """Tokens that are no longer registered, with the time APNs last knew them valid, in milliseconds"""
+        for index in self.__indexes('Unregistered'):
+            yield self.__token(index), self.__timestamps[index]
+
+    def failures(self) -> Iterator[Tuple[str, Result]]:
+        """Token and result of every failure"""
+        for match in _FAILURE.finditer(self.__codes):
+            index = match.start()
+            yield self.__token(index), self.__result(index)
+
+    def to_dict(self) -> Dict[str, Result]:
+        """
+        The results as returned by send_notification_batch: a notification held back as a duplicate
+        or by the rate limiter doesn't hide the result of one sent to the same token.
+        """
+        return _collect_results(self)
+
+    def __indexes(self, reason: str) -> Iterator[int]:
+        code = self.__reason_codes.get(reason)
+        if code is None:
+            return
+        index = self.__codes.find(code)
+        while index != -1:
+            yield index
+            index = self.__codes.find(code, index + 1)
+
+    def __token(self, index: int) -> str:
+        start = self.__token_ends[index - 1] if index else 0
+        raw_token = bytes(self.__tokens[start:self.__token_ends[index]])
+        if index in self.__text_tokens:
+            return raw_token.decode('utf-8')
+        return raw_token.hex()
+
+    def __result(self, index: int) -> Result:
+        reason = self.__reasons[self.__codes[index]]
+        timestamp = self.__timestamps[index]
+        if timestamp == _NO_TIMESTAMP:
+            return reason
+        return reason, timestamp
@@ -0,0 +1,47 @@
+import random
+from typing import FrozenSet, Iterable, Optional
+
+# Failure reasons that are worth sending again: rate limiting and transient server errors
+RETRYABLE_REASONS = frozenset([
+    'TooManyRequests',
+    'InternalServerError',
+    'ServiceUnavailable',
+    'Shutdown',
+])
+
+DEFAULT_MAX_RETRIES = 3
+DEFAULT_BACKOFF = 0.5
+DEFAULT_MAX_BACKOFF = 30.0
+
+
+class RetryPolicy(object):
+    """
+    Decide which failed notifications of a batch are sent again, and when.
+
+    A notification failing with one of `reasons` is retried up to `max_retries` times. Retry n
+    waits backoff * 2^n seconds, capped at max_backoff, of which a random `jitter` fraction is
+    dropped so retries of many tokens don't hit APNs at the same time.
+    """
+
+    def __init__(self, max_retries: int = DEFAULT_MAX_RETRIES, backoff: float = DEFAULT_BACKOFF,
+                 max_backoff: float = DEFAULT_MAX_BACKOFF, jitter: float = 0.5,
+                 reasons: Optional[Iterable[str]] = None) -> None:
+        if max_retries < 0:
+            raise ValueError('max_retries must not be negative')
+        if not 0 <= jitter <= 1:
+            raise ValueError('jitter must be between 0 and 1')
+
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.reasons = RETRYABLE_REASONS if reasons is None else frozenset(reasons)  # type: FrozenSet[str]
+
+    def should_retry(self, reason: str, attempt: int) -> bool:
+        """Whether a notification that failed with `reason` on its `attempt`-th send (0-based) is retried"""
+        return reason in self.reasons and attempt < self.max_retries
+
+    def delay(self, attempt: int) -> float:
+        """Seconds to wait before sending a notification again after its `attempt`-th send failed"""
+        delay = min(self.max_backoff, self.backoff * 2.0 ** attempt)
+        return delay * (1 - self.jitter * random.random())
@@ -0,0 +1,107 @@
+import concurrent.futures
+import itertools
+import os
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Set, Tuple, Union
+
+from .client import APNsClient, AnyNotification, NotificationPriority, NotificationType
+from .credentials import Credentials
+from .validation import _collect_results
+
+# Notifications handed to a worker process at a time
+DEFAULT_CHUNK_SIZE = 2000
+
+# The client of the current worker process, created once by _init_worker
+_worker_client = None  # type: Optional[APNsClient]
+
+_Result = Tuple[str, Union[str, Tuple[str, str]]]
+
+
+def _init_worker(credentials: Union[Credentials, str], client_kwargs: Dict[str, Any]) -> None:
+    global _worker_client  # pylint: disable=global-statement
+    _worker_client = APNsClient(credentials, **client_kwargs)
+
+
+def _send_chunk(chunk: List[AnyNotification], topic: Optional[str], priority: NotificationPriority,
+                expiration: Optional[int], collapse_id: Optional[str],
+                push_type: Optional[NotificationType]) -> List[_Result]:
+    assert _worker_client is not None
+    return list(_worker_client.iter_notification_results(chunk, topic, priority, expiration, collapse_id, push_type))
+
+
+class ShardedSender(object):
+    """
+    Sends very large batches from a pool of worker processes, so that payload serialization and
+    HTTP/2 framing use every core instead of one.
+
+    Each worker owns an APNsClient, with its own connections, built from `credentials` and
+    `client_kwargs`. Credentials are pickled to the workers: CertificateCredentials and
+    TokenCredentials load their certificate or key file again there, so it must be readable by the
+    workers. Notifications are handed out in chunks of `chunk_size`, and results are streamed back
+    as each chunk completes. A duplicate_policy given to the clients only applies within a chunk,
+    and a rate_limiter to the notifications of each worker.
+    """
+
+    def __init__(self, credentials: Union[Credentials, str], processes: Optional[int] = None,
+                 chunk_size: int = DEFAULT_CHUNK_SIZE, **client_kwargs: Any) -> None:
+        if chunk_size < 1:
+            raise ValueError('chunk_size must be at least 1')
+
+        self.__credentials = credentials
+        self.__processes = processes or os.cpu_count() or 1
+        self.__chunk_size = chunk_size
+        self.__client_kwargs = client_kwargs
+        self.__executor = None  # type: Optional[concurrent.futures.ProcessPoolExecutor]
+
+    def __enter__(self) -> 'ShardedSender':
+        return self
+
+    def __exit__(self, *_args: Any) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """Stop the worker processes, closing their connections"""
+        if self.__executor is not None:
+            self.__executor.shutdown()
+            self.__executor = None
+
+    def send_notification_batch(self, notifications: Iterable[AnyNotification], topic: Optional[str] = None,
+                                priority: NotificationPriority = NotificationPriority.Immediate,
+                                expiration: Optional[int] = None, collapse_id: Optional[str] = None,
+                                push_type: Optional[NotificationType] = None) -> Dict[str, Union[str, Tuple[str, str]]]:
+        """Send a batch from the worker processes, see APNsClient.send_notification_batch"""
+        return _collect_results(self.iter_notification_results(notifications, topic, priority, expiration,
+                                                               collapse_id, push_type))
+
+    def iter_notification_results(self, notifications: Iterable[AnyNotification], topic: Optional[str] = None,
+                                  priority: NotificationPriority = NotificationPriority.Immediate,
+                                  expiration: Optional[int] = None, collapse_id: Optional[str] = None,
+                                  push_type: Optional[NotificationType] = None) -> Iterator[_Result]:
+        """
+        Yield a (token, result) pair for every notification, chunk by chunk in completion order.
+
+        The notifications iterable is consumed lazily: only two chunks per worker are read ahead,
+        so a token stream of any length can be sent with bounded memory.
+        """
+        if self.__executor is None:
+            self.__executor = concurrent.futures.ProcessPoolExecutor(
+                self.__processes, initializer=_init_worker, initargs=(self.__credentials, self.__client_kwargs))
+
+        notification_iterator = iter(notifications)
+        pending = set()  # type: Set[concurrent.futures.Future[List[_Result]]]
+        try:
+            while True:
+                while len(pending) < 2 * self.__processes:
+                    chunk = list(itertools.islice(notification_iterator, self.__chunk_size))
+                    if not chunk:
+                        break
+                    pending.add(self.__executor.submit(_send_chunk, chunk, topic, priority, expiration, collapse_id,
+                                                       push_type))
+                if not pending:
+                    return
+
+                done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    yield from future.result()
+        finally:
+            for future in pending:
+                future.cancel()
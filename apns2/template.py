@@ -0,0 +1,148 @@
+import json
+import json.encoder
+import operator
+import string
+from typing import Any, Callable, Dict, List, Optional, Tuple, cast
+
+from .errors import PayloadTooLarge
+from .payload import MAX_PAYLOAD_SIZE, Payload, _PAYLOAD_FIELDS
+from .serializer import JSONSerializer
+
+_FORMATTER = string.Formatter()
+# The json module's own string escaping, which its stubs don't declare
+_encode_basestring = cast(Callable[[str], str], getattr(json.encoder, 'encode_basestring'))
+
+
+def _encode_value(value: Any) -> str:
+    """JSON for a field standing for a whole value: a string, a number, a list of loc-args..."""
+    if isinstance(value, str):
+        return _encode_basestring(value)
+    elif type(value) is int:  # pylint: disable=unidiomatic-typecheck
+        return str(value)
+    encoded = json.dumps(value, ensure_ascii=False, separators=(',', ':'))  # type: str
+    return encoded
+
+
+def _encode_text(value: Any) -> str:
+    """JSON for a field within a longer string: its escaped text, without the quotes"""
+    return _encode_basestring(value if isinstance(value, str) else str(value))[1:-1]
+
+
+class _Compiler(object):
+    """Turns a payload dictionary into static JSON text and the fields to splice in between"""
+
+    def __init__(self) -> None:
+        # Static JSON text, with an empty string where each field goes
+        self.parts = []  # type: List[str]
+        # Index in parts, name and encoding function of every field
+        self.fields = []  # type: List[Tuple[int, str, Callable[[Any], str]]]
+
+    def static(self, text: str) -> None:
+        if self.parts and (not self.fields or self.fields[-1][0] != len(self.parts) - 1):
+            self.parts[-1] += text
+        else:
+            self.parts.append(text)
+
+    def field(self, name: str, encode: Callable[[Any], str]) -> None:
+        if not name.isidentifier():
+            raise ValueError('Template fields must be plain names, got {%s}' % name)
+        self.fields.append((len(self.parts), name, encode))
+        self.parts.append('')
+
+    def value(self, value: Any) -> None:
+        if isinstance(value, dict):
+            self.static('{')
+            for index, (key, item) in enumerate(value.items()):
+                self.static('%s%s:' % (',' if index else '', _encode_basestring(key)))
+                self.value(item)
+            self.static('}')
+        elif isinstance(value, (list, tuple)):
+            self.static('[')
+            for index, item in enumerate(value):
+                if index:
+                    self.static(',')
+                self.value(item)
+            self.static(']')
+        elif isinstance(value, str):
+            self.string(value)
+        else:
+            self.static(json.dumps(value, ensure_ascii=False))
+
+    def string(self, value: str) -> None:
+        parsed = list(_FORMATTER.parse(value))
+        for _, name, format_spec, conversion in parsed:
+            if format_spec or conversion:
+                raise ValueError('Template fields must be plain names, got %r' % value)
+
+        if len(parsed) == 1 and not parsed[0][0] and parsed[0][1] is not None:
+            self.field(parsed[0][1], _encode_value)
+            return
+
+        self.static('"')
+        for literal, name, _, _ in parsed:
+            self.static(_encode_basestring(literal)[1:-1])
+            if name is not None:
+                self.field(name, _encode_text)
+        self.static('"')
+
+
+class PayloadTemplate(object):
+    """
+    A payload with {name} fields in its strings, for campaigns where only a few values change from
+    one token to the next. The JSON around the fields is encoded once, and render() splices the
+    escaped values in, which is much cheaper than building and encoding a Payload per token.
+
+    A string made of a single field, such as badge='{count}' or body_localized_args=['{name}'],
+    takes the JSON value given for it, whatever its type. Fields within longer strings take the
+    text of their value. As with str.format, literal braces must be doubled.
+    """
+
+    def __init__(self, payload: Payload) -> None:
+        self.payload = payload
+        compiler = _Compiler()
+        compiler.value(payload.dict())
+        self.__parts = compiler.parts
+        self.__fields = compiler.fields
+        self.field_names = frozenset(name for _, name, _ in self.__fields)
+        if len(''.join(self.__parts).encode('utf-8')) > MAX_PAYLOAD_SIZE:
+            raise PayloadTooLarge()
+
+    def render(self, **values: Any) -> 'RenderedPayload':
+        """
+        The payload with the given field values, raising PayloadTooLarge if it exceeds the maximum
+        size allowed by APNs. Values must be serializable by the standard json module.
+        """
+        parts = self.__parts[:]
+        for index, name, encode in self.__fields:
+            parts[index] = encode(values[name])
+        json_payload = ''.join(parts).encode('utf-8')
+        if len(json_payload) > MAX_PAYLOAD_SIZE:
+            raise PayloadTooLarge()
+        return RenderedPayload(self, json_payload)
+
+
+class RenderedPayload(Payload):
+    """
+    A payload rendered from a PayloadTemplate, ready to be sent. Its attributes are those of the
+    template's payload, and can't be modified.
+    """
+    __slots__ = ('template', '__json_payload')
+
+    def __init__(self, template: PayloadTemplate, json_payload: bytes) -> None:  # pylint: disable=super-init-not-called
+        self.template = template
+        self.__json_payload = json_payload
+
+    def dict(self) -> Dict[str, Any]:
+        result = json.loads(self.__json_payload.decode('utf-8'))  # type: Dict[str, Any]
+        return result
+
+    def encode(self, serializer: Optional[JSONSerializer] = None) -> bytes:
+        return self.__json_payload
+
+    # The read-only field properties can't be restored by the default pickling of slots
+    def __reduce__(self) -> Tuple[Any, ...]:
+        return RenderedPayload, (self.template, self.__json_payload)
+
+
+for _name in _PAYLOAD_FIELDS:
+    setattr(RenderedPayload, _name, property(operator.attrgetter('template.payload.' + _name)))
@@ -0,0 +1,350 @@
+"""
+An in-process stand-in for APNs, to exercise clients over real HTTP/2 without network access.
+
+MockAPNsServer runs an h2 server on a background thread. It answers every request after a
+configurable latency, can fail chosen tokens with any APNs reason, and can change its
+SETTINGS_MAX_CONCURRENT_STREAMS or send GOAWAY while clients are connected. Point APNsClient or
+AsyncAPNsClient at it with MockCredentials:
+
+    with MockAPNsServer(reasons={bad_token: 'BadDeviceToken'}) as server:
+        client = APNsClient(credentials=MockCredentials(server))
+        client.send_notification_batch(notifications, topic)
+"""
+import asyncio
+import collections
+import json
+import ssl
+import threading
+import time
+import uuid
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple, Union
+
+import h2.config  # type: ignore
+import h2.connection  # type: ignore
+import h2.errors  # type: ignore
+import h2.events  # type: ignore
+import h2.exceptions  # type: ignore
+import h2.settings  # type: ignore
+from hyper import HTTP20Connection  # type: ignore
+
+from .async_connection import AsyncHTTP20Connection
+from .credentials import Credentials
+from .payload import MAX_PAYLOAD_SIZE
+
+DEFAULT_MAX_CONCURRENT_STREAMS = 500
+
+# HTTP status APNs answers with for each failure reason, 400 for the others
+REASON_STATUS = {
+    'BadCertificate': 403,
+    'BadCertificateEnvironment': 403,
+    'ExpiredProviderToken': 403,
+    'Forbidden': 403,
+    'InvalidProviderToken': 403,
+    'MissingProviderToken': 403,
+    'BadPath': 404,
+    'MethodNotAllowed': 405,
+    'Unregistered': 410,
+    'PayloadTooLarge': 413,
+    'TooManyProviderTokenUpdates': 429,
+    'TooManyRequests': 429,
+    'InternalServerError': 500,
+    'ServiceUnavailable': 503,
+    'Shutdown': 503,
+}
+
+MockRequest = collections.namedtuple('MockRequest', ['token', 'headers', 'payload'])
+
+# A reason, an (Unregistered, timestamp) pair, or a list of those consumed one per request,
+# after which requests succeed
+MockReason = Union[str, Tuple[str, int], List[Union[str, Tuple[str, int]]]]
+
+
+class MockAPNsServer(object):
+    """
+    In-process HTTP/2 server answering like APNs.
+
+    :param reasons: failure reason per device token. A list of reasons is consumed one request at
+        a time, so `['ServiceUnavailable']` fails the first request for the token only.
+    :param latency: called with the device token for every request, returns the number of seconds
+        to wait before answering, e.g. `lambda token: random.expovariate(20)`.
+    :param ssl_context: server side TLS context. Without it the server speaks plain-text HTTP/2.
+    :param goaway_after: send GOAWAY on every connection once this many requests were answered.
+    :param record_requests: keep every request in `requests`. Disable it for large load tests.
+    """
+
+    def __init__(self, reasons: Optional[Dict[str, MockReason]] = None,
+                 max_concurrent_streams: int = DEFAULT_MAX_CONCURRENT_STREAMS,
+                 latency: Optional[Callable[[str], float]] = None, ssl_context: Optional[ssl.SSLContext] = None,
+                 host: str = '127.0.0.1', goaway_after: Optional[int] = None, record_requests: bool = True) -> None:
+        self.reasons = dict(reasons or {})  # type: Dict[str, MockReason]
+        self.max_concurrent_streams = max_concurrent_streams
+        self.latency = latency
+        self.ssl_context = ssl_context
+        self.host = host
+        self.port = 0
+        self.goaway_after = goaway_after
+        self.record_requests = record_requests
+
+        self.requests = []  # type: List[MockRequest]
+        self.request_count = 0
+        self.response_count = 0
+        self.connection_count = 0
+
+        self._loop = None  # type: Optional[asyncio.AbstractEventLoop]
+        self._thread = None  # type: Optional[threading.Thread]
+        self._server = None  # type: Optional[asyncio.base_events.Server]
+        self._connections = set()  # type: Set[_MockConnection]
+
+    @property
+    def secure(self) -> bool:
+        return self.ssl_context is not None
+
+    def start(self) -> None:
+        """Start serving on a background thread. The port is picked by the OS unless set before."""
+        loop = asyncio.new_event_loop()
+        self._loop = loop
+        self._thread = threading.Thread(target=loop.run_forever, name='MockAPNsServer', daemon=True)
+        self._thread.start()
+        self._server = asyncio.run_coroutine_threadsafe(self._start_server(), loop).result()
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    def stop(self) -> None:
+        if self._loop is None:
+            return
+
+        asyncio.run_coroutine_threadsafe(self._stop_server(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        assert self._thread is not None
+        self._thread.join()
+        self._loop.close()
+        self._loop = self._thread = self._server = None
+
+    def __enter__(self) -> 'MockAPNsServer':
+        self.start()
+        return self
+
+    def __exit__(self, *_args: Any) -> None:
+        self.stop()
+
+    def set_reason(self, token: str, reason: Optional[MockReason]) -> None:
+        """Make requests for the token fail with the reason from now on, or succeed if it's None"""
+        self._call(self.__set_reason, token, reason)
+
+    def update_max_concurrent_streams(self, max_concurrent_streams: int) -> None:
+        """Send a new SETTINGS_MAX_CONCURRENT_STREAMS value on every open connection"""
+        self._call(self.__update_max_concurrent_streams, max_concurrent_streams)
+
+    def goaway(self, error_code: int = 0) -> None:
+        """
+        Send GOAWAY on every open connection and close them. Requests that were not answered yet
+        are dropped, as when APNs recycles a connection.
+        """
+        self._call(self.__goaway, error_code)
+
+    def _call(self, function: Callable[..., None], *args: Any) -> None:
+        if self._loop is None:
+            function(*args)
+            return
+
+        done = threading.Event()
+
+        def call() -> None:
+            try:
+                function(*args)
+            finally:
+                done.set()
+
+        self._loop.call_soon_threadsafe(call)
+        done.wait()
+
+    def __set_reason(self, token: str, reason: Optional[MockReason]) -> None:
+        if reason is None:
+            self.reasons.pop(token, None)
+        else:
+            self.reasons[token] = reason
+
+    def __update_max_concurrent_streams(self, max_concurrent_streams: int) -> None:
+        self.max_concurrent_streams = max_concurrent_streams
+        for connection in list(self._connections):
+            connection.update_max_concurrent_streams(max_concurrent_streams)
+
+    def _response_sent(self) -> None:
+        self.response_count += 1
+        if self.response_count == self.goaway_after:
+            self.goaway_after = None
+            self.__goaway(0)
+
+    def __goaway(self, error_code: int) -> None:
+        for connection in list(self._connections):
+            connection.goaway(error_code)
+
+    async def _start_server(self) -> 'asyncio.base_events.Server':
+        return await asyncio.start_server(self._handle_connection, self.host, self.port, ssl=self.ssl_context)
+
+    async def _stop_server(self) -> None:
+        assert self._server is not None
+        self._server.close()
+        await self._server.wait_closed()
+        for connection in list(self._connections):
+            connection.close()
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        connection = _MockConnection(self, writer)
+        self._connections.add(connection)
+        self.connection_count += 1
+        try:
+            await connection.serve(reader)
+        finally:
+            self._connections.discard(connection)
+
+    def _next_result(self, token: str, payload: bytes) -> Union[str, Tuple[str, int]]:
+        self.request_count += 1
+        if len(payload) > MAX_PAYLOAD_SIZE:
+            return 'PayloadTooLarge'
+
+        reason = self.reasons.get(token)
+        if isinstance(reason, list):
+            return reason.pop(0) if reason else 'Success'
+        return reason or 'Success'
+
+
+class _MockConnection(object):
+    def __init__(self, server: MockAPNsServer, writer: asyncio.StreamWriter) -> None:
+        self.server = server
+        self.writer = writer
+        config = h2.config.H2Configuration(client_side=False, header_encoding='utf-8')
+        self.conn = h2.connection.H2Connection(config=config)
+        self.requests = {}  # type: Dict[int, Tuple[Dict[str, str], List[bytes]]]
+        self.highest_answered_stream_id = 0
+        self.closed = False
+
+    async def serve(self, reader: asyncio.StreamReader) -> None:
+        self.conn.initiate_connection()
+        self.conn.update_settings({h2.settings.SettingCodes.MAX_CONCURRENT_STREAMS:
+                                   self.server.max_concurrent_streams})
+        self.flush()
+
+        while not self.closed:
+            try:
+                data = await reader.read(65535)
+            except ConnectionError:
+                break
+            if not data:
+                break
+
+            try:
+                events = self.conn.receive_data(data)
+            except h2.exceptions.ProtocolError:
+                self.flush()
+                break
+
+            for event in events:
+                self.handle_event(event)
+            self.flush()
+
+        self.close()
+
+    def handle_event(self, event: 'h2.events.Event') -> None:
+        if isinstance(event, h2.events.RequestReceived):
+            self.requests[event.stream_id] = (dict(event.headers), [])
+        elif isinstance(event, h2.events.DataReceived):
+            self.conn.acknowledge_received_data(event.flow_controlled_length, event.stream_id)
+            if event.stream_id in self.requests:
+                self.requests[event.stream_id][1].append(event.data)
+        elif isinstance(event, h2.events.StreamEnded):
+            self.receive_request(event.stream_id)
+        elif isinstance(event, h2.events.StreamReset):
+            self.requests.pop(event.stream_id, None)
+        elif isinstance(event, h2.events.ConnectionTerminated):
+            self.close()
+
+    def receive_request(self, stream_id: int) -> None:
+        headers, data = self.requests.pop(stream_id)
+        token = headers.get(':path', '').rsplit('/', 1)[-1]
+        payload = b''.join(data)
+        if self.server.record_requests:
+            self.server.requests.append(MockRequest(token, headers, payload))
+        result = self.server._next_result(token, payload)  # pylint: disable=protected-access
+
+        delay = self.server.latency(token) if self.server.latency is not None else 0
+        if delay > 0:
+            asyncio.get_event_loop().call_later(delay, self.respond, stream_id, result)
+        else:
+            self.respond(stream_id, result)
+
+    def respond(self, stream_id: int, result: Union[str, Tuple[str, int]]) -> None:
+        if self.closed:
+            return
+
+        response_headers = [('apns-id', str(uuid.uuid4()).upper())]
+        try:
+            if result == 'Success':
+                self.conn.send_headers(stream_id, [(':status', '200')] + response_headers, end_stream=True)
+            else:
+                if isinstance(result, tuple):
+                    reason, timestamp = result
+                elif result == 'Unregistered':
+                    reason, timestamp = result, int(time.time() * 1000)
+                else:
+                    reason, timestamp = result, None
+
+                body = {'reason': reason}  # type: Dict[str, Any]
+                if timestamp is not None:
+                    body['timestamp'] = timestamp
+                status = REASON_STATUS.get(reason, 400)
+                self.conn.send_headers(stream_id, [(':status', str(status))] + response_headers)
+                self.conn.send_data(stream_id, json.dumps(body).encode('utf-8'), end_stream=True)
+        except h2.exceptions.ProtocolError:
+            # The client reset the stream or the connection is going away
+            return
+
+        self.highest_answered_stream_id = max(self.highest_answered_stream_id, stream_id)
+        self.flush()
+        self.server._response_sent()  # pylint: disable=protected-access
+
+    def update_max_concurrent_streams(self, max_concurrent_streams: int) -> None:
+        if self.closed:
+            return
+        self.conn.update_settings({h2.settings.SettingCodes.MAX_CONCURRENT_STREAMS: max_concurrent_streams})
+        self.flush()
+
+    def goaway(self, error_code: int) -> None:
+        if self.closed:
+            return
+        self.conn.close_connection(error_code=error_code, last_stream_id=self.highest_answered_stream_id)
+        self.flush()
+        self.close()
+
+    def flush(self) -> None:
+        if not self.closed:
+            self.writer.write(self.conn.data_to_send())
+
+    def close(self) -> None:
+        if not self.closed:
+            self.closed = True
+            self.writer.close()
+
+
+class MockCredentials(Credentials):
+    """
+    Credentials connecting to a MockAPNsServer instead of APNs. The server address given by the
+    client is ignored. The server must be started first, so that its port is known. For a TLS
+    server, pass a client SSL context that trusts its certificate.
+    """
+
+    def __init__(self, server: MockAPNsServer, ssl_context: Optional[ssl.SSLContext] = None) -> None:
+        super().__init__(ssl_context)
+        # Only the address is kept, so that the credentials can be pickled for other processes
+        self.__host = server.host
+        self.__port = server.port
+        self.__secure = server.secure
+        self.__ssl_context = ssl_context
+
+    def create_connection(self, server: str, port: int, proto: Optional[str], proxy_host: Optional[str] = None,
+                          proxy_port: Optional[int] = None) -> HTTP20Connection:
+        return HTTP20Connection(self.__host, self.__port, ssl_context=self.__ssl_context,
+                                force_proto=proto or 'h2', secure=self.__secure)
+
+    def create_async_connection(self, server: str, port: int) -> AsyncHTTP20Connection:
+        return AsyncHTTP20Connection(self.__host, self.__port, ssl_context=self.__ssl_context,
+                                     secure=self.__secure)
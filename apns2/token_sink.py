@@ -0,0 +1,166 @@
+import re
+import sqlite3
+import threading
+import time
+from typing import Any, Iterator, List, Optional, Tuple, Union
+
+# Failure reasons meaning that the device token should no longer be used
+INVALID_TOKEN_REASONS = frozenset(('BadDeviceToken', 'DeviceTokenNotForTopic', 'Unregistered'))
+
+_TABLE_NAME = re.compile('[A-Za-z_][A-Za-z0-9_]*')
+
+
+class InvalidTokenSink(object):
+    """
+    Receives the device tokens that APNs reported as invalid, as their results arrive, so that they
+    can be removed from the application's database while a batch is still being sent. Implementations
+    must be safe to use from several threads.
+    """
+
+    def add(self, token: str, reason: str, timestamp: Optional[int]) -> None:
+        """
+        Record an invalid token. The reason is one of INVALID_TOKEN_REASONS, and the timestamp, in
+        milliseconds, is when APNs last knew an Unregistered token to be valid.
+        """
+        raise NotImplementedError
+
+    def flush(self) -> None:
+        """Write the tokens buffered so far. Called by the client at the end of every batch."""
+
+    def close(self) -> None:
+        """Flush and release resources"""
+        self.flush()
+
+
+def _report_result(sink: InvalidTokenSink, token: str, result: Union[str, Tuple[str, Any]]) -> None:
+    if isinstance(result, tuple):
+        reason, timestamp = result[0], int(result[1])  # type: Tuple[str, Optional[int]]
+    else:
+        reason, timestamp = result, None
+    if reason in INVALID_TOKEN_REASONS:
+        sink.add(token, reason, timestamp)
+
+
+class SQLiteTokenSink(InvalidTokenSink):
+    """
+    Keeps invalid tokens in a table of an SQLite database, one row per token with the last reason
+    and timestamp reported for it. Tokens are buffered and written by a background thread, in one
+    transaction once `batch_size` of them are waiting or `flush_interval` seconds have passed since
+    the last write, so that a slow or locked database doesn't hold up sending. flush() and close()
+    wait for the tokens added before them to be written, and raise the error of a failed write.
+
+    It can be given to the clients of a ShardedSender: every worker process opens the database again.
+    """
+
+    def __init__(self, path: str, batch_size: int = 500, flush_interval: float = 1.0,
+                 table: str = 'invalid_tokens') -> None:
+        if batch_size < 1:
+            raise ValueError('batch_size must be at least 1')
+        if not _TABLE_NAME.fullmatch(table):
+            raise ValueError('Invalid table name: %r' % table)
+
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.table = table
+        self.__pending = []  # type: List[Tuple[str, str, Optional[int], float]]
+        # Numbers of tokens added, written, and that flush() waits for the writer to have written
+        self.__added = 0
+        self.__written = 0
+        self.__flush_target = 0
+        self.__error = None  # type: Optional[sqlite3.Error]
+        self.__closed = False
+        self.__condition = threading.Condition()
+        # Writers of other processes may hold the database lock for a while
+        self.__connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.__connection_lock = threading.Lock()
+        with self.__connection:
+            self.__connection.execute(
+                'CREATE TABLE IF NOT EXISTS %s (token TEXT PRIMARY KEY, reason TEXT NOT NULL, '
+                'timestamp INTEGER, reported_at REAL NOT NULL)' % table)
+        self.__writer = threading.Thread(target=self.__write, name='SQLiteTokenSink writer', daemon=True)
+        self.__writer.start()
+
+    def add(self, token: str, reason: str, timestamp: Optional[int]) -> None:
+        with self.__condition:
+            if self.__closed:
+                raise RuntimeError('Cannot add to a closed sink')
+            self.__pending.append((token, reason, timestamp, time.time()))
+            self.__added += 1
+            if len(self.__pending) >= self.batch_size:
+                self.__condition.notify_all()
+
+    def flush(self) -> None:
+        with self.__condition:
+            target = self.__flush_target = self.__added
+            self.__condition.notify_all()
+            while self.__written < target and self.__error is None and self.__writer.is_alive():
+                self.__condition.wait()
+            self.__raise_error()
+
+    def close(self) -> None:
+        with self.__condition:
+            self.__closed = True
+            self.__condition.notify_all()
+        self.__writer.join()
+        self.__connection.close()
+        with self.__condition:
+            self.__raise_error()
+
+    def tokens(self, reason: Optional[str] = None) -> Iterator[Tuple[str, str, Optional[int]]]:
+        """Token, reason and timestamp of every invalid token recorded, or only of those with the reason"""
+        self.flush()
+        query = 'SELECT token, reason, timestamp FROM %s' % self.table
+        with self.__connection_lock:
+            if reason is None:
+                rows = self.__connection.execute(query).fetchall()
+            else:
+                rows = self.__connection.execute(query + ' WHERE reason = ?', (reason,)).fetchall()
+        for token, row_reason, timestamp in rows:
+            yield token, row_reason, timestamp
+
+    def __raise_error(self) -> None:
+        error, self.__error = self.__error, None
+        if error is not None:
+            raise error
+
+    def __write(self) -> None:
+        failed = False
+        while True:
+            with self.__condition:
+                deadline = time.monotonic() + self.flush_interval
+                # After a failed write, wait for the interval before trying again
+                while not self.__closed and (failed or (len(self.__pending) < self.batch_size
+                                                        and self.__flush_target <= self.__written)):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.__condition.wait(remaining)
+                rows, self.__pending = self.__pending, []
+                closed = self.__closed
+
+            error = None  # type: Optional[sqlite3.Error]
+            if rows:
+                try:
+                    with self.__connection_lock, self.__connection:
+                        self.__connection.executemany(
+                            'INSERT OR REPLACE INTO %s (token, reason, timestamp, reported_at) '
+                            'VALUES (?, ?, ?, ?)' % self.table, rows)
+                except sqlite3.Error as exc:
+                    error = exc
+
+            with self.__condition:
+                failed = error is not None
+                if error is None:
+                    self.__written += len(rows)
+                else:
+                    # Keep the tokens for the next write
+                    self.__pending[:0] = rows
+                    self.__error = error
+                self.__condition.notify_all()
+            if closed:
+                return
+
+    # Connections can't be pickled, another process opens the database again
+    def __reduce__(self) -> Tuple[Any, ...]:
+        return SQLiteTokenSink, (self.path, self.batch_size, self.flush_interval, self.table)
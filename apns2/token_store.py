@@ -0,0 +1,152 @@
+import contextlib
+import mmap
+import os
+import re
+import struct
+import threading
+from typing import Any, Dict, Iterator, Optional, Tuple
+
+
+class TokenStore(object):
+    """
+    Keeps JWT provider tokens, so that every TokenCredentials with the same key ID and team ID
+    signs one token and shares it. Implementations must be safe to use from several threads.
+    """
+
+    def get(self, key: str) -> Optional[Tuple[float, str]]:
+        """Return the issue time and token stored under the key, if any"""
+        raise NotImplementedError
+
+    def set(self, key: str, issued_at: float, token: str) -> None:
+        """Store a new token under the key. Only called while holding lock(key)."""
+        raise NotImplementedError
+
+    @contextlib.contextmanager
+    def lock(self, key: str) -> Iterator[None]:
+        """Serialize token refreshes for the key, so that only one of the sharing clients signs"""
+        yield
+
+
+class MemoryTokenStore(TokenStore):
+    """Tokens shared by the clients of this process"""
+
+    def __init__(self) -> None:
+        self.__tokens = {}  # type: Dict[str, Tuple[float, str]]
+        self.__locks = {}  # type: Dict[str, threading.Lock]
+        self.__locks_lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[Tuple[float, str]]:
+        return self.__tokens.get(key)
+
+    def set(self, key: str, issued_at: float, token: str) -> None:
+        self.__tokens[key] = (issued_at, token)
+
+    @contextlib.contextmanager
+    def lock(self, key: str) -> Iterator[None]:
+        with self.__locks_lock:
+            lock = self.__locks.setdefault(key, threading.Lock())
+        with lock:
+            yield
+
+    # Locks can't be pickled. Another process gets its own default store, or an empty one.
+    def __reduce__(self) -> Tuple[Any, ...]:
+        if self is DEFAULT_TOKEN_STORE:
+            return get_default_token_store, ()
+        return MemoryTokenStore, ()
+
+
+DEFAULT_TOKEN_STORE = MemoryTokenStore()
+
+
+def get_default_token_store() -> MemoryTokenStore:
+    """The store used by TokenCredentials unless told otherwise, shared by the whole process"""
+    return DEFAULT_TOKEN_STORE
+
+
+class FileTokenStore(TokenStore):
+    """
+    Tokens in memory-mapped files of a directory, shared by every process of the host. Reading a
+    token is a memory read, without any system call. Refreshes are serialized with flock(), so only
+    one process signs a new token when the current one expires.
+
+    Each file holds a sequence number, odd while a write is in progress, the issue time and the
+    token. Readers retry when the sequence number is odd or changed while they read.
+    """
+    FILE_SIZE = 4096
+    _HEADER = struct.Struct('<Qdi')
+
+    def __init__(self, directory: str) -> None:
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.__files = {}  # type: Dict[str, Tuple[int, mmap.mmap, threading.Lock]]
+        self.__files_lock = threading.Lock()
+        # Sequence number and token last read from each file, to skip decoding unchanged tokens
+        self.__cache = {}  # type: Dict[str, Tuple[int, Tuple[float, str]]]
+
+    def __reduce__(self) -> Tuple[Any, ...]:
+        return FileTokenStore, (self.directory,)
+
+    def __open(self, key: str) -> Tuple[int, mmap.mmap, threading.Lock]:
+        entry = self.__files.get(key)
+        if entry is not None:
+            return entry
+
+        with self.__files_lock:
+            entry = self.__files.get(key)
+            if entry is None:
+                path = os.path.join(self.directory, re.sub(r'[^A-Za-z0-9_.-]', '_', key) + '.jwt')
+                fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+                if os.fstat(fd).st_size < self.FILE_SIZE:
+                    os.ftruncate(fd, self.FILE_SIZE)
+                entry = (fd, mmap.mmap(fd, self.FILE_SIZE), threading.Lock())
+                self.__files[key] = entry
+        return entry
+
+    def get(self, key: str) -> Optional[Tuple[float, str]]:
+        _, data, _ = self.__open(key)
+        # Give up after a while if a writer died in the middle of a write, the caller then
+        # refreshes the token, which fixes the file.
+        for _ in range(1000):
+            sequence, issued_at, length = self._HEADER.unpack_from(data)
+            if sequence & 1:
+                continue
+            if sequence == 0:
+                return None
+
+            cached = self.__cache.get(key)
+            if cached is not None and cached[0] == sequence:
+                return cached[1]
+
+            start = self._HEADER.size
+            token = data[start:start + length].decode('ascii')
+            if self._HEADER.unpack_from(data)[0] == sequence:
+                self.__cache[key] = (sequence, (issued_at, token))
+                return issued_at, token
+        return None
+
+    def set(self, key: str, issued_at: float, token: str) -> None:
+        _, data, _ = self.__open(key)
+        encoded = token.encode('ascii')
+        start = self._HEADER.size
+        if start + len(encoded) > self.FILE_SIZE:
+            raise ValueError('Token too long for the token store')
+
+        # Rounding down to even recovers from a writer that died halfway
+        sequence = self._HEADER.unpack_from(data)[0] & ~1
+        struct.pack_into('<Q', data, 0, sequence + 1)
+        data[start:start + len(encoded)] = encoded
+        self._HEADER.pack_into(data, 0, sequence + 1, issued_at, len(encoded))
+        struct.pack_into('<Q', data, 0, sequence + 2)
+
+    @contextlib.contextmanager
+    def lock(self, key: str) -> Iterator[None]:
+        import fcntl  # pylint: disable=import-outside-toplevel
+
+        fd, _, thread_lock = self.__open(key)
+        # flock() doesn't exclude other threads using the same file descriptor
+        with thread_lock:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
@@ -0,0 +1,95 @@
+import collections
+import hashlib
+import re
+import typing
+from enum import Enum
+from typing import Any, Dict, Hashable, Iterable, Optional, Tuple, TypeVar
+
+from .rate_limit import COALESCED, RATE_LIMITED
+from .serializer import JSONSerializer
+
+# Device tokens are hex strings, of 32 bytes nowadays, but Apple warns that their length may change
+_TOKEN_PATTERN = re.compile('(?:[0-9a-f]{2}){32,100}')
+
+# Result of the notifications dropped as duplicates, they're not sent
+DUPLICATE = 'Duplicate'
+# Results of notifications that weren't sent because of another one to the same token
+_HELD_BACK = frozenset((DUPLICATE, COALESCED, RATE_LIMITED))
+
+# Number of most recent notifications of a batch that duplicates are looked for among
+DUPLICATE_WINDOW = 10000
+
+_R = TypeVar('_R')
+
+
+class DuplicatePolicy(Enum):
+    # Send every notification
+    Keep = 'keep'
+    # Drop notifications identical to an earlier one of the batch: same token, payload, topic,
+    # priority, expiration, collapse ID and push type
+    DropIdentical = 'drop-identical'
+    # Drop every notification to a token that already got one in the batch
+    DropToken = 'drop-token'
+
+
+def normalize_token(token: str) -> str:
+    """The device token in lowercase, without surrounding whitespace"""
+    return token.strip().lower()
+
+
+def is_valid_token(token: str) -> bool:
+    """Whether a normalized device token is well-formed"""
+    return _TOKEN_PATTERN.fullmatch(token) is not None
+
+
+class _PreSendCheck(object):
+    """
+    Screens the notifications of a batch before they're sent: malformed tokens get a
+    BadDeviceToken result right away instead of costing a round trip to APNs, and duplicates are
+    dropped according to the policy. Duplicates are only looked for among the last `window`
+    distinct notifications, and payloads are remembered by digest, so memory stays bounded.
+    """
+
+    def __init__(self, validate_tokens: bool, duplicate_policy: DuplicatePolicy, serializer: JSONSerializer,
+                 window: int = DUPLICATE_WINDOW) -> None:
+        self.__validate_tokens = validate_tokens
+        self.__duplicate_policy = duplicate_policy
+        self.__serializer = serializer
+        self.__window = window
+        # Keys of the notifications seen, least recently seen first
+        self.__seen = collections.OrderedDict()  # type: typing.OrderedDict[Hashable, None]
+
+    def check(self, notification: Any) -> Optional[str]:
+        """The reason to reject the notification with, if any"""
+        token = notification.token  # type: str
+        if self.__validate_tokens:
+            token = normalize_token(token)
+            if not is_valid_token(token):
+                return 'BadDeviceToken'
+
+        if self.__duplicate_policy is not DuplicatePolicy.Keep:
+            if self.__duplicate_policy is DuplicatePolicy.DropToken:
+                key = token  # type: Hashable
+            else:
+                # The payload is memoized, the client doesn't serialize it again
+                digest = hashlib.blake2b(notification.payload.encode(self.__serializer), digest_size=16).digest()
+                key = (token, digest, tuple(notification[2:]))
+            if key in self.__seen:
+                self.__seen.move_to_end(key)
+                return DUPLICATE
+            self.__seen[key] = None
+            if len(self.__seen) > self.__window:
+                self.__seen.popitem(last=False)
+        return None
+
+
+def _collect_results(results: Iterable[Tuple[str, _R]]) -> Dict[str, _R]:
+    """
+    The (token, result) pairs of a batch as a dictionary. A notification dropped as a duplicate or
+    by the rate limiter doesn't hide the result of one that was sent to the same token.
+    """
+    collected = {}  # type: Dict[str, _R]
+    for token, result in results:
+        if result not in _HELD_BACK or token not in collected:
+            collected[token] = result
+    return collected
@@ -0,0 +1,213 @@
+"""
+Throughput benchmarks for APNsClient against a local MockAPNsServer.
+
+Every case runs in fresh processes: one for the server, so its CPU time isn't counted, and one
+for the client, so peak RSS belongs to that case alone. Results are printed as JSON and can be
+compared with an earlier run:
+
+    python benchmarks/bench_client.py --output before.json
+    git checkout my-branch
+    python benchmarks/bench_client.py --compare before.json
+
+The JSON serializer can be chosen the same way, to measure the gain of orjson:
+
+    python benchmarks/bench_client.py --serializer json --output json.json
+    python benchmarks/bench_client.py --serializer orjson --compare json.json
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from apns2.client import APNsClient, Notification  # noqa: E402
+from apns2.payload import Payload  # noqa: E402
+from apns2.serializer import JSONSerializer, OrjsonSerializer, get_default_serializer  # noqa: E402
+from apns2.testing import MockAPNsServer, MockCredentials  # noqa: E402
+
+TOPIC = 'com.example.App'
+WORKLOADS = ['single', 'batch', 'broadcast', 'per_token']
+SERIALIZERS = {
+    'default': get_default_serializer,
+    'json': JSONSerializer,
+    'orjson': OrjsonSerializer,
+}
+DEFAULT_MAX_CONCURRENT_STREAMS = [10, 100, 1000]
+
+
+class TimedClient(APNsClient):
+    """Records when the request for each token is sent, to measure per-notification latency"""
+
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        self.sent_at = {}  # type: Dict[str, float]
+
+    def _send_request(self, connection: Any, token_hex: str, json_payload: bytes,  # type: ignore
+                      headers: Any) -> int:
+        self.sent_at[token_hex] = time.perf_counter()
+        return APNsClient._send_request(connection, token_hex, json_payload, headers)
+
+
+def make_notifications(workload: str, count: int) -> List[Notification]:
+    tokens = ['%064x' % i for i in range(count)]
+    if workload == 'broadcast':
+        payload = Payload(alert='Breaking news', sound='default', badge=1)
+        return [Notification(token=token, payload=payload) for token in tokens]
+    elif workload == 'per_token':
+        return [Notification(token=token, payload=Payload(alert='Hello user %d' % i, badge=i % 10,
+                                                          custom={'user_id': i}))
+                for i, token in enumerate(tokens)]
+    else:
+        # Same content as broadcast, but every notification carries its own Payload object
+        return [Notification(token=token, payload=Payload(alert='Breaking news', sound='default', badge=1))
+                for token in tokens]
+
+
+def run_client(workload: str, port: int, count: int, serializer: str) -> Dict[str, Any]:
+    server = MockAPNsServer()
+    server.port = port
+    client = TimedClient(credentials=MockCredentials(server), serializer=SERIALIZERS[serializer]())
+    client.connect()
+    notifications = make_notifications(workload, count)
+
+    latencies = []  # type: List[float]
+    cpu_start = time.process_time()
+    start = time.perf_counter()
+    if workload == 'single':
+        for notification in notifications:
+            sent = time.perf_counter()
+            client.send_notification(notification.token, notification.payload, TOPIC)
+            latencies.append(time.perf_counter() - sent)
+    else:
+        for token, result in client.iter_notification_results(notifications, TOPIC):
+            latencies.append(time.perf_counter() - client.sent_at[token])
+    elapsed = time.perf_counter() - start
+    cpu = time.process_time() - cpu_start
+
+    latencies.sort()
+    return {
+        'notifications': count,
+        'seconds': round(elapsed, 4),
+        'notifications_per_second': round(count / elapsed, 1),
+        'latency_p50_ms': round(percentile(latencies, 50) * 1000, 3),
+        'latency_p99_ms': round(percentile(latencies, 99) * 1000, 3),
+        'cpu_us_per_notification': round(cpu / count * 1e6, 1),
+        # ru_maxrss is in kilobytes on Linux and bytes on macOS
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // (1024 if sys.platform == 'darwin' else 1),
+    }
+
+
+def percentile(values: List[float], percent: float) -> float:
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+
+def serve(max_concurrent_streams: int, latency: float, port_queue: Any, stop: Any) -> None:
+    latency_function = (lambda token: latency) if latency > 0 else None  # type: Optional[Callable[[str], float]]
+    with MockAPNsServer(max_concurrent_streams=max_concurrent_streams, latency=latency_function,
+                        record_requests=False) as server:
+        port_queue.put(server.port)
+        stop.wait()
+
+
+def client_process(workload: str, port: int, count: int, serializer: str, result_queue: Any) -> None:
+    result_queue.put(run_client(workload, port, count, serializer))
+
+
+def run_case(context: Any, workload: str, max_concurrent_streams: int, count: int, latency: float,
+             serializer: str) -> Dict[str, Any]:
+    port_queue, result_queue, stop = context.Queue(), context.Queue(), context.Event()
+    server = context.Process(target=serve, args=(max_concurrent_streams, latency, port_queue, stop))
+    server.start()
+    try:
+        port = port_queue.get(timeout=30)
+        client = context.Process(target=client_process, args=(workload, port, count, serializer, result_queue))
+        client.start()
+        result = result_queue.get()
+        client.join()
+    finally:
+        stop.set()
+        server.join()
+
+    result.update(workload=workload, max_concurrent_streams=max_concurrent_streams)
+    return result
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(baseline: Dict[str, Any], current: Dict[str, Any]) -> None:
+    previous = {(result['workload'], result['max_concurrent_streams']): result for result in baseline['results']}
+    for result in current['results']:
+        before = previous.get((result['workload'], result['max_concurrent_streams']))
+        if before is None:
+            continue
+        change = result['notifications_per_second'] / before['notifications_per_second'] - 1
+        cpu_change = result['cpu_us_per_notification'] / before['cpu_us_per_notification'] - 1
+        print('%-10s streams=%-5d %10.1f -> %10.1f notifications/s (%+.1f%%), %7.1f -> %7.1f CPU us each (%+.1f%%)' % (
+            result['workload'], result['max_concurrent_streams'], before['notifications_per_second'],
+            result['notifications_per_second'], change * 100, before['cpu_us_per_notification'],
+            result['cpu_us_per_notification'], cpu_change * 100), file=sys.stderr)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--count', type=int, default=5000, help='notifications per batch case')
+    parser.add_argument('--single-count', type=int, default=500, help='notifications for the single-send case')
+    parser.add_argument('--workload', choices=WORKLOADS, action='append', help='workloads to run (default: all)')
+    parser.add_argument('--max-concurrent-streams', type=int, action='append',
+                        help='server SETTINGS_MAX_CONCURRENT_STREAMS values (default: %s)'
+                             % DEFAULT_MAX_CONCURRENT_STREAMS)
+    parser.add_argument('--latency', type=float, default=0, help='server response latency in seconds')
+    parser.add_argument('--serializer', choices=sorted(SERIALIZERS), default='default',
+                        help='JSON serializer of the client (default: orjson if installed)')
+    parser.add_argument('--output', help='write the JSON results to this file instead of stdout')
+    parser.add_argument('--compare', help='print the throughput change against an earlier JSON result file')
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context('spawn')
+    results = []
+    for workload in args.workload or WORKLOADS:
+        # Single sends never have more than one stream open, so the server limit doesn't matter
+        stream_values = [1] if workload == 'single' else args.max_concurrent_streams or DEFAULT_MAX_CONCURRENT_STREAMS
+        for max_concurrent_streams in stream_values:
+            count = args.single_count if workload == 'single' else args.count
+            results.append(run_case(context, workload, max_concurrent_streams, count, args.latency,
+                                    args.serializer))
+            print('%(workload)s streams=%(max_concurrent_streams)s: %(notifications_per_second)s notifications/s'
+                  % results[-1], file=sys.stderr)
+
+    report = {
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'latency': args.latency,
+        'serializer': type(SERIALIZERS[args.serializer]()).__name__,
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), report)
+
+
+if __name__ == '__main__':
+    main()
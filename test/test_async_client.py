@@ -0,0 +1,121 @@
+import asyncio
+import time
+
+import pytest
+
+from apns2.async_client import AsyncAPNsClient
+from apns2.client import Notification
+from apns2.errors import BadDeviceToken, Unregistered
+from apns2.payload import Payload
+from apns2.retry import RetryPolicy
+from apns2.testing import MockAPNsServer, MockCredentials
+from apns2.validation import DuplicatePolicy
+
+TOPIC = 'com.example.App'
+
+
+def run_with_server(server, coroutine_function, **client_kwargs):
+    async def main():
+        client = AsyncAPNsClient(credentials=MockCredentials(server), **client_kwargs)
+        try:
+            return await coroutine_function(client)
+        finally:
+            await client.close()
+
+    with server:
+        return asyncio.run(main())
+
+
+@pytest.fixture
+def notifications():
+    payload = Payload(alert='Test alert')
+    return [Notification(token='%064x' % i, payload=payload) for i in range(300)]
+
+
+def test_send_notification_succeeds():
+    server = MockAPNsServer()
+    run_with_server(server, lambda client: client.send_notification('%064x' % 1, Payload(alert='Test'), TOPIC))
+    assert server.requests[0].token == '%064x' % 1
+    assert server.requests[0].headers['apns-topic'] == TOPIC
+
+
+def test_send_notification_raises_unregistered_with_timestamp():
+    server = MockAPNsServer(reasons={'%064x' % 1: ('Unregistered', 1500000000000)})
+    with pytest.raises(Unregistered) as exc_info:
+        run_with_server(server, lambda client: client.send_notification('%064x' % 1, Payload(alert='Test'), TOPIC))
+    assert exc_info.value.timestamp == 1500000000000
+
+
+def test_send_notification_raises_failure_reason():
+    server = MockAPNsServer(reasons={'%064x' % 1: 'BadDeviceToken'})
+    with pytest.raises(BadDeviceToken):
+        run_with_server(server, lambda client: client.send_notification('%064x' % 1, Payload(alert='Test'), TOPIC))
+
+
+def test_send_notification_batch_reports_results(notifications):
+    reasons = {notification.token: 'BadDeviceToken' for notification in notifications[::3]}
+    results = run_with_server(MockAPNsServer(reasons=reasons, max_concurrent_streams=10),
+                              lambda client: client.send_notification_batch(notifications, TOPIC))
+    assert results == {notification.token: reasons.get(notification.token, 'Success')
+                       for notification in notifications}
+
+
+def test_iter_notification_results_yields_every_token(notifications):
+    async def collect(client):
+        return [token async for token, result in client.iter_notification_results(notifications, TOPIC)]
+
+    tokens = run_with_server(MockAPNsServer(max_concurrent_streams=10), collect)
+    assert sorted(tokens) == [notification.token for notification in notifications]
+
+
+def test_iter_notification_results_yields_before_streams_are_full(notifications):
+    consumed = []
+
+    def slow_source():
+        for notification in notifications[:20]:
+            if consumed:
+                time.sleep(0.02)
+            consumed.append(notification)
+            yield notification
+
+    async def first_result(client):
+        async for _ in client.iter_notification_results(slow_source(), TOPIC):
+            return len(consumed)
+
+    assert run_with_server(MockAPNsServer(), first_result) < 20
+
+
+def test_send_notification_batch_uses_every_connection_of_the_pool(notifications):
+    server = MockAPNsServer(max_concurrent_streams=10)
+    results = run_with_server(server, lambda client: client.send_notification_batch(notifications, TOPIC),
+                              pool_size=3)
+    assert results == {notification.token: 'Success' for notification in notifications}
+    assert server.connection_count == 3
+    assert server.request_count == len(notifications)
+
+
+def test_send_notification_batch_retries_retryable_failures(notifications):
+    reasons = {notifications[0].token: ['TooManyRequests'], notifications[1].token: ['Shutdown'] * 3}
+    server = MockAPNsServer(reasons=reasons, max_concurrent_streams=10)
+    results = run_with_server(server, lambda client: client.send_notification_batch(notifications, TOPIC),
+                              retry_policy=RetryPolicy(max_retries=2, backoff=0))
+    assert results[notifications[0].token] == 'Success'
+    assert results[notifications[1].token] == 'Shutdown'
+    assert len(server.requests) == len(notifications) + 3
+
+
+def test_send_notification_batch_replays_requests_after_goaway(notifications):
+    server = MockAPNsServer(max_concurrent_streams=10, goaway_after=50)
+    results = run_with_server(server, lambda client: client.send_notification_batch(notifications, TOPIC))
+    assert results == {notification.token: 'Success' for notification in notifications}
+    assert len({request.token for request in server.requests}) == len(notifications)
+
+
+def test_send_notification_batch_validates_and_deduplicates_tokens(notifications):
+    notifications = [Notification(token='not a token', payload=Payload(alert='Test'))] + notifications + notifications
+    server = MockAPNsServer()
+    results = run_with_server(server, lambda client: client.send_notification_batch(notifications, TOPIC),
+                              validate_tokens=True, duplicate_policy=DuplicatePolicy.DropIdentical)
+    assert results.pop('not a token') == 'BadDeviceToken'
+    assert set(results.values()) == {'Success'}
+    assert server.request_count == len(results)
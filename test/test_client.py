@@ -1,11 +1,18 @@
+import collections
 import contextlib
+import json
+import logging
 from unittest.mock import MagicMock, Mock, patch
 
 import pytest
+from hyper.http20.exceptions import ConnectionError as HTTP20ConnectionError, StreamResetError
 
-from apns2.client import APNsClient, Credentials, CONCURRENT_STREAMS_SAFETY_MAXIMUM, Notification
-from apns2.errors import ConnectionFailed
-from apns2.payload import Payload
+from apns2.client import (APNsClient, Credentials, CONCURRENT_STREAMS_SAFETY_MAXIMUM, MAX_CONNECTION_RETRIES,
+                          STREAM_LOST, Notification, NotificationPriority, RoutedNotification)
+from apns2.errors import ConnectionFailed, PayloadTooLarge
+from apns2.payload import MAX_PAYLOAD_SIZE, Payload, PayloadAlert
+from apns2.retry import RetryPolicy
+from apns2.serializer import JSONSerializer, get_default_serializer
 
 TOPIC = 'com.example.App'
 
@@ -31,11 +38,17 @@ def client(mock_connection):
 
 @pytest.fixture
 def mock_connection():
+    return create_mock_connection()
+
+
+def create_mock_connection():
     mock_connection = MagicMock()
     mock_connection.__max_open_streams = 0
     mock_connection.__open_streams = 0
     mock_connection.__mock_results = None
     mock_connection.__next_stream_id = 0
+    mock_connection.streams = {}
+    mock_connection.recent_recv_streams = set()
 
     @contextlib.contextmanager
     def mock_get_response(stream_id):
@@ -54,6 +67,9 @@ def mock_connection():
 
         stream_id = mock_connection.__next_stream_id
         mock_connection.__next_stream_id += 1
+        # Responses arrive immediately
+        mock_connection.streams[stream_id] = Mock(remote_closed=True)
+        mock_connection.recent_recv_streams.add(stream_id)
         return stream_id
 
     mock_connection.get_response.side_effect = mock_get_response
@@ -64,6 +80,16 @@ def mock_connection():
     return mock_connection
 
 
+@pytest.mark.parametrize('client_kwargs', [{}, {'json_encoder': json.JSONEncoder}, {'serializer': JSONSerializer()}])
+def test_send_notification_uses_serializer(mock_connection, client_kwargs):
+    with patch('apns2.credentials.HTTP20Connection') as mock_connection_constructor:
+        mock_connection_constructor.return_value = mock_connection
+        client = APNsClient(credentials=Credentials(), **client_kwargs)
+
+    client.send_notification_async('%064x' % 0, Payload(alert='Zoë'), TOPIC)
+    assert mock_connection.request.call_args[0][2] == '{"aps":{"alert":"Zoë"}}'.encode('utf-8')
+
+
 def test_connect_establishes_connection(client, mock_connection):
     client.connect()
     mock_connection.connect.assert_called_once_with()
@@ -123,3 +149,323 @@ def test_send_notification_batch_reports_different_results(client, mock_connecti
     results = client.send_notification_batch(notifications, TOPIC)
     expected_results = dict(zip(tokens, mock_connection.__mock_results))
     assert results == expected_results
+
+
+def test_send_notification_batch_collects_responses_in_completion_order(client, mock_connection, tokens,
+                                                                        notifications):
+    mock_connection._conn.remote_settings.max_concurrent_streams = 2
+    send_request = mock_connection.request.side_effect
+    get_response = mock_connection.get_response.side_effect
+    calls = []
+
+    def mock_request(*args):
+        stream_id = send_request(*args)
+        calls.append(('request', stream_id))
+        if stream_id == 0:
+            # The first response only arrives on the next read
+            mock_connection.streams[0].remote_closed = False
+            mock_connection.recent_recv_streams.discard(0)
+        return stream_id
+
+    def mock_get_response(stream_id):
+        calls.append(('response', stream_id))
+        return get_response(stream_id)
+
+    def mock_recv_cb():
+        mock_connection.streams[0].remote_closed = True
+        mock_connection.recent_recv_streams.add(0)
+
+    mock_connection.request.side_effect = mock_request
+    mock_connection.get_response.side_effect = mock_get_response
+    mock_connection._recv_cb.side_effect = mock_recv_cb
+
+    results = client.send_notification_batch(notifications[:3], TOPIC)
+    assert results == {token: 'Success' for token in tokens[:3]}
+    assert calls == [('request', 0), ('request', 1), ('response', 1), ('request', 2), ('response', 2),
+                     ('response', 0)]
+
+
+def test_send_notification_batch_replays_lost_requests_in_sending_order(client, mock_connection, tokens,
+                                                                        notifications):
+    mock_connection._conn.remote_settings.max_concurrent_streams = 3
+    send_request = mock_connection.request.side_effect
+    sent_tokens = []
+    failed = []
+
+    def mock_request(method, url, body, headers):
+        token = url.rsplit('/', 1)[1]
+        if token == tokens[2] and not failed:
+            failed.append(token)
+            raise ConnectionResetError()
+        stream_id = send_request(method, url, body, headers)
+        sent_tokens.append(token)
+        if stream_id < 2:
+            # No response before the connection is lost
+            mock_connection.streams[stream_id].remote_closed = False
+            mock_connection.recent_recv_streams.discard(stream_id)
+        return stream_id
+
+    mock_connection.request.side_effect = mock_request
+    results = client.send_notification_batch(notifications[:3], TOPIC)
+    assert results == {token: 'Success' for token in tokens[:3]}
+    assert sent_tokens == [tokens[0], tokens[1], tokens[0], tokens[1], tokens[2]]
+
+
+def test_send_notification_batch_gives_up_on_streams_reset_every_time(client, mock_connection, tokens,
+                                                                      notifications):
+    get_response = mock_connection.get_response.side_effect
+    reset_stream_ids = set()
+
+    def mock_request(method, url, body, headers):
+        stream_id = send_request(method, url, body, headers)
+        if url.endswith(tokens[1]):
+            reset_stream_ids.add(stream_id)
+        return stream_id
+
+    def mock_get_response(stream_id):
+        if stream_id in reset_stream_ids:
+            raise StreamResetError()
+        return get_response(stream_id)
+
+    send_request = mock_connection.request.side_effect
+    mock_connection.request.side_effect = mock_request
+    mock_connection.get_response.side_effect = mock_get_response
+    results = client.send_notification_batch(notifications[:3], TOPIC)
+    assert results == {tokens[0]: 'Success', tokens[1]: STREAM_LOST, tokens[2]: 'Success'}
+    assert len(reset_stream_ids) == MAX_CONNECTION_RETRIES + 1
+
+
+def test_send_notification_batch_spreads_streams_over_connection_pool(tokens, notifications):
+    connections = [create_mock_connection() for _ in range(3)]
+    for connection in connections:
+        connection._conn.remote_settings.max_concurrent_streams = 100
+    with patch('apns2.credentials.HTTP20Connection') as mock_connection_constructor:
+        mock_connection_constructor.side_effect = connections
+        client = APNsClient(credentials=Credentials(), pool_size=3)
+
+    results = client.send_notification_batch(notifications, TOPIC)
+    assert results == {token: 'Success' for token in tokens}
+    for connection in connections:
+        connection.connect.assert_called_once_with()
+        assert connection.__max_open_streams == 100
+    assert sum(connection.request.call_count for connection in connections) == len(tokens)
+
+
+def test_pool_size_must_be_positive():
+    with pytest.raises(ValueError):
+        APNsClient(credentials=Credentials(), pool_size=0)
+
+
+def test_iter_notification_results_yields_results_while_sending(client, mock_connection, tokens, notifications):
+    mock_connection._conn.remote_settings.max_concurrent_streams = 10
+    results = client.iter_notification_results(notifications, TOPIC)
+    assert mock_connection.request.call_count == 0
+
+    token, result = next(results)
+    assert (token, result) == (tokens[0], 'Success')
+    assert mock_connection.request.call_count == 10
+
+    assert dict(results) == {token: 'Success' for token in tokens[1:]}
+
+
+def test_send_notification_batch_logs_aggregated_progress(client, tokens, notifications, caplog):
+    caplog.set_level(logging.DEBUG, logger='apns2.client')
+    with patch('apns2.client.PROGRESS_LOG_INTERVAL', 400):
+        client.send_notification_batch(notifications, TOPIC)
+
+    messages = [record.getMessage() for record in caplog.records]
+    assert not any(tokens[0] in message for message in messages)
+    progress = [message for message in messages if message.startswith('Batch progress')]
+    assert [message.split(' results')[0] for message in progress] == ['Batch progress: 400', 'Batch progress: 800']
+    assert any(message.startswith('Batch finished: 1000 results') and message.endswith('Success: 1000')
+               for message in messages)
+
+
+def test_send_notification_batch_logs_progress_periodically(client, notifications, caplog):
+    caplog.set_level(logging.INFO, logger='apns2.client')
+    with patch('apns2.client.PROGRESS_LOG_PERIOD', 0):
+        client.send_notification_batch(notifications[:3], TOPIC)
+
+    progress = [record.getMessage() for record in caplog.records if record.getMessage().startswith('Batch progress')]
+    assert [message.split(' results')[0] for message in progress] == ['Batch progress: %d' % i for i in range(1, 4)]
+
+
+def test_send_notification_batch_logs_tokens_when_asked(mock_connection, tokens, notifications, caplog):
+    caplog.set_level(logging.DEBUG, logger='apns2.client')
+    with patch('apns2.credentials.HTTP20Connection') as mock_connection_constructor:
+        mock_connection_constructor.return_value = mock_connection
+        client = APNsClient(credentials=Credentials(), log_tokens=True)
+    client.send_notification_batch(notifications[:10], TOPIC)
+
+    messages = [record.getMessage() for record in caplog.records]
+    assert 'Sending to token %s' % tokens[0] in messages
+    assert 'Got response for %s: Success' % tokens[0] in messages
+
+
+def test_send_notification_batch_encodes_shared_payload_once(client, mock_connection, tokens):
+    payload = Payload(alert='Test alert')
+    serializer = get_default_serializer()
+    with patch.object(serializer, 'dumps', wraps=serializer.dumps) as dumps:
+        client.send_notification_batch([Notification(token=token, payload=payload) for token in tokens], TOPIC)
+    assert dumps.call_count == 1
+    json_payloads = {id(call[0][2]) for call in mock_connection.request.call_args_list}
+    assert len(json_payloads) == 1
+
+
+def test_send_notification_batch_infers_push_type_per_payload(client, mock_connection):
+    notifications = [Notification(token='%064x' % 0, payload=Payload(alert='Test alert')),
+                     Notification(token='%064x' % 1, payload=Payload(content_available=True))]
+    client.send_notification_batch(notifications, TOPIC, expiration=60)
+    headers = [call[0][3] for call in mock_connection.request.call_args_list]
+    assert dict(headers[0]) == {'apns-topic': TOPIC, 'apns-push-type': 'alert', 'apns-expiration': '60'}
+    assert dict(headers[1]) == {'apns-topic': TOPIC, 'apns-push-type': 'background', 'apns-expiration': '60'}
+
+
+def test_send_notification_batch_routes_notifications_to_their_own_topic(client, mock_connection):
+    payload = Payload(alert='Test alert')
+    notifications = [Notification(token='%064x' % 0, payload=payload),
+                     RoutedNotification(token='%064x' % 1, payload=payload, topic='com.example.Other',
+                                        priority=NotificationPriority.Delayed),
+                     RoutedNotification(token='%064x' % 2, payload=payload, topic='com.example.App.voip',
+                                        expiration=0, collapse_id='news')]
+    client.send_notification_batch(notifications, TOPIC, expiration=60)
+    headers = {call[0][1].rsplit('/', 1)[1]: dict(call[0][3]) for call in mock_connection.request.call_args_list}
+    assert headers['%064x' % 0] == {'apns-topic': TOPIC, 'apns-push-type': 'alert', 'apns-expiration': '60'}
+    assert headers['%064x' % 1] == {'apns-topic': 'com.example.Other', 'apns-push-type': 'alert',
+                                    'apns-priority': '5', 'apns-expiration': '60'}
+    assert headers['%064x' % 2] == {'apns-topic': 'com.example.App.voip', 'apns-push-type': 'voip',
+                                    'apns-expiration': '0', 'apns-collapse-id': 'news'}
+
+
+def test_notification_keeps_its_two_fields(client, mock_connection):
+    token, payload = Notification(token='%064x' % 0, payload=Payload(alert='Test alert'))
+    # Tuples of other shapes, like the caller's own namedtuples, don't override the batch arguments
+    Other = collections.namedtuple('Other', ['token', 'payload', 'user_id'])
+    client.send_notification_batch([Other(token, payload, 42)], TOPIC)
+    assert dict(mock_connection.request.call_args[0][3])['apns-topic'] == TOPIC
+
+
+def test_send_notification_rejects_payload_too_large_before_sending(client, mock_connection):
+    with pytest.raises(PayloadTooLarge):
+        client.send_notification('%064x' % 0, Payload(alert='x' * MAX_PAYLOAD_SIZE), TOPIC)
+    assert mock_connection.request.call_count == 0
+
+
+def test_send_notification_batch_reports_payload_too_large_without_sending(client, mock_connection, tokens):
+    notifications = [Notification(token=tokens[0], payload=Payload(alert='x' * MAX_PAYLOAD_SIZE)),
+                     Notification(token=tokens[1], payload=Payload(alert='Test alert'))]
+    results = client.send_notification_batch(notifications, TOPIC)
+    assert results == {tokens[0]: 'PayloadTooLarge', tokens[1]: 'Success'}
+    assert mock_connection.request.call_count == 1
+
+
+@pytest.mark.parametrize('body', ['x' * 5000, '\u00e9\U0001F600"\n' * 1000])
+def test_send_notification_truncates_alert_body_to_fit(mock_connection, body):
+    with patch('apns2.credentials.HTTP20Connection') as mock_connection_constructor:
+        mock_connection_constructor.return_value = mock_connection
+        client = APNsClient(credentials=Credentials(), truncate_alert_body=True)
+
+    payload = Payload(alert=PayloadAlert(title='Title', body=body), custom={'data': 'value'})
+    client.send_notification_async('%064x' % 0, payload, TOPIC)
+    json_payload = mock_connection.request.call_args[0][2]
+    assert MAX_PAYLOAD_SIZE - 8 < len(json_payload) <= MAX_PAYLOAD_SIZE
+    truncated_body = json.loads(json_payload.decode('utf-8'))['aps']['alert']['body']
+    assert truncated_body.endswith('\u2026')
+    assert body.startswith(truncated_body[:-1])
+    assert payload.alert.body == body
+    assert payload.dict()['aps']['alert']['body'] == body
+
+
+@pytest.fixture
+def retrying_client(mock_connection):
+    with patch('apns2.credentials.HTTP20Connection') as mock_connection_constructor:
+        mock_connection_constructor.return_value = mock_connection
+        return APNsClient(credentials=Credentials(), retry_policy=RetryPolicy(max_retries=2, backoff=0))
+
+
+def fail_tokens(mock_connection, failures):
+    """Make the requests for each token fail with the given reasons, in order, before succeeding"""
+    send_request = mock_connection.request.side_effect
+    stream_tokens = {}
+
+    def mock_request(method, url, body, headers):
+        stream_id = send_request(method, url, body, headers)
+        stream_tokens[stream_id] = url.rsplit('/', 1)[1]
+        return stream_id
+
+    class Results(object):
+        def __bool__(self):
+            return True
+
+        def __getitem__(self, stream_id):
+            reasons = failures.get(stream_tokens[stream_id])
+            return reasons.pop(0) if reasons else 'Success'
+
+    mock_connection.request.side_effect = mock_request
+    mock_connection.__mock_results = Results()
+
+
+def test_send_notification_batch_retries_retryable_failures(retrying_client, mock_connection, tokens, notifications):
+    fail_tokens(mock_connection, {
+        tokens[0]: ['TooManyRequests'],
+        tokens[1]: ['InternalServerError', 'Shutdown'],
+        tokens[2]: ['ServiceUnavailable'] * 3,
+    })
+    results = retrying_client.send_notification_batch(notifications, TOPIC)
+    expected_results = {token: 'Success' for token in tokens}
+    expected_results[tokens[2]] = 'ServiceUnavailable'
+    assert results == expected_results
+    assert mock_connection.request.call_count == 1005
+
+
+def test_send_notification_batch_does_not_retry_permanent_failures(retrying_client, mock_connection, tokens,
+                                                                   notifications):
+    mock_connection.__mock_results = ['BadDeviceToken'] * 1000
+    results = retrying_client.send_notification_batch(notifications, TOPIC)
+    assert results == {token: 'BadDeviceToken' for token in tokens}
+    assert mock_connection.request.call_count == 1000
+
+
+def test_send_notification_batch_reconnects_after_shutdown(retrying_client, mock_connection, tokens, notifications):
+    fail_tokens(mock_connection, {tokens[10]: ['Shutdown']})
+    results = retrying_client.send_notification_batch(notifications, TOPIC)
+    assert results == {token: 'Success' for token in tokens}
+    mock_connection.close.assert_called_once_with()
+    assert mock_connection.connect.call_count == 2
+
+
+def test_retry_policy_backs_off_exponentially():
+    policy = RetryPolicy(max_retries=3, backoff=1, max_backoff=5, jitter=0)
+    assert [policy.delay(attempt) for attempt in range(4)] == [1, 2, 4, 5]
+    assert policy.should_retry('TooManyRequests', 2)
+    assert not policy.should_retry('TooManyRequests', 3)
+    assert not policy.should_retry('BadDeviceToken', 0)
+
+
+def test_send_notification_batch_replays_requests_after_connection_loss(client, mock_connection, tokens, notifications):
+    mock_connection._conn.remote_settings.max_concurrent_streams = 10
+    send_request = mock_connection.request.side_effect
+
+    def mock_request(*args):
+        stream_id = send_request(*args)
+        if stream_id < 5:
+            # These requests never get a response
+            mock_connection.streams[stream_id].remote_closed = False
+            mock_connection.recent_recv_streams.discard(stream_id)
+        return stream_id
+
+    mock_connection.request.side_effect = mock_request
+    mock_connection._recv_cb.side_effect = HTTP20ConnectionError('Connection terminated')
+
+    results = client.send_notification_batch(notifications[:20], TOPIC)
+    assert results == {token: 'Success' for token in tokens[:20]}
+    assert mock_connection.request.call_count == 25
+    replayed_urls = [call[0][1] for call in mock_connection.request.call_args_list[-5:]]
+    assert replayed_urls == ['/3/device/%s' % token for token in tokens[:5]]
+    mock_connection.close.assert_called_once_with()
+
+
+def test_send_notification_batch_gives_up_when_connection_keeps_failing(client, mock_connection, notifications):
+    mock_connection.request.side_effect = HTTP20ConnectionError('Connection terminated')
+    with pytest.raises(ConnectionFailed):
+        client.send_notification_batch(notifications, TOPIC)
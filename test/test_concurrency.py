@@ -0,0 +1,101 @@
+import pytest
+
+from apns2.client import APNsClient, Notification
+from apns2.concurrency import AdaptiveConcurrency
+from apns2.observer import MetricsObserver
+from apns2.payload import Payload
+from apns2.testing import MockAPNsServer, MockCredentials
+
+TOPIC = 'com.example.App'
+
+
+def test_window_grows_additively():
+    concurrency = AdaptiveConcurrency(initial=10, latency_threshold=1)
+    # One more stream for every window's worth of responses
+    for _ in range(11):
+        concurrency.response_received('Success', sent_at=100.0, now=100.01)
+    assert concurrency.limit == 11
+    assert concurrency.latency == pytest.approx(0.01)
+
+
+def test_window_shrinks_once_per_congestion():
+    concurrency = AdaptiveConcurrency(initial=40, latency_threshold=1)
+    concurrency.response_received('ServiceUnavailable', sent_at=100.0, now=100.1)
+    assert concurrency.limit == 20
+    # Requests sent before the decrease don't count
+    concurrency.response_received('InternalServerError', sent_at=100.05, now=100.2)
+    concurrency.stream_lost(sent_at=100.05, now=100.2)
+    assert concurrency.limit == 20
+    concurrency.stream_lost(sent_at=100.15, now=100.3)
+    assert concurrency.limit == 10
+    # TooManyRequests is about the device token, not APNs
+    concurrency.response_received('TooManyRequests', sent_at=100.4, now=100.5)
+    assert concurrency.limit == 10
+
+
+def test_window_shrinks_when_latency_rises():
+    concurrency = AdaptiveConcurrency(initial=40, latency_threshold=0.05, smoothing=1)
+    concurrency.response_received('Success', sent_at=100.0, now=100.01)
+    concurrency.response_received('Success', sent_at=100.0, now=100.03)
+    assert concurrency.limit == 40
+    concurrency.response_received('Success', sent_at=100.1, now=100.2)
+    assert concurrency.limit == 20
+
+
+def test_window_is_capped_by_server():
+    concurrency = AdaptiveConcurrency(initial=50, minimum=2)
+    concurrency.set_maximum(10)
+    assert concurrency.limit == 10
+    concurrency.response_received('ServiceUnavailable', sent_at=100.0, now=100.1)
+    assert concurrency.limit == 5
+    concurrency.set_maximum(0)
+    assert concurrency.limit == 2
+
+
+def test_window_keeps_maximum_below_server_limit():
+    concurrency = AdaptiveConcurrency(initial=2, maximum=3, latency_threshold=1)
+    concurrency.set_maximum(100)
+    assert concurrency.maximum == 3
+    for _ in range(20):
+        concurrency.response_received('Success', sent_at=100.0, now=100.01)
+    assert concurrency.limit == 3
+
+
+class InFlightObserver(MetricsObserver):
+    def __init__(self):
+        super().__init__()
+        self.max_in_flight = 0
+
+    def stream_opened(self, token, stream_id):
+        super().stream_opened(token, stream_id)
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+
+
+def test_batch_keeps_window_of_requests_in_flight():
+    payload = Payload(alert='Test alert')
+    notifications = [Notification(token='%064x' % i, payload=payload) for i in range(200)]
+    reasons = {notification.token: 'ServiceUnavailable' for notification in notifications[:10]}
+    observer = InFlightObserver()
+    concurrency = AdaptiveConcurrency(initial=32, minimum=4, latency_threshold=1)
+    with MockAPNsServer(reasons=reasons, latency=lambda token: 0.001) as server:
+        client = APNsClient(credentials=MockCredentials(server), observer=observer, concurrency=concurrency)
+        results = client.send_notification_batch(notifications, TOPIC)
+
+    assert len(results) == 200
+    assert 4 <= observer.max_in_flight <= 32
+    assert concurrency.limit < 32
+    assert observer.concurrency_window == concurrency.limit
+    assert 'apns_concurrency_window %d' % concurrency.limit in observer.render()
+
+
+def test_batch_keeps_maximum_below_server_limit():
+    payload = Payload(alert='Test alert')
+    notifications = [Notification(token='%064x' % i, payload=payload) for i in range(100)]
+    observer = InFlightObserver()
+    concurrency = AdaptiveConcurrency(initial=2, maximum=3, latency_threshold=1)
+    with MockAPNsServer(max_concurrent_streams=50, latency=lambda token: 0.001) as server:
+        client = APNsClient(credentials=MockCredentials(server), observer=observer, concurrency=concurrency)
+        client.send_notification_batch(notifications, TOPIC)
+
+    assert observer.max_in_flight <= 3
+    assert concurrency.limit == 3
@@ -4,10 +4,15 @@
 # - timing out of the token
 # - creating multiple tokens for different topics
 
+import time
+
 import pytest
 from freezegun import freeze_time
 
+from apns2 import credentials as credentials_module
 from apns2.credentials import TokenCredentials
+from apns2.observer import MetricsObserver
+from apns2.token_store import FileTokenStore, MemoryTokenStore
 
 TOPIC = 'com.example.first_app'
 
@@ -19,6 +24,7 @@ def token_credentials():
         auth_key_id='1QBCDJ9RST',
         team_id='3Z24IP123A',
         token_lifetime=30,  # seconds
+        token_store=MemoryTokenStore(),
     )
 
 
@@ -35,3 +41,63 @@ def test_token_expiration(token_credentials):
     with freeze_time('2012-01-14 12:00:40'):
         header3 = token_credentials.get_authorization_header(TOPIC)
         assert header3 != header1
+
+
+def test_token_refresh_notifies_observers(token_credentials):
+    observer = MetricsObserver()
+    token_credentials.add_observer(observer)
+    token_credentials.add_observer(observer)
+
+    with freeze_time('2012-01-14 12:00:00'):
+        token_credentials.get_authorization_header(TOPIC)
+        token_credentials.get_authorization_header(TOPIC)
+    with freeze_time('2012-01-14 12:00:40'):
+        token_credentials.get_authorization_header(TOPIC)
+
+    assert observer.token_refreshes == 2
+
+
+def make_token_credentials(token_store, **kwargs):
+    return TokenCredentials(auth_key_path='test/eckey.pem', auth_key_id='1QBCDJ9RST', team_id='3Z24IP123A',
+                            token_store=token_store, **kwargs)
+
+
+def test_credentials_with_same_key_share_tokens():
+    store = MemoryTokenStore()
+    observer = MetricsObserver()
+    first, second = make_token_credentials(store), make_token_credentials(store)
+    first.add_observer(observer)
+    second.add_observer(observer)
+
+    assert first.get_authorization_header(TOPIC) == second.get_authorization_header(TOPIC)
+    assert observer.token_refreshes == 1
+
+
+def test_file_token_store_is_shared_between_instances(tmp_path):
+    first, second = FileTokenStore(str(tmp_path)), FileTokenStore(str(tmp_path))
+    assert first.get('team.key') is None
+
+    with first.lock('team.key'):
+        first.set('team.key', 1000.5, 'token-1')
+    assert second.get('team.key') == (1000.5, 'token-1')
+
+    with second.lock('team.key'):
+        second.set('team.key', 2000.0, 'token-2')
+    assert first.get('team.key') == (2000.0, 'token-2')
+
+    header = make_token_credentials(first).get_authorization_header(TOPIC)
+    assert make_token_credentials(second).get_authorization_header(TOPIC) == header
+
+
+def test_background_refresh_replaces_token_before_expiry(monkeypatch):
+    monkeypatch.setattr(credentials_module, 'MIN_REFRESH_INTERVAL', 0.01)
+    observer = MetricsObserver()
+    credentials = make_token_credentials(MemoryTokenStore(), token_lifetime=1, background_refresh=True)
+    credentials.add_observer(observer)
+    header = credentials.get_authorization_header(TOPIC)
+
+    deadline = time.time() + 5
+    while credentials.get_authorization_header(TOPIC) == header and time.time() < deadline:
+        time.sleep(0.05)
+    assert credentials.get_authorization_header(TOPIC) != header
+    assert observer.token_refreshes >= 1
@@ -0,0 +1,118 @@
+import queue
+import threading
+import time
+from concurrent.futures import wait
+
+import pytest
+
+from apns2.client import APNsClient, Notification, RoutedNotification
+from apns2.dispatcher import APNsDispatcher
+from apns2.payload import Payload
+from apns2.testing import MockAPNsServer, MockCredentials
+from apns2.validation import DuplicatePolicy
+
+TOPIC = 'com.example.App'
+PAYLOAD = Payload(alert='Test alert')
+
+
+def test_dispatcher_resolves_futures_from_many_threads():
+    with MockAPNsServer(reasons={'%064x' % 7: 'BadDeviceToken'}, max_concurrent_streams=20) as server:
+        with APNsDispatcher(APNsClient(credentials=MockCredentials(server)), topic=TOPIC) as dispatcher:
+            futures = {}
+
+            def produce(start):
+                for i in range(start, start + 50):
+                    futures[i] = dispatcher.submit(Notification(token='%064x' % i, payload=PAYLOAD))
+
+            threads = [threading.Thread(target=produce, args=(start,)) for start in range(0, 200, 50)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            wait(futures.values(), timeout=10)
+
+    assert futures[7].result() == 'BadDeviceToken'
+    assert all(future.result() == 'Success' for i, future in futures.items() if i != 7)
+    assert server.request_count == 200
+
+
+def test_dispatcher_sends_after_being_idle():
+    with MockAPNsServer() as server:
+        with APNsDispatcher(APNsClient(credentials=MockCredentials(server)), topic=TOPIC) as dispatcher:
+            assert dispatcher.submit(Notification(token='%064x' % 1, payload=PAYLOAD)).result(timeout=5) == 'Success'
+            time.sleep(0.2)
+            started = time.monotonic()
+            assert dispatcher.submit(Notification(token='%064x' % 2, payload=PAYLOAD)).result(timeout=5) == 'Success'
+            assert time.monotonic() - started < 1
+
+
+def test_dispatcher_applies_backpressure():
+    # Slow responses and a single stream keep the queue full
+    with MockAPNsServer(max_concurrent_streams=1, latency=lambda token: 0.2) as server:
+        dispatcher = APNsDispatcher(APNsClient(credentials=MockCredentials(server)), topic=TOPIC, max_queue_size=2)
+        futures = [dispatcher.submit(Notification(token='%064x' % i, payload=PAYLOAD)) for i in range(3)]
+        with pytest.raises(queue.Full):
+            for i in range(3, 10):
+                futures.append(dispatcher.submit(Notification(token='%064x' % i, payload=PAYLOAD), block=False))
+        dispatcher.close()
+
+    assert all(future.result() == 'Success' for future in futures)
+    with pytest.raises(RuntimeError):
+        dispatcher.submit(Notification(token='%064x' % 1, payload=PAYLOAD))
+
+
+def test_dispatcher_sends_notification_submitted_while_closing():
+    with MockAPNsServer() as server:
+        dispatcher = APNsDispatcher(APNsClient(credentials=MockCredentials(server)), topic=TOPIC)
+        # Make submit() linger between its closed check and queueing the notification
+        pending = dispatcher._APNsDispatcher__queue
+        put = pending.put
+
+        def slow_put(*args):
+            time.sleep(0.2)
+            put(*args)
+
+        pending.put = slow_put
+        futures = []
+        thread = threading.Thread(
+            target=lambda: futures.append(dispatcher.submit(Notification(token='%064x' % 1, payload=PAYLOAD))))
+        thread.start()
+        time.sleep(0.05)
+        dispatcher.close()
+        thread.join()
+
+        assert futures[0].result(timeout=5) == 'Success'
+        assert server.request_count == 1
+
+
+def test_dispatcher_sends_every_submission_whatever_the_duplicate_policy():
+    with MockAPNsServer() as server:
+        client = APNsClient(credentials=MockCredentials(server), duplicate_policy=DuplicatePolicy.DropToken)
+        with APNsDispatcher(client, topic=TOPIC) as dispatcher:
+            token = '%064x' % 1
+            assert dispatcher.submit(Notification(token=token, payload=PAYLOAD)).result(timeout=5) == 'Success'
+            assert dispatcher.submit(Notification(token=token, payload=PAYLOAD)).result(timeout=5) == 'Success'
+
+    assert server.request_count == 2
+
+
+def test_dispatcher_fails_only_the_future_of_a_bad_submission():
+    with MockAPNsServer(latency=lambda token: 0.1) as server:
+        with APNsDispatcher(APNsClient(credentials=MockCredentials(server)), topic=TOPIC) as dispatcher:
+            accepted = dispatcher.submit(Notification(token='%064x' % 1, payload=PAYLOAD))
+            unserializable = dispatcher.submit(Notification(token='%064x' % 2, payload=Payload(custom={'a': object()})))
+            malformed = dispatcher.submit(('%064x' % 3,))
+            # Fails once the sender thread builds its headers
+            bad_priority = dispatcher.submit(RoutedNotification(token='%064x' % 4, payload=PAYLOAD, priority='high'))
+            later = dispatcher.submit(Notification(token='%064x' % 5, payload=PAYLOAD))
+
+            assert accepted.result(timeout=5) == 'Success'
+            assert later.result(timeout=5) == 'Success'
+            with pytest.raises(TypeError):
+                unserializable.result(timeout=5)
+            with pytest.raises(TypeError):
+                malformed.result(timeout=5)
+            with pytest.raises(AttributeError):
+                bad_priority.result(timeout=5)
+
+    assert server.request_count == 2
@@ -0,0 +1,66 @@
+from apns2.client import APNsClient, Notification
+from apns2.observer import MetricsObserver
+from apns2.payload import Payload
+from apns2.testing import MockAPNsServer, MockCredentials
+
+TOPIC = 'com.example.App'
+
+
+def make_notifications(count):
+    payload = Payload(alert='Test alert')
+    return [Notification(token='%064x' % i, payload=payload) for i in range(count)]
+
+
+def test_observer_sees_batch_lifecycle():
+    notifications = make_notifications(100)
+    observer = MetricsObserver()
+    with MockAPNsServer(reasons={notifications[0].token: 'BadDeviceToken'}, max_concurrent_streams=20) as server:
+        client = APNsClient(credentials=MockCredentials(server), observer=observer)
+        client.send_notification_batch(notifications, TOPIC)
+
+    assert observer.connects == 1
+    assert observer.reconnects == 0
+    assert observer.max_concurrent_streams == 20
+    assert observer.streams_opened == 100
+    assert observer.in_flight == 0
+    assert observer.responses == {(200, 'Success'): 99, (400, 'BadDeviceToken'): 1}
+    assert observer.latency.count == 100
+
+
+def test_observer_sees_lost_streams_and_reconnects():
+    notifications = make_notifications(300)
+    observer = MetricsObserver()
+    with MockAPNsServer(max_concurrent_streams=50, goaway_after=100, latency=lambda token: 0.001) as server:
+        client = APNsClient(credentials=MockCredentials(server), observer=observer)
+        client.send_notification_batch(notifications, TOPIC)
+
+    assert observer.reconnects == 1
+    assert observer.streams_lost > 0
+    assert observer.streams_opened == 300 + observer.streams_lost
+    assert observer.in_flight == 0
+
+
+def test_observer_sees_single_notification():
+    observer = MetricsObserver()
+    with MockAPNsServer() as server:
+        client = APNsClient(credentials=MockCredentials(server), observer=observer)
+        client.connect()
+        client.send_notification('%064x' % 1, Payload(alert='Test'), TOPIC)
+
+    assert observer.streams_opened == 1
+    assert observer.responses == {(200, 'Success'): 1}
+
+
+def test_metrics_render_prometheus_text():
+    observer = MetricsObserver(latency_buckets=(0.1, 1.0))
+    observer.stream_opened('token', 1)
+    observer.response_received('token', 410, 'Unregistered', 0.5)
+    text = observer.render()
+
+    assert 'apns_streams_opened_total 1\n' in text
+    assert 'apns_streams_in_flight 0\n' in text
+    assert 'apns_responses_total{status="410",reason="Unregistered"} 1\n' in text
+    assert 'apns_response_seconds_bucket{le="0.1"} 0\n' in text
+    assert 'apns_response_seconds_bucket{le="1.0"} 1\n' in text
+    assert 'apns_response_seconds_bucket{le="+Inf"} 1\n' in text
+    assert 'apns_response_seconds_count 1\n' in text
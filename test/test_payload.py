@@ -89,3 +89,31 @@ def test_payload_with_payload_alert(payload_alert):
         },
         'extra': 'something'
     }
+
+
+def test_payload_memoizes_dict_and_json():
+    payload = Payload(alert='my_alert', badge=2)
+    assert payload.dict() is payload.dict()
+    assert payload.encode() is payload.encode()
+    assert payload.encode() == b'{"aps":{"alert":"my_alert","badge":2}}'
+    assert not hasattr(payload, '__dict__')
+
+
+def test_payload_invalidates_memoized_values_on_assignment(payload_alert):
+    payload = Payload(alert=payload_alert, badge=2)
+    payload.encode()
+    payload.badge = 3
+    assert payload.dict()['aps']['badge'] == 3
+
+    payload_alert.body = 'new body'
+    assert payload.dict()['aps']['alert']['body'] == 'new body'
+    assert b'"body":"new body"' in payload.encode()
+
+
+def test_payload_invalidates_memoized_values_on_equal_value_of_another_type():
+    payload = Payload(badge=1)
+    assert payload.encode() == b'{"aps":{"badge":1}}'
+    payload.badge = True
+    assert payload.encode() == b'{"aps":{"badge":true}}'
+    payload.badge = 1.0
+    assert payload.encode() == b'{"aps":{"badge":1.0}}'
@@ -0,0 +1,83 @@
+import pickle
+import time
+
+import pytest
+
+from apns2.client import APNsClient, Notification
+from apns2.payload import Payload
+from apns2.rate_limit import COALESCED, RATE_LIMITED, RateLimitPolicy, TokenRateLimiter
+from apns2.testing import MockAPNsServer, MockCredentials
+
+TOPIC = 'com.example.App'
+TOKEN = '%064x' % 1
+OTHER_TOKEN = '%064x' % 2
+
+
+def test_limiter_allows_bursts_then_rate():
+    limiter = TokenRateLimiter(rate=10, burst=2)
+    assert limiter.check(TOKEN, now=100.0) == 0
+    assert limiter.check(TOKEN, now=100.0) == 0
+    assert limiter.check(TOKEN, now=100.0) == pytest.approx(0.1)
+    # Checking doesn't take a notification, reserving does
+    assert limiter.reserve(TOKEN, now=100.0) == pytest.approx(0.1)
+    assert limiter.reserve(TOKEN, now=100.0) == pytest.approx(0.2)
+    assert limiter.check(TOKEN, now=100.3) == 0
+    assert limiter.check(OTHER_TOKEN, now=100.0) == 0
+
+
+def test_limiter_evicts_least_recently_used_tokens():
+    limiter = TokenRateLimiter(rate=1, max_tokens=1)
+    assert limiter.check(TOKEN, now=100.0) == 0
+    assert limiter.check(OTHER_TOKEN, now=100.0) == 0
+    assert limiter.check(TOKEN, now=100.0) == 0
+    assert limiter.check(TOKEN, now=100.0) == pytest.approx(1)
+
+
+def send(policy, count=3, max_waiting=100):
+    notifications = [Notification(token=TOKEN, payload=Payload(alert='Message %d' % i)) for i in range(count)]
+    notifications.append(Notification(token=OTHER_TOKEN, payload=Payload(alert='Other')))
+    with MockAPNsServer() as server:
+        client = APNsClient(credentials=MockCredentials(server),
+                            rate_limiter=TokenRateLimiter(rate=20, policy=policy, max_waiting=max_waiting))
+        started = time.monotonic()
+        results = list(client.iter_notification_results(notifications, TOPIC))
+        elapsed = time.monotonic() - started
+    return results, [request.payload for request in server.requests], elapsed
+
+
+def test_batch_delays_excess_notifications():
+    results, payloads, elapsed = send(RateLimitPolicy.Delay)
+    assert [result for _, result in results] == ['Success'] * 4
+    assert len(payloads) == 4
+    assert elapsed >= 0.1
+
+
+def test_batch_stops_taking_notifications_while_too_many_wait():
+    results, payloads, _ = send(RateLimitPolicy.Delay, max_waiting=1)
+    assert [result for _, result in results] == ['Success'] * 4
+    # The notification to the other token stays in the batch until the others are sent
+    assert b'Other' in payloads[-1]
+    _, payloads, _ = send(RateLimitPolicy.Delay)
+    assert b'Other' in payloads[1]
+
+
+def test_batch_coalesces_excess_notifications():
+    results, payloads, _ = send(RateLimitPolicy.Coalesce, count=4)
+    assert sorted(results) == sorted([(TOKEN, COALESCED), (TOKEN, COALESCED)] +
+                                     [(TOKEN, 'Success')] * 2 + [(OTHER_TOKEN, 'Success')])
+    assert len(payloads) == 3
+    assert any(b'Message 3' in payload for payload in payloads)
+    assert not any(b'Message 1' in payload or b'Message 2' in payload for payload in payloads)
+
+
+def test_batch_drops_excess_notifications():
+    results, payloads, _ = send(RateLimitPolicy.Drop)
+    assert sorted(results) == sorted([(TOKEN, 'Success'), (TOKEN, RATE_LIMITED), (TOKEN, RATE_LIMITED),
+                                      (OTHER_TOKEN, 'Success')])
+    assert len(payloads) == 2
+
+
+def test_limiter_can_be_pickled():
+    limiter = pickle.loads(pickle.dumps(TokenRateLimiter(rate=10, burst=2, policy=RateLimitPolicy.Drop,
+                                                         max_waiting=5)))
+    assert (limiter.rate, limiter.burst, limiter.policy, limiter.max_waiting) == (10, 2, RateLimitPolicy.Drop, 5)
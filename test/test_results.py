@@ -0,0 +1,50 @@
+import sys
+
+from apns2.client import APNsClient, Notification
+from apns2.errors import BadDeviceToken, exception_class_for_reason
+from apns2.payload import Payload
+from apns2.results import BatchResults
+from apns2.testing import MockAPNsServer, MockCredentials
+
+
+def test_batch_results_round_trip():
+    pairs = [('%064x' % 0, 'Success'), ('%064x' % 1, 'BadDeviceToken'), ('%064x' % 2, ('Unregistered', 1500000000000)),
+             ('ABCDEF', 'Success'), ('not hex', 'SomeNewReason'), ('%064x' % 3, 'BadDeviceToken')]
+    results = BatchResults(pairs)
+    assert len(results) == len(pairs)
+    assert list(results) == pairs
+    assert results.to_dict() == dict(pairs)
+    assert results.count('Success') == 2
+    assert results.count('Forbidden') == 0
+    assert results.counts() == {'Success': 2, 'BadDeviceToken': 2, 'Unregistered': 1, 'SomeNewReason': 1}
+    assert list(results.tokens_with_reason('BadDeviceToken')) == ['%064x' % 1, '%064x' % 3]
+    assert list(results.unregistered()) == [('%064x' % 2, 1500000000000)]
+    assert list(results.failures()) == [pairs[1], pairs[2], pairs[4], pairs[5]]
+
+
+def test_batch_results_are_compact():
+    pairs = [('%064x' % i, 'Success') for i in range(10000)]
+    results = BatchResults(pairs)
+    size = sum(sys.getsizeof(getattr(results, '_BatchResults__' + column))
+               for column in ['tokens', 'token_ends', 'codes', 'timestamps'])
+    assert size < 60 * len(pairs)
+
+
+def test_batch_results_from_client():
+    notifications = [Notification(token='%064x' % i, payload=Payload(alert='Test alert')) for i in range(100)]
+    with MockAPNsServer(reasons={'%064x' % 5: 'BadDeviceToken'}) as server:
+        client = APNsClient(credentials=MockCredentials(server))
+        results = BatchResults(client.iter_notification_results(notifications, 'com.example.App'))
+
+    assert results.count('Success') == 99
+    assert list(results.tokens_with_reason('BadDeviceToken')) == ['%064x' % 5]
+
+
+def test_exception_class_for_reason():
+    assert exception_class_for_reason('BadDeviceToken') is BadDeviceToken
+
+
+def test_batch_results_dict_keeps_sent_results_over_held_back_ones():
+    token = '%064x' % 0
+    results = BatchResults([(token, 'Unregistered'), (token, 'Duplicate'), ('%064x' % 1, 'RateLimited')])
+    assert results.to_dict() == {token: 'Unregistered', '%064x' % 1: 'RateLimited'}
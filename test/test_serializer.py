@@ -0,0 +1,43 @@
+import datetime
+import json
+
+import pytest
+
+from apns2.payload import Payload, PayloadAlert
+from apns2.serializer import JSONSerializer, OrjsonSerializer, get_default_serializer
+
+
+class DateEncoder(json.JSONEncoder):
+    def default(self, o):
+        if isinstance(o, datetime.date):
+            return o.isoformat()
+        return super().default(o)
+
+
+@pytest.fixture
+def payload():
+    return Payload(alert=PayloadAlert(title='Zoë', body='☃ "snow"\n'), badge=1,
+                   custom={'ids': [1, 2], 'by_id': {3: 'three'}})
+
+
+def test_json_serializer(payload):
+    serializer = JSONSerializer()
+    json_payload = serializer.dumps(payload.dict())
+    assert json_payload == json.dumps(payload.dict(), ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    assert serializer.loads(b'{"reason":"BadDeviceToken"}') == {'reason': 'BadDeviceToken'}
+    assert JSONSerializer(DateEncoder).dumps({'day': datetime.date(2020, 1, 2)}) == b'{"day":"2020-01-02"}'
+
+
+def test_orjson_serializer_matches_json_serializer(payload):
+    pytest.importorskip('orjson')
+    serializer = OrjsonSerializer(DateEncoder)
+    assert serializer.dumps(payload.dict()) == JSONSerializer().dumps(payload.dict())
+    assert serializer.loads(b'{"reason":"BadDeviceToken"}') == {'reason': 'BadDeviceToken'}
+    assert serializer.dumps({'day': datetime.date(2020, 1, 2)}) == b'{"day":"2020-01-02"}'
+    assert isinstance(get_default_serializer(), OrjsonSerializer)
+
+
+def test_payload_encoding_is_memoized_per_serializer(payload):
+    serializer = JSONSerializer()
+    assert payload.encode(serializer) is payload.encode(serializer)
+    assert payload.encode(JSONSerializer()) == payload.encode(serializer)
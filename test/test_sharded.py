@@ -0,0 +1,53 @@
+import pickle
+
+import pytest
+
+from apns2.client import Notification
+from apns2.credentials import TokenCredentials
+from apns2.payload import Payload
+from apns2.sharded import ShardedSender
+from apns2.testing import MockAPNsServer, MockCredentials
+
+TOPIC = 'com.example.App'
+
+
+@pytest.fixture
+def notifications():
+    payload = Payload(alert='Test alert')
+    return [Notification(token='%064x' % i, payload=payload) for i in range(1000)]
+
+
+def test_sharded_sender_sends_every_notification(notifications):
+    reasons = {notifications[0].token: 'BadDeviceToken', notifications[-1].token: 'Unregistered'}
+    with MockAPNsServer(reasons=reasons, max_concurrent_streams=50, record_requests=False) as server:
+        with ShardedSender(MockCredentials(server), processes=2, chunk_size=100) as sender:
+            results = sender.send_notification_batch(notifications, TOPIC)
+        assert server.connection_count == 2
+
+    assert len(results) == len(notifications)
+    assert results[notifications[0].token] == 'BadDeviceToken'
+    assert results[notifications[-1].token][0] == 'Unregistered'
+    assert sum(result == 'Success' for result in results.values()) == len(notifications) - 2
+
+
+def test_sharded_sender_consumes_notifications_lazily(notifications):
+    consumed = []
+
+    def generate():
+        for notification in notifications:
+            consumed.append(notification)
+            yield notification
+
+    with MockAPNsServer(record_requests=False) as server:
+        with ShardedSender(MockCredentials(server), processes=1, chunk_size=100) as sender:
+            results = sender.iter_notification_results(generate(), TOPIC)
+            next(results)
+            assert len(consumed) <= 300
+            results.close()
+
+
+def test_token_credentials_are_rebuilt_from_key_path():
+    credentials = TokenCredentials(auth_key_path='test/eckey.pem', auth_key_id='1QBCDJ9RST', team_id='3Z24IP123A')
+    copy = pickle.loads(pickle.dumps(credentials))
+    assert isinstance(copy, TokenCredentials)
+    assert copy.get_authorization_header(TOPIC).startswith('bearer ')
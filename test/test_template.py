@@ -0,0 +1,72 @@
+import json
+import pickle
+
+import pytest
+
+from apns2.client import APNsClient, Notification
+from apns2.errors import PayloadTooLarge
+from apns2.payload import MAX_PAYLOAD_SIZE, Payload, PayloadAlert
+from apns2.template import PayloadTemplate
+from apns2.testing import MockAPNsServer, MockCredentials
+
+TOPIC = 'com.example.App'
+
+
+@pytest.fixture
+def template():
+    return PayloadTemplate(Payload(
+        alert=PayloadAlert(title='Hi {name}', body='You have {count} new {{messages}}', body_localized_args=['{name}']),
+        badge='{count}', sound='default', custom={'user': '{user}'}))
+
+
+def test_template_renders_like_payload(template):
+    rendered = template.render(name='Zoë "Z"\n', count=3, user={'id': 1})
+    expected = Payload(
+        alert=PayloadAlert(title='Hi Zoë "Z"\n', body='You have 3 new {messages}',
+                           body_localized_args=['Zoë "Z"\n']),
+        badge=3, sound='default', custom={'user': {'id': 1}})
+    assert rendered.encode() == expected.encode()
+    assert rendered.dict() == expected.dict()
+    assert template.field_names == {'name', 'count', 'user'}
+
+
+def test_rendered_payload_is_read_only(template):
+    rendered = template.render(name='Bob', count=1, user=1)
+    assert rendered.sound == 'default'
+    with pytest.raises(AttributeError):
+        rendered.badge = 2
+
+
+def test_rendered_payload_can_be_pickled(template):
+    rendered = template.render(name='Bob', count=1, user=1)
+    copy = pickle.loads(pickle.dumps(rendered))
+    assert copy.encode() == rendered.encode()
+    assert copy.sound == 'default'
+    assert copy.template.field_names == template.field_names
+
+
+def test_template_checks_size(template):
+    with pytest.raises(PayloadTooLarge):
+        template.render(name='x' * MAX_PAYLOAD_SIZE, count=1, user=1)
+    with pytest.raises(PayloadTooLarge):
+        PayloadTemplate(Payload(alert='x' * MAX_PAYLOAD_SIZE + '{name}'))
+
+
+@pytest.mark.parametrize('alert', ['{0}', '{}', '{name!r}', '{count:d}', '{user.name}', '{unclosed'])
+def test_template_rejects_unsupported_fields(alert):
+    with pytest.raises(ValueError):
+        PayloadTemplate(Payload(alert=alert))
+
+
+def test_batch_of_rendered_payloads():
+    template = PayloadTemplate(Payload(alert='Hello {name}', badge='{count}'))
+    notifications = [Notification(token='%064x' % i, payload=template.render(name='user %d' % i, count=i))
+                     for i in range(100)]
+    with MockAPNsServer() as server:
+        client = APNsClient(credentials=MockCredentials(server))
+        results = client.send_notification_batch(notifications, TOPIC)
+
+    assert set(results.values()) == {'Success'}
+    request = next(request for request in server.requests if request.token == '%064x' % 42)
+    assert json.loads(request.payload) == {'aps': {'alert': 'Hello user 42', 'badge': 42}}
+    assert request.headers['apns-push-type'] == 'alert'
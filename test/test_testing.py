@@ -0,0 +1,59 @@
+import time
+
+import pytest
+
+from apns2.client import APNsClient, Notification
+from apns2.errors import Unregistered
+from apns2.payload import Payload
+from apns2.testing import MockAPNsServer, MockCredentials
+
+TOPIC = 'com.example.App'
+
+
+@pytest.fixture
+def notifications():
+    payload = Payload(alert='Test alert')
+    return [Notification(token='%064x' % i, payload=payload) for i in range(1000)]
+
+
+def test_batch_against_mock_server(notifications):
+    reasons = {notifications[0].token: 'BadDeviceToken', notifications[1].token: ('Unregistered', 1500000000000)}
+    with MockAPNsServer(reasons=reasons, max_concurrent_streams=100) as server:
+        client = APNsClient(credentials=MockCredentials(server))
+        results = client.send_notification_batch(notifications, TOPIC)
+
+    assert results[notifications[0].token] == 'BadDeviceToken'
+    assert results[notifications[1].token] == ('Unregistered', 1500000000000)
+    assert sum(result == 'Success' for result in results.values()) == len(notifications) - 2
+    assert server.request_count == len(notifications)
+
+
+def test_unregistered_has_timestamp():
+    with MockAPNsServer(reasons={'%064x' % 1: 'Unregistered'}) as server:
+        client = APNsClient(credentials=MockCredentials(server))
+        with pytest.raises(Unregistered) as exc_info:
+            client.send_notification('%064x' % 1, Payload(alert='Test'), TOPIC)
+
+    assert abs(exc_info.value.timestamp / 1000 - time.time()) < 60
+
+
+def test_latency_and_settings_update(notifications):
+    with MockAPNsServer(max_concurrent_streams=10, latency=lambda token: 0.001) as server:
+        client = APNsClient(credentials=MockCredentials(server))
+        client.connect()
+        client.update_max_concurrent_streams()
+        server.update_max_concurrent_streams(50)
+        results = client.send_notification_batch(notifications[:200], TOPIC)
+        with client._connection._conn as connection:
+            assert connection.remote_settings.max_concurrent_streams == 50
+
+    assert set(results.values()) == {'Success'}
+
+
+def test_goaway_replays_unanswered_requests(notifications):
+    with MockAPNsServer(max_concurrent_streams=50, goaway_after=300, latency=lambda token: 0.001) as server:
+        client = APNsClient(credentials=MockCredentials(server))
+        results = client.send_notification_batch(notifications, TOPIC)
+
+    assert results == {notification.token: 'Success' for notification in notifications}
+    assert server.connection_count == 2
@@ -0,0 +1,112 @@
+import pickle
+import sqlite3
+import time
+
+import pytest
+
+from apns2.client import APNsClient, Notification
+from apns2.errors import Unregistered
+from apns2.payload import Payload
+from apns2.testing import MockAPNsServer, MockCredentials
+from apns2.token_sink import SQLiteTokenSink
+
+TOPIC = 'com.example.App'
+
+
+@pytest.fixture
+def sink(tmp_path):
+    sink = SQLiteTokenSink(str(tmp_path / 'tokens.db'), batch_size=2, flush_interval=60)
+    yield sink
+    sink.close()
+
+
+def test_batch_reports_invalid_tokens(sink):
+    payload = Payload(alert='Test alert')
+    notifications = [Notification(token='%064x' % i, payload=payload) for i in range(20)]
+    reasons = {
+        notifications[1].token: ('Unregistered', 1500000000000),
+        notifications[2].token: 'BadDeviceToken',
+        notifications[3].token: 'DeviceTokenNotForTopic',
+        notifications[4].token: 'PayloadEmpty',
+    }
+    with MockAPNsServer(reasons=reasons) as server:
+        client = APNsClient(credentials=MockCredentials(server), validate_tokens=True, invalid_token_sink=sink)
+        client.send_notification_batch(notifications + [Notification(token='bad', payload=payload)], TOPIC)
+
+    assert sorted(sink.tokens()) == [
+        (notifications[1].token, 'Unregistered', 1500000000000),
+        (notifications[2].token, 'BadDeviceToken', None),
+        (notifications[3].token, 'DeviceTokenNotForTopic', None),
+        ('bad', 'BadDeviceToken', None),
+    ]
+    assert list(sink.tokens('Unregistered')) == [(notifications[1].token, 'Unregistered', 1500000000000)]
+
+
+def test_single_notification_reports_invalid_token(sink):
+    token = '%064x' % 1
+    with MockAPNsServer(reasons={token: ('Unregistered', 1500000000000)}) as server:
+        client = APNsClient(credentials=MockCredentials(server), invalid_token_sink=sink)
+        with pytest.raises(Unregistered):
+            client.send_notification(token, Payload(alert='Test alert'), TOPIC)
+    assert list(sink.tokens()) == [(token, 'Unregistered', 1500000000000)]
+
+
+def wait_for_tokens(reader, count):
+    deadline = time.monotonic() + 5
+    while len(list(reader.tokens())) < count and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return len(list(reader.tokens()))
+
+
+def test_sink_writes_in_batches(sink):
+    reader = SQLiteTokenSink(sink.path)
+    sink.add('a', 'BadDeviceToken', None)
+    time.sleep(0.1)
+    assert list(reader.tokens()) == []
+    sink.add('b', 'BadDeviceToken', None)
+    assert wait_for_tokens(reader, 2) == 2
+    # The latest report of a token wins
+    sink.add('a', 'Unregistered', 1)
+    sink.flush()
+    assert sorted(reader.tokens()) == [('a', 'Unregistered', 1), ('b', 'BadDeviceToken', None)]
+    reader.close()
+
+    copy = pickle.loads(pickle.dumps(sink))
+    assert len(list(copy.tokens())) == 2
+    copy.close()
+
+
+def test_sink_writes_without_blocking_the_caller(sink):
+    # Another connection holds the database lock
+    locker = sqlite3.connect(sink.path, isolation_level=None)
+    locker.execute('BEGIN EXCLUSIVE')
+    started = time.monotonic()
+    sink.add('a', 'BadDeviceToken', None)
+    sink.add('b', 'BadDeviceToken', None)
+    sink.add('c', 'BadDeviceToken', None)
+    assert time.monotonic() - started < 0.1
+    time.sleep(0.1)
+    locker.execute('COMMIT')
+    locker.close()
+    sink.flush()
+    assert sorted(token for token, _, _ in sink.tokens()) == ['a', 'b', 'c']
+
+
+def test_sink_raises_write_errors_on_flush(tmp_path):
+    sink = SQLiteTokenSink(str(tmp_path / 'tokens.db'), flush_interval=60)
+    locker = sqlite3.connect(sink.path)
+    locker.execute('DROP TABLE invalid_tokens')
+    locker.commit()
+    locker.close()
+    sink.add('a', 'BadDeviceToken', None)
+    with pytest.raises(sqlite3.OperationalError):
+        sink.flush()
+    with pytest.raises(sqlite3.OperationalError):
+        sink.close()
+    with pytest.raises(RuntimeError):
+        sink.add('b', 'BadDeviceToken', None)
+
+
+def test_sink_rejects_invalid_table_name(tmp_path):
+    with pytest.raises(ValueError):
+        SQLiteTokenSink(str(tmp_path / 'tokens.db'), table='tokens; DROP TABLE users')
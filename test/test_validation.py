@@ -0,0 +1,75 @@
+import pytest
+
+from apns2.client import APNsClient, Notification
+from apns2.errors import BadDeviceToken
+from apns2.payload import Payload
+from apns2.testing import MockAPNsServer, MockCredentials
+from apns2.serializer import JSONSerializer
+from apns2.validation import DUPLICATE, DuplicatePolicy, _PreSendCheck, is_valid_token, normalize_token
+
+TOPIC = 'com.example.App'
+TOKEN = '%064x' % 1
+
+
+@pytest.mark.parametrize('token, valid', [
+    (TOKEN, True),
+    ('  ' + TOKEN.upper() + '\n', True),
+    ('ab' * 100, True),
+    (TOKEN[:-2], False),
+    (TOKEN[:-1], False),
+    (TOKEN[:-1] + 'g', False),
+    ('ab' * 101, False),
+    ('', False),
+])
+def test_token_validation(token, valid):
+    assert is_valid_token(normalize_token(token)) == valid
+
+
+def send_batch(notifications, **client_kwargs):
+    with MockAPNsServer() as server:
+        client = APNsClient(credentials=MockCredentials(server), **client_kwargs)
+        results = list(client.iter_notification_results(notifications, TOPIC))
+        return results, dict(results), server.requests
+
+
+def test_batch_rejects_malformed_tokens_without_sending_them():
+    payload = Payload(alert='Test alert')
+    notifications = [Notification(token='not a token', payload=payload),
+                     Notification(token=TOKEN.upper(), payload=payload)]
+    _, results, requests = send_batch(notifications, validate_tokens=True)
+    assert results == {'not a token': 'BadDeviceToken', TOKEN.upper(): 'Success'}
+    assert [request.token for request in requests] == [TOKEN]
+
+
+@pytest.mark.parametrize('policy, sent', [
+    (DuplicatePolicy.Keep, 4),
+    (DuplicatePolicy.DropIdentical, 3),
+    (DuplicatePolicy.DropToken, 2),
+])
+def test_batch_duplicate_policy(policy, sent):
+    other_token = '%064x' % 2
+    notifications = [Notification(token=TOKEN, payload=Payload(alert='Test alert')),
+                     Notification(token=TOKEN, payload=Payload(alert='Test alert')),
+                     Notification(token=TOKEN, payload=Payload(alert='Other alert')),
+                     Notification(token=other_token, payload=Payload(alert='Test alert'))]
+    results, results_dict, requests = send_batch(notifications, duplicate_policy=policy)
+    assert len(results) == 4
+    assert sum(result == DUPLICATE for _, result in results) == 4 - sent
+    assert results_dict == {TOKEN: 'Success', other_token: 'Success'}
+    assert len(requests) == sent
+
+
+def test_duplicates_are_only_looked_for_among_recent_notifications():
+    check = _PreSendCheck(False, DuplicatePolicy.DropToken, JSONSerializer(), window=2)
+    tokens = ['%064x' % i for i in (1, 2, 1, 3, 4, 1)]
+    results = [check.check(Notification(token=token, payload=Payload(alert='Test alert'))) for token in tokens]
+    assert results == [None, None, DUPLICATE, None, None, None]
+
+
+def test_send_notification_rejects_malformed_token_without_sending_it():
+    with MockAPNsServer() as server:
+        client = APNsClient(credentials=MockCredentials(server), validate_tokens=True)
+        with pytest.raises(BadDeviceToken):
+            client.send_notification('not a token', Payload(alert='Test alert'), TOPIC)
+        client.send_notification(TOKEN.upper(), Payload(alert='Test alert'), TOPIC)
+    assert [request.token for request in server.requests] == [TOKEN]